@@ -13,12 +13,15 @@ from models.Discriminator import Discriminator_1DCNN
 from models.Generator import Generator
 from utils.dataset import ConductorMotionDataset
 from utils.loss import SyncLoss, rhythm_density_error, strengh_contour_error
-from utils.train_utils import plot_motion
+from utils.plot_utils import FigureRenderer, render_motion
+from utils.checkpoint_utils import CheckpointWriter
 
 
 class M2SGAN_Evaluator():
-    def __init__(self, args):
-        self.batch_size = 1
+    def __init__(self, args, device='cuda'):
+        self.batch_size = args.eval_batch_size
+        self.seed = 0
+        self.device = device
         self.sample_length = args.sample_length
         self.mode = args.mode
         self.save_path = 'checkpoints/M2SGAN/' + self.mode + time.strftime("_%a-%b-%d_%H-%M-%S", time.localtime())
@@ -28,16 +31,18 @@ class M2SGAN_Evaluator():
                                                   split=args.testing_set,
                                                   limit=args.testing_set_limit,
                                                   root_dir=args.dataset_dir)
-        self.test_loader = DataLoader(dataset=self.testing_set, batch_size=self.batch_size, shuffle=True)
+        self.test_loader = DataLoader(dataset=self.testing_set, batch_size=self.batch_size, shuffle=False)
         print('testing set initialized, {} samples, {} hours'
               .format(len(self.testing_set), round(len(self.testing_set) * args.sample_length / 3600, 2)))
 
         self.MSE = nn.MSELoss()
 
-        M2SNet = models.M2SNet.M2SNet().cuda()
-        M2SNet.load_state_dict(torch.load(args.M2SNet))
+        M2SNet = models.M2SNet.M2SNet().to(device)
+        M2SNet.load_state_dict(torch.load(args.M2SNet, map_location=device))
         M2SNet.eval()
         self.perceptual_loss = SyncLoss(M2SNet.motion_encoder)
+        self.renderer = FigureRenderer(background=args.background_plots)
+        self.checkpoints = CheckpointWriter(self.save_path, keep=args.keep_checkpoints)
 
     def evaluate(self, G, D, perceptual_loss, writer, epoch, total_step, save_checkpoints=True):
         G.eval()
@@ -45,92 +50,83 @@ class M2SGAN_Evaluator():
 
         print('| Evaluating M2SGAN at Epoch {}'.format(epoch))
 
-        # Realism
-        SD_fake_all = []
-        SD_real_all = []
-        W_dis_all = []
-
-        # Consistency
-        MSE_all = []
-        MPE_all = []
-        loss_sync_all = []
-        RDE_all = []
-        SCE_all = []
+        # per-sample metrics, summed on the device and synced once after the loop
+        metrics = ['SD_fake', 'SD_real', 'W_dis', 'MSE', 'MPE', 'loss_sync', 'SCE']
+        sums = {metric: torch.zeros([], device=self.device) for metric in metrics}
+        RDE_sum = 0
+        num_samples = 0
+        # the same noise every evaluation, so that checkpoints are comparable
+        generator = torch.Generator(device=self.device).manual_seed(self.seed)
 
         pbar = tqdm.tqdm(enumerate(self.test_loader), total=len(self.test_loader))
-        for step, (mel, real_motion) in pbar:
-            if real_motion.shape[0] != self.batch_size:
-                continue
-            mel = mel.type(torch.FloatTensor).cuda()
-            real_motion = real_motion.type(torch.FloatTensor).cuda()
-
-            noise = torch.randn([self.batch_size, self.sample_length, 8]).cuda()
-            fake_motion = G(mel, noise)
-
-            # ----------- #
-            #   Realism   #
-            # ----------- #
-
-            # Standard Deviation
-            fake_sd = torch.mean(torch.std(fake_motion, dim=1)).item()
-            real_sd = torch.mean(torch.std(real_motion, dim=1)).item()
-            SD_fake_all.append(fake_sd)
-            SD_real_all.append(real_sd)
-
-            # W Distance
-            real_output_D = D(real_motion)
-            fake_output_D = D(fake_motion.detach())
-            W_dis_all.append((real_output_D - fake_output_D).detach().cpu().numpy().mean())
-
-            # ----------- #
-            # Consistency #
-            # ----------- #
-
-            # Mean Squared Error
-            mse = self.MSE(fake_motion, real_motion)
-            MSE_all.append(mse.item())
-
-            # Mean Perceptual Error
-            mpe = self.perceptual_loss(fake_motion, real_motion)
-            MPE_all.append(mpe.item())
-
-            # Perceptual Loss
-            loss_sync = perceptual_loss(fake_motion, real_motion)
-            loss_sync_all.append(loss_sync.item())
-
-            # Rhythm Density Error
-            RDE = rhythm_density_error(real_motion, fake_motion)
-            RDE_all.append(RDE)
-
-            # Strengh Contur Error
-            SCE = strengh_contour_error(real_motion, fake_motion)
-            SCE_all.append(SCE.item())
+        with torch.no_grad():
+            for step, (mel, real_motion) in pbar:
+                batch_size = real_motion.shape[0]
+                mel = mel.type(torch.FloatTensor).to(self.device)
+                real_motion = real_motion.type(torch.FloatTensor).to(self.device)
+
+                noise = torch.randn([batch_size, self.sample_length, 8], generator=generator, device=self.device)
+                fake_motion = G(mel, noise)
+
+                # ----------- #
+                #   Realism   #
+                # ----------- #
+
+                # Standard Deviation
+                sums['SD_fake'] += torch.std(fake_motion, dim=1).flatten(start_dim=1).mean(dim=1).sum()
+                sums['SD_real'] += torch.std(real_motion, dim=1).flatten(start_dim=1).mean(dim=1).sum()
+
+                # W Distance
+                sums['W_dis'] += (D(real_motion) - D(fake_motion)).sum()
+
+                # ----------- #
+                # Consistency #
+                # ----------- #
+
+                # Mean Squared Error
+                sums['MSE'] += ((fake_motion - real_motion) ** 2).flatten(start_dim=1).mean(dim=1).sum()
+
+                # Mean Perceptual Error and Perceptual Loss: means over equally sized samples
+                sums['MPE'] += self.perceptual_loss(fake_motion, real_motion) * batch_size
+                sums['loss_sync'] += perceptual_loss(fake_motion, real_motion) * batch_size
+
+                # Rhythm Density Error
+                RDE_sum += rhythm_density_error(real_motion, fake_motion, per_sample=True).sum()
+
+                # Strengh Contur Error
+                sums['SCE'] += strengh_contour_error(real_motion, fake_motion, per_sample=True).sum()
+                num_samples += batch_size
+
+        means = dict(zip(metrics, (torch.stack([sums[metric] for metric in metrics]) / num_samples).tolist()))
+        RDE = RDE_sum / num_samples
 
         writer.add_scalars('M2SGAN_Realism/W_distance',
-                           {'test': np.array(W_dis_all).mean()}, total_step)
+                           {'test': means['W_dis']}, total_step)
         writer.add_scalars('M2SGAN_Realism/Standard Deviation',
-                           {'test': np.mean(SD_fake_all),
-                            'real': np.mean(SD_real_all)}, total_step)
+                           {'test': means['SD_fake'],
+                            'real': means['SD_real']}, total_step)
 
         writer.add_scalars('M2SGAN_Consistency/MSE Loss',
-                           {'test': np.mean(MSE_all)}, total_step)
+                           {'test': means['MSE']}, total_step)
         writer.add_scalars('M2SGAN_Consistency/Sync Loss',
-                           {'test': np.mean(loss_sync_all)}, total_step)
+                           {'test': means['loss_sync']}, total_step)
 
-        writer.add_scalars('M2SGAN_Consistency/Sync Error (SE)', {'test': np.mean(MPE_all)}, total_step)
-        writer.add_scalars('M2SGAN_Consistency/Rhythm Density Error (RDE)', {'test': np.mean(RDE_all)}, total_step)
-        writer.add_scalars('M2SGAN_Consistency/Strengh Contour Error (SCE)', {'test': np.mean(SCE_all)}, total_step)
+        writer.add_scalars('M2SGAN_Consistency/Sync Error (SE)', {'test': means['MPE']}, total_step)
+        writer.add_scalars('M2SGAN_Consistency/Rhythm Density Error (RDE)', {'test': RDE}, total_step)
+        writer.add_scalars('M2SGAN_Consistency/Strengh Contour Error (SCE)', {'test': means['SCE']}, total_step)
 
-        print('| MPE: %.5f | RDE: %.5f | SCE: %.5f' % (np.mean(MPE_all), np.mean(RDE_all), np.mean(SCE_all)))
+        print('| MPE: %.5f | RDE: %.5f | SCE: %.5f' % (means['MPE'], RDE, means['SCE']))
 
-        fig_motion = plot_motion(fake_motion, real_motion)
-        writer.add_image("M2SGAN training sample", fig_motion, total_step, dataformats='HWC')
+        self.renderer.submit(lambda image: writer.add_image("M2SGAN training sample", image, total_step,
+                                                            dataformats='HWC'),
+                             render_motion, fake_motion[0].detach().float().cpu().numpy(),
+                             real_motion[0].cpu().numpy())
 
         if save_checkpoints:
-            torch.save(G.state_dict(), '{}/M2SGAN_Generator_{}_{}.pt'.format(self.save_path, epoch, total_step))
-            torch.save(G.state_dict(), '{}/M2SGAN_Generator_last.pt'.format(self.save_path))
-            torch.save(D.state_dict(), '{}/M2SGAN_Discriminator_{}_{}.pt'.format(self.save_path, epoch, total_step))
-            torch.save(D.state_dict(), '{}/M2SGAN_Discriminator_last.pt'.format(self.save_path))
+            self.checkpoints.save(G.state_dict(), 'M2SGAN_Generator_{}_{}.pt'.format(epoch, total_step),
+                                  last='M2SGAN_Generator_last.pt')
+            self.checkpoints.save(D.state_dict(), 'M2SGAN_Discriminator_{}_{}.pt'.format(epoch, total_step),
+                                  last='M2SGAN_Discriminator_last.pt')
 
         G.train()
         D.train()
@@ -1,3 +1,4 @@
+import os
 import argparse
 import tqdm
 import numpy as np
@@ -16,119 +17,312 @@ torch.backends.cudnn.benchmark = True
 import models.M2SNet
 from models.Generator import Generator
 from models.Discriminator import Discriminator_1DCNN
+from models.activation_checkpoint import set_checkpointing, frozen_batch_norm
 from M2SGAN_eval import M2SGAN_Evaluator
 from utils.dataset import ConductorMotionDataset
-from utils.train_utils import freeze, unfreeze
-from utils.loss import calc_gradient_penalty_ST, SyncLoss, rhythm_density_error, strengh_contour_error, \
+from utils.embedding_store import precompute_music_embedding, precompute_sync_feature, StoredFeatureDataset
+from utils.train_utils import freeze, unfreeze, StageTimer, StageProfiler, FakeReplayBuffer, ResumableSampler
+from utils.checkpoint_utils import rng_state, set_rng_state, load_state
+from utils.metrics import MetricLogger
+from utils.amp_utils import AMP_MODES, autocast, grad_scaler
+from utils.dist_utils import init_distributed, barrier, cleanup, main_process_first, broadcast_parameters, \
+    all_reduce_gradients, average_buffers, all_gather_object
+from utils.loss import lazy_gradient_penalty, SyncLoss, rhythm_density_error, strengh_contour_error, \
     FeatureMatchingLoss
 
-torch.manual_seed(19990319)
-torch.cuda.manual_seed(19990319)
-np.random.seed(19990319)
+SEED = 19990319
+torch.manual_seed(SEED)
+torch.cuda.manual_seed(SEED)
+np.random.seed(SEED)
+
+
+def generate(G, music, noise, args):
+    with autocast(args.amp, music.device.type):
+        if args.music_embedding_dir is not None:
+            fake_motion = G.decode(music, noise)
+        else:
+            fake_motion = G(music, noise)
+    # losses, penalty and metrics are computed from float32 motion
+    return fake_motion.float()
 
 
 def train(args):
+    rank, world_size, device = init_distributed(args.device, args.backend)
+
     training_set = ConductorMotionDataset(sample_length=args.sample_length,
                                           split=args.training_set,
                                           limit=args.training_set_limit,
                                           root_dir=args.dataset_dir)
-    train_loader = DataLoader(dataset=training_set, batch_size=args.batch_size, shuffle=True, pin_memory=True)
 
-    M2SNet = models.M2SNet.M2SNet().cuda()
-    M2SNet.load_state_dict(torch.load(args.M2SNet))
+    M2SNet = models.M2SNet.M2SNet().to(device)
+    M2SNet.load_state_dict(torch.load(args.M2SNet, map_location=device))
     M2SNet.eval()
     perceptual_loss = SyncLoss(M2SNet.motion_encoder)
 
     MSE = nn.MSELoss()
 
-    G = Generator().cuda()
+    G = Generator().to(device)
     if args.transfer_music_encoder:
         G.music_encoder.load_state_dict(M2SNet.music_encoder.state_dict())
     if not args.train_music_encoder:
         freeze(G.music_encoder)
+    D = Discriminator_1DCNN().to(device)
+    # the models are built under the same seed and synchronized from rank 0 before anything (e.g. the embedding store
+    # below) depends on their weights, then every process draws different noise
+    broadcast_parameters(G)
+    broadcast_parameters(D)
+    torch.manual_seed(SEED + rank)
+    np.random.seed(SEED + rank)
+    if len(args.checkpoint_blocks) > 0:
+        # the motion encoder of M2SNet is run with gradients by the sync loss
+        print('| Activation checkpointing:', ', '.join(set_checkpointing(args.checkpoint_blocks, G, M2SNet)))
+    music_embedding, sync_feature = None, None
+    if args.music_embedding_dir is not None:
+        # the frozen music encoder is run once over the training set, training reads its outputs instead of mels
+        if args.train_music_encoder:
+            raise RuntimeError('--music_embedding_dir requires a frozen music encoder!')
+        with main_process_first():
+            music_embedding = precompute_music_embedding(G.music_encoder, training_set, args.music_embedding_dir,
+                                                         split=args.training_set, limit=args.training_set_limit,
+                                                         device=device)
+    if args.sync_feature_dir is not None:
+        # the frozen motion encoder of the sync loss then only runs on generated motion
+        with main_process_first():
+            sync_feature = precompute_sync_feature(perceptual_loss, training_set, args.sync_feature_dir,
+                                                   split=args.training_set, limit=args.training_set_limit,
+                                                   device=device)
+    if music_embedding is not None or sync_feature is not None:
+        training_set = StoredFeatureDataset(training_set, music_embedding, sync_feature)
+    sampler = ResumableSampler(training_set, shuffle=True, seed=SEED, num_replicas=world_size, rank=rank)
+    train_loader = DataLoader(dataset=training_set, batch_size=args.batch_size, sampler=sampler, pin_memory=True)
     optimizer_G = torch.optim.RMSprop(G.parameters(), lr=args.lr)
-
-    D = Discriminator_1DCNN().cuda()
-
     optimizer_D = torch.optim.RMSprop(D.parameters(), lr=args.lr)
-    writer = SummaryWriter(comment='_M2SGAN_[{}]'.format(args.mode))
-    evaluator = M2SGAN_Evaluator(args)
+    scaler_G = grad_scaler(args.amp, device.type)
+    scaler_D = grad_scaler(args.amp, device.type)
+    # evaluation, checkpoints and TensorBoard are handled by rank 0
+    writer = SummaryWriter(comment='_M2SGAN_[{}]'.format(args.mode)) if rank == 0 else None
+    evaluator = M2SGAN_Evaluator(args, device) if rank == 0 else None
+
+    if args.accumulation_steps < 1:
+        raise RuntimeError('--accumulation_steps should be at least 1!')
+    if args.gp_interval < 1:
+        raise RuntimeError('--gp_interval should be at least 1!')
+    # --profile_steps: a short run of synchronized stage timing, without evaluation
+    profiling = args.profile_steps > 0
+    timer = StageProfiler(device, rank, warmup=args.profile_warmup) if profiling \
+        else StageTimer(enabled=args.log_timing, device=device)
+    logger = MetricLogger(writer, flush_steps=args.log_interval)
+    replay_buffer = None
+    if args.critic_replay_size > 0:
+        if args.critic_replay_size < args.batch_size * args.accumulation_steps:
+            raise RuntimeError('--critic_replay_size should be at least batch_size * accumulation_steps!')
+        replay_buffer = FakeReplayBuffer(args.critic_replay_size)
+    # a buffer of exactly one update: the critic trains on the fakes of every micro-batch, not on random samples
+    replay_exact = args.critic_replay_size == args.batch_size * args.accumulation_steps
 
     total_step = 0
-
-    SD_real_all = []
-    for epoch in range(args.epoch_num):
-        pbar = tqdm.tqdm(enumerate(train_loader), total=train_loader.__len__())
-        for step, (music, real_motion) in pbar:
-            if real_motion.shape[0] != args.batch_size:
+    critic_step = 0
+
+    SD_real_sum = torch.zeros([], device=device)
+    SD_real_count = 0
+
+    start_epoch, start_step = 0, 0
+    if args.resume is not None:
+        state = load_state(args.resume)
+        G.load_state_dict(state['G'])
+        D.load_state_dict(state['D'])
+        optimizer_G.load_state_dict(state['optimizer_G'])
+        optimizer_D.load_state_dict(state['optimizer_D'])
+        scaler_G.load_state_dict(state['scaler_G'])
+        scaler_D.load_state_dict(state['scaler_D'])
+        if replay_buffer is not None and state['replay_buffer'] is not None:
+            replay_buffer.load_state_dict(state['replay_buffer'], device)
+        start_epoch, start_step = state['epoch'], state['step']
+        total_step, critic_step = state['total_step'], state['critic_step']
+        SD_real_sum, SD_real_count = state['SD_real_sum'].to(device), state['SD_real_count']
+        set_rng_state(state['rng'][rank % len(state['rng'])])
+        print('| Resuming from {} at epoch {}, step {}'.format(args.resume, start_epoch, start_step))
+
+    for epoch in range(start_epoch, args.epoch_num):
+        # the batches of an interrupted epoch that were already trained on are skipped
+        first_step = start_step if epoch == start_epoch else 0
+        sampler.set_epoch(epoch, first_step * args.batch_size)
+        pbar = tqdm.tqdm(enumerate(timer.iterate(train_loader), first_step), total=train_loader.__len__(),
+                         disable=rank != 0)
+        num_batches = first_step + len(train_loader)
+        micro_batches = []
+        for step, batch in pbar:
+            with timer('host_to_device'):
+                music, real_motion = batch[:2]
+                music = music.type(torch.FloatTensor).to(device)
+                real_motion = real_motion.type(torch.FloatTensor).to(device)
+                real_sync_feature = batch[2].to(device) if sync_feature is not None else None
+                noise = torch.randn([real_motion.shape[0], args.sample_length, 8]).to(device)
+            micro_batches.append((music, real_motion, real_sync_feature, noise))
+            # one update per accumulation_steps batches, the last (possibly partial) batches of an epoch included
+            if len(micro_batches) < args.accumulation_steps and step + 1 < num_batches:
                 continue
-            music = music.type(torch.FloatTensor).cuda()
-            real_motion = real_motion.type(torch.FloatTensor).cuda()
-            optimizer_G.zero_grad()
-
-            noise = torch.randn([args.batch_size, args.sample_length, 8]).cuda()
-            fake_motion = G(music, noise)
+            # every loss is a mean over the effective batch: the loss of a micro-batch is weighted by its share
+            effective_size = sum(len(real_motion) for _, real_motion, _, _ in micro_batches)
+            fractions = [len(real_motion) / effective_size for _, real_motion, _, _ in micro_batches]
+
+            with timer('generator_forward'):
+                if replay_buffer is not None:
+                    # the critic trains on detached fakes, the generator graph is only built for its own update.
+                    # G runs in train mode twice on the same batches: only the update pass moves the BN statistics
+                    with torch.no_grad(), frozen_batch_norm(G):
+                        positions = [replay_buffer.push(generate(G, music, noise, args))
+                                     for music, _, _, noise in micro_batches]
+                elif len(micro_batches) == 1:
+                    fake_motion = generate(G, music, noise, args)
+                    critic_fakes = [fake_motion.detach()]
+                else:
+                    # the generator graphs of all micro-batches are not kept alive through the critic iterations,
+                    # the generator is re-run for its own update (which alone updates the BN statistics)
+                    with torch.no_grad(), frozen_batch_norm(G):
+                        critic_fakes = [generate(G, music, noise, args) for music, _, _, noise in micro_batches]
 
             # ------------------------ #
             #    train Discriminator   #
             # ------------------------ #
             for critic_i in range(args.CRITIC_ITERS):
                 optimizer_D.zero_grad()
-                real_output_D = D(real_motion)
-                fake_output_D = D(fake_motion.detach())
-
-                Loss_D_real = -torch.mean(real_output_D)
-                Loss_D_fake = torch.mean(fake_output_D)
-
-                gradient_penalty_Dr = calc_gradient_penalty_ST(D, real_motion.data, fake_motion.data,
-                                                               term=['real_fake'])
-                Loss_D = Loss_D_real + Loss_D_fake + args.w_gp * gradient_penalty_Dr
-                Loss_D.backward()
-                optimizer_D.step()
+                for i, (music, real_motion, _, _) in enumerate(micro_batches):
+                    if replay_buffer is None:
+                        critic_fake = critic_fakes[i]
+                    elif replay_exact:
+                        critic_fake = replay_buffer.latest(positions[i], len(real_motion))
+                    else:
+                        critic_fake = replay_buffer.sample(len(real_motion))
+                    with timer('critic_adversarial'), autocast(args.amp, device.type):
+                        real_output_D = D(real_motion)
+                        fake_output_D = D(critic_fake)
+
+                        Loss_D_real = -torch.mean(real_output_D)
+                        Loss_D_fake = torch.mean(fake_output_D)
+                        Loss_D = fractions[i] * (Loss_D_real + Loss_D_fake)
+
+                    with timer('critic_gradient_penalty'), autocast(args.amp, device.type):
+                        gradient_penalty_Dr = lazy_gradient_penalty(D, real_motion.data, critic_fake, critic_step,
+                                                                    interval=args.gp_interval, term=['real_fake'],
+                                                                    scaler=scaler_D, batch_fraction=fractions[i])
+                        if gradient_penalty_Dr is not None:
+                            Loss_D = Loss_D + args.w_gp * gradient_penalty_Dr
+
+                    with timer('critic_backward'):
+                        scaler_D.scale(Loss_D).backward()
+                with timer('critic_backward'):
+                    all_reduce_gradients(D)
+                    scaler_D.step(optimizer_D)
+                    scaler_D.update()
+                critic_step += 1
 
             # ----------------------- #
             #     train Generator     #
             # ----------------------- #
             optimizer_G.zero_grad()
-            mse_loss = MSE(fake_motion, real_motion)
-            Loss_adv = -torch.mean(D(fake_motion))
-            sync_loss = perceptual_loss(fake_motion, real_motion)
-
-            Loss_G = args.w_mse * mse_loss + args.w_adv * Loss_adv + args.w_sync * sync_loss
-            Loss_G.backward()
-            optimizer_G.step()
+            with timer('generator_update'):
+                for i, (music, real_motion, real_sync_feature, noise) in enumerate(micro_batches):
+                    if replay_buffer is not None or len(micro_batches) > 1:
+                        fake_motion = generate(G, music, noise, args)
+                    with autocast(args.amp, device.type):
+                        mse_loss = MSE(fake_motion, real_motion)
+                        Loss_adv = -torch.mean(D(fake_motion))
+                        with timer('sync_loss'):
+                            sync_loss = perceptual_loss(fake_motion, real_motion, real_sync_feature)
+
+                        Loss_G = args.w_mse * mse_loss + args.w_adv * Loss_adv + args.w_sync * sync_loss
+                    scaler_G.scale(fractions[i] * Loss_G).backward()
+                all_reduce_gradients(G)
+                scaler_G.step(optimizer_G)
+                scaler_G.update()
+            micro_batches = []
 
             ###############################################
             #                    Logging                  #
             ###############################################
 
-            W_dis = torch.mean(real_output_D).item() - torch.mean(fake_output_D).item()
-            writer.add_scalars('M2SGAN_Realism/W_distance', {'train': W_dis}, total_step)
-            writer.add_scalars('M2SGAN_Realism/Standard Deviation',
-                               {'train': torch.mean(torch.std(fake_motion, dim=1))}, total_step)
-            SD_real_all.append(torch.mean(torch.std(real_motion, dim=1)).item())
-
-            writer.add_scalars('M2SGAN_Consistency/MSE Loss',
-                               {'train': mse_loss.item()}, total_step)
-            writer.add_scalars('M2SGAN_Consistency/Perceptual Loss',
-                               {'train': sync_loss.item()}, total_step)
-
-            writer.add_scalars('M2SGAN_Consistency/Rhythm Density Error (RDE)',
-                               {'train': rhythm_density_error(real_motion, fake_motion)}, total_step)
-            writer.add_scalars('M2SGAN_Consistency/Strengh Contour Error (SCE)',
-                               {'train': strengh_contour_error(real_motion, fake_motion)}, total_step)
-
-            pbar.set_description('Epoch: %d | step: %d | total step: %d '
-                                 '| MSE: %.5f | sync loss: %.5f | Wasserstein distance: %.5f'
-                                 % (epoch, step, total_step,
-                                    mse_loss.item(), sync_loss.item(), W_dis))
+            with timer('logging'):
+                # accumulated on the device and written every --log_interval steps, no host sync per step
+                logger.add('M2SGAN_Realism/W_distance', 'train', torch.mean(real_output_D) - torch.mean(fake_output_D))
+                logger.add('M2SGAN_Realism/Standard Deviation', 'train', torch.mean(torch.std(fake_motion, dim=1)))
+                SD_real_sum += torch.mean(torch.std(real_motion, dim=1)).detach()
+                SD_real_count += 1
+
+                logger.add('M2SGAN_Consistency/MSE Loss', 'train', mse_loss)
+                logger.add('M2SGAN_Consistency/Perceptual Loss', 'train', sync_loss)
+                logger.add('M2SGAN_Consistency/Strengh Contour Error (SCE)', 'train',
+                           strengh_contour_error(real_motion, fake_motion))
+                if args.rde_interval > 0 and total_step % args.rde_interval == 0:
+                    # computed on the CPU with scipy, sampled
+                    logger.add('M2SGAN_Consistency/Rhythm Density Error (RDE)', 'train',
+                               rhythm_density_error(real_motion, fake_motion))
+                if args.log_timing and (total_step + 1) % args.log_interval == 0:
+                    # per training step: the critic stages are summed over the CRITIC_ITERS iterations
+                    for stage, ms in timer.collect().items():
+                        logger.add('M2SGAN_Timing/ms per step', stage, ms / args.log_interval)
+                logger.step(total_step)
+
+                latest = logger.latest
+                pbar.set_description('Epoch: %d | step: %d | total step: %d '
+                                     '| MSE: %.5f | sync loss: %.5f | Wasserstein distance: %.5f'
+                                     % (epoch, step, total_step,
+                                        latest.get(('M2SGAN_Consistency/MSE Loss', 'train'), float('nan')),
+                                        latest.get(('M2SGAN_Consistency/Perceptual Loss', 'train'), float('nan')),
+                                        latest.get(('M2SGAN_Realism/W_distance', 'train'), float('nan'))))
             total_step += 1
+            if args.state_interval > 0 and total_step % args.state_interval == 0:
+                # everything needed to continue after this step, written in the background by rank 0
+                with timer('checkpoint'):
+                    # the BatchNorm statistics of every process are saved, averaged
+                    average_buffers(G)
+                    average_buffers(D)
+                    rng = all_gather_object(rng_state())
+                    # after the last batch of the epoch, training continues with the first batch of the next one
+                    next_epoch, next_step = (epoch + 1, 0) if step + 1 == num_batches else (epoch, step + 1)
+                    if rank == 0:
+                        evaluator.checkpoints.save({'G': G.state_dict(), 'D': D.state_dict(),
+                                                    'optimizer_G': optimizer_G.state_dict(),
+                                                    'optimizer_D': optimizer_D.state_dict(),
+                                                    'scaler_G': scaler_G.state_dict(),
+                                                    'scaler_D': scaler_D.state_dict(),
+                                                    'replay_buffer': None if replay_buffer is None
+                                                    else replay_buffer.state_dict(),
+                                                    'epoch': next_epoch, 'step': next_step, 'total_step': total_step,
+                                                    'critic_step': critic_step,
+                                                    'SD_real_sum': SD_real_sum, 'SD_real_count': SD_real_count,
+                                                    'rng': rng}, 'training_state.pt')
+            timer.step()
+            if profiling and timer.steps == args.profile_warmup + args.profile_steps:
+                break
+        if profiling:
+            if timer.steps == args.profile_warmup + args.profile_steps:
+                break
+            continue
         torch.cuda.empty_cache()
         if epoch % args.evaluate_epoch == 0 or epoch == 0 or epoch == args.epoch_num:
-            evaluator.evaluate(G, D, perceptual_loss, writer, epoch, total_step)
-            writer.add_scalars('M2SGAN_Realism/Standard Deviation',
-                               {'train_real': np.mean(SD_real_all)}, total_step)
-
+            logger.flush(total_step - 1)
+            logger.join()
+            average_buffers(G)
+            average_buffers(D)
+            if rank == 0:
+                evaluator.evaluate(G, D, perceptual_loss, writer, epoch, total_step)
+                writer.add_scalars('M2SGAN_Realism/Standard Deviation',
+                                   {'train_real': (SD_real_sum / max(SD_real_count, 1)).item()}, total_step)
+            barrier()
+    logger.close()
+    if profiling:
+        if rank == 0:
+            timer.print_report()
+        # one trace per process, they can be opened together
+        root, ext = os.path.splitext(args.profile_trace)
+        trace = args.profile_trace if world_size == 1 else '{}_rank{}{}'.format(root, rank, ext)
+        timer.save_trace(trace)
+        print('| Profile trace written to {}'.format(trace))
+    if rank == 0:
+        evaluator.renderer.close()
+        evaluator.checkpoints.close()
+    cleanup()
 
 def main(args):
     print()
@@ -161,6 +355,12 @@ if __name__ == '__main__':
     parser.add_argument('--train_music_encoder', default=False)
     parser.add_argument('--M2SNet_test', default='checkpoints/M2SNet/hard_test/M2SNet_last.pt',
                         help='to calculate sync error')
+    parser.add_argument('--music_embedding_dir', default=None,
+                        help='precompute the frozen (eval-mode) music encoder outputs of the training set once, '
+                             'store them memory-mapped in this directory and train on them instead of mels')
+    parser.add_argument('--sync_feature_dir', default=None,
+                        help='precompute the sync loss features of the real training motion once and store them '
+                             'memory-mapped in this directory')
 
     parser.add_argument('--dataset_dir', default='Dataset')
     parser.add_argument('--training_set', default='train')
@@ -180,6 +380,52 @@ if __name__ == '__main__':
     parser.add_argument('--w_sync', default=0.05, help='weight for sync loss')
     parser.add_argument('--w_mse', default=0, help='weight for MSE loss')
     parser.add_argument('--w_gp', default=10, help='weight for gradient penalty')
+    parser.add_argument('--gp_interval', default=1, type=int,
+                        help='lazy regularization: apply the gradient penalty every k critic steps, weighted by k')
+    parser.add_argument('--accumulation_steps', default=1, type=int,
+                        help='gradient accumulation: every update (of the generator, and each critic iteration) '
+                             'averages the gradients of accumulation_steps batches of batch_size')
+    parser.add_argument('--critic_replay_size', default=0, type=int,
+                        help='0: the critic trains on the fakes of the current step, whose generator graph is kept '
+                             'alive until the generator update. n >= batch_size * accumulation_steps: fakes are '
+                             'generated under no_grad into a buffer of the last n samples, the critic trains on random '
+                             'batches from it (on exactly the current fakes when n equals batch_size * '
+                             'accumulation_steps) and the generator is re-run for its own update (lower peak memory)')
+    parser.add_argument('--eval_batch_size', default=16, type=int, help='batch size of the evaluation')
+    parser.add_argument('--keep_checkpoints', default=0, type=int,
+                        help='number of epoch checkpoints kept on disk per model (0: all)')
+    parser.add_argument('--background_plots', action='store_true',
+                        help='render evaluation figures in a background process')
+    parser.add_argument('--log_interval', default=20, type=int,
+                        help='training metrics are averaged on the GPU and written every log_interval steps')
+    parser.add_argument('--rde_interval', default=100, type=int,
+                        help='compute the (CPU) Rhythm Density Error every rde_interval steps, 0 to disable')
+    parser.add_argument('--log_timing', action='store_true',
+                        help='log the time of the generator / critic / gradient penalty stages to TensorBoard')
+    parser.add_argument('--checkpoint_blocks', default=[], nargs='*',
+                        help='activation checkpointing: blocks whose activations are recomputed in backward instead '
+                             'of kept, as fnmatch patterns of their names, e.g. "music_encoder.conv*" (generator, '
+                             'with --train_music_encoder) "motion_encoder.st_gcn.st_gcn_networks.*" (sync loss). Less '
+                             'memory for longer sample_length')
+    parser.add_argument('--profile_steps', default=0, type=int,
+                        help='profile profile_steps training steps (after profile_warmup steps) with the device '
+                             'synchronized around every stage, print the per-stage breakdown, write a Chrome trace '
+                             'and exit without evaluation. 0 to train normally')
+    parser.add_argument('--profile_warmup', default=5, type=int, help='steps left out of the profile report')
+    parser.add_argument('--profile_trace', default='M2SGAN_profile.json',
+                        help='Chrome trace of the profiled steps (chrome://tracing, ui.perfetto.dev)')
+
+    parser.add_argument('--amp', default='fp32', choices=AMP_MODES,
+                        help='mixed precision: "bf16" autocast, or "fp16" autocast with loss scaling')
+    parser.add_argument('--state_interval', default=500, type=int,
+                        help='save the full training state (models, optimizers, RNG, data position) to '
+                             'training_state.pt in the checkpoint directory every state_interval steps, 0 to disable')
+    parser.add_argument('--resume', default=None, help='training state to resume from')
+    parser.add_argument('--device', default='cuda',
+                        help='"cuda" or "cpu". Launched with torchrun, every process trains on its own GPU '
+                             '(cuda:LOCAL_RANK) and batch_size is per process')
+    parser.add_argument('--backend', default=None,
+                        help='torch.distributed backend, by default nccl on CUDA and gloo on CPU')
 
     args = parser.parse_args()
 
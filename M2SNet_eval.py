@@ -1,20 +1,36 @@
 import os
+import time
 import tqdm
-import numpy as np
 
 import torch
 from torch.utils.data import DataLoader
 
 from utils.dataset import ConductorMotionDataset
-from utils.train_utils import PairBuilder, plot_hidden_feature
+from utils.train_utils import PairBuilder
+from utils.plot_utils import FigureRenderer, render_hidden_feature
+from utils.checkpoint_utils import CheckpointWriter
+
+
+# sampling strategy of PairBuilder, name in the logs
+DIFFICULTIES = [('easy', 'easy'), ('hard', 'hard'), ('super_hard', 'superhard')]
 
 
 class M2SNet_evaluator():
-    def __init__(self, args):
-        self.batch_size = 2
+    """
+    Scores easy, hard and super-hard pairs of every test batch in one pass: the clips of all three difficulties are
+    stacked, each clip is encoded once and the positive music embedding is fused with both motion embeddings.
+    Clip offsets come from a generator seeded at every evaluation, so the same pairs are scored at every epoch.
+    """
+
+    def __init__(self, args, device='cuda'):
+        self.batch_size = args.eval_batch_size
+        if self.batch_size < 2 or self.batch_size % 2 != 0:
+            raise RuntimeError('eval_batch_size should be an even number (easy negatives flip the batch)')
         self.clip_length = args.clip_length
         self.sample_length = args.sample_length
         self.mode = args.mode
+        self.seed = 0
+        self.device = device
         self.save_path = 'checkpoints/M2SNet/'+self.mode
         if not os.path.isdir('checkpoints/M2SNet/'+self.mode):
             os.mkdir(self.save_path)
@@ -22,94 +38,84 @@ class M2SNet_evaluator():
                                                   split=args.testing_set,
                                                   limit=args.testing_set_limit,
                                                   root_dir=args.dataset_dir)
-        self.test_loader = DataLoader(dataset=self.testing_set, batch_size=self.batch_size, shuffle=True)
-        self.pairBuilder = PairBuilder(args)
+        self.test_loader = DataLoader(dataset=self.testing_set, batch_size=self.batch_size, shuffle=False)
+        self.pairBuilder = PairBuilder(args, device)
+        self.renderer = FigureRenderer(background=args.background_plots)
+        self.checkpoints = CheckpointWriter(self.save_path, keep=args.keep_checkpoints)
+
+    def score_pairs(self, M2SNet, pairs):
+        """ Predictions (difficulty, N, T, 1) of positive and negative pairs, pairs: one build_pairs per difficulty """
+        # build_pairs cuts clips of a fixed length, the clips of all difficulties are encoded in one batch
+        mel_1 = torch.cat([mel_1 for mel_1, _, _, _ in pairs])
+        motion_12 = torch.cat([motion_1 for _, _, motion_1, _ in pairs] + [motion_2 for _, _, _, motion_2 in pairs])
+
+        h_mel_1, h_motion_12 = M2SNet.encode(mel_1, motion_12)
+        h_motion_1, h_motion_2 = h_motion_12.chunk(2)
+        pred_11 = M2SNet.fuse(h_mel_1, h_motion_1)
+        pred_12 = M2SNet.fuse(h_mel_1, h_motion_2)
+        num_difficulties = len(DIFFICULTIES)
+        return pred_11.unflatten(0, (num_difficulties, -1)), pred_12.unflatten(0, (num_difficulties, -1))
 
     def evaluate(self, M2SNet, writer, epoch, total_step):
         M2SNet.eval()
+        self.pairBuilder.seed(self.seed)
 
         print('| Evaluating M2SNet at Epoch {}'.format(epoch))
 
-        accuracy_easy_all = []
-        accuracy_hard_all = []
-        accuracy_superhard_all = []
-
-        sync_easy_all = []
-        non_sync_easy_all = []
-        sync_hard_all = []
-        non_sync_hard_all = []
-        sync_superhard_all = []
-        non_sync_superhard_all = []
+        # per difficulty: correct predictions, sum of positive / negative predictions and number of predictions
+        correct = torch.zeros(len(DIFFICULTIES), device=self.device)
+        sync_sum = torch.zeros(len(DIFFICULTIES), device=self.device)
+        non_sync_sum = torch.zeros(len(DIFFICULTIES), device=self.device)
+        count = 0
+        num_samples = 0
 
-        for repet in range(1):
-            pbar = tqdm.tqdm(enumerate(self.test_loader), total=len(self.test_loader))
+        start_time = time.perf_counter()
+        pbar = tqdm.tqdm(enumerate(self.test_loader), total=len(self.test_loader))
+        with torch.no_grad():
             for step, (music, motion) in pbar:
-                if motion.shape[0] != self.batch_size:
+                # easy negatives flip the batch, so a partial batch of odd size leaves out its last sample
+                size = motion.shape[0] - motion.shape[0] % 2
+                if size == 0:
                     continue
-                music = music.type(torch.FloatTensor).cuda()
-                motion = motion.type(torch.FloatTensor).cuda()
-
-                # --- Easy Negatives --- #
-                mel_1, mel_2, motion_1, motion_2 = self.pairBuilder.build_pairs(music, motion, 'easy')
-                pred_easy_11 = M2SNet(mel_1, motion_1)
-                pred_easy_12 = M2SNet(mel_1, motion_2)
-                sync_easy_all.append(torch.mean(pred_easy_11).item())
-                non_sync_easy_all.append(torch.mean(pred_easy_12).item())
-
-                TP = np.sum(pred_easy_11.detach().cpu().numpy() > 0.5)
-                TF = np.sum(pred_easy_12.detach().cpu().numpy() < 0.5)
-                accuracy_easy = (TP + TF) / (self.batch_size * 2 * 30 * self.clip_length)
-                accuracy_easy_all.append(accuracy_easy.item())
-
-                # --- Hard Negatives --- #
-                mel_1, mel_2, motion_1, motion_2 = self.pairBuilder.build_pairs(music, motion, 'hard')
-                pred_hard_11 = M2SNet(mel_1, motion_1)
-                pred_hard_12 = M2SNet(mel_1, motion_2)
-                sync_hard_all.append(torch.mean(pred_hard_11).item())
-                non_sync_hard_all.append(torch.mean(pred_hard_12).item())
-
-                TP = np.sum(pred_hard_11.detach().cpu().numpy() > 0.5)
-                TF = np.sum(pred_hard_12.detach().cpu().numpy() < 0.5)
-                accuracy_hard = (TP + TF) / (self.batch_size * 2 * 30 * self.clip_length)
-                accuracy_hard_all.append(accuracy_hard.item())
-
-                # --- Super-hard Negatives --- #
-                mel_1, mel_2, motion_1, motion_2 = self.pairBuilder.build_pairs(music, motion, 'super_hard')
-                pred_superhard_11 = M2SNet(mel_1, motion_1)
-                pred_superhard_12 = M2SNet(mel_1, motion_2)
-                sync_superhard_all.append(torch.mean(pred_superhard_11).item())
-                non_sync_superhard_all.append(torch.mean(pred_superhard_12).item())
-
-                TP = np.sum(pred_superhard_11.detach().cpu().numpy() > 0.5)
-                TF = np.sum(pred_superhard_12.detach().cpu().numpy() < 0.5)
-                accuracy_superhard = (TP + TF) / (self.batch_size * 2 * 30 * self.clip_length)
-                accuracy_superhard_all.append(accuracy_superhard.item())
-
-        accuracy_easy_avg = np.mean(accuracy_easy_all)
-        accuracy_hard_avg = np.mean(accuracy_hard_all)
-        accuracy_superhard_avg = np.mean(accuracy_superhard_all)
-        writer.add_scalars('M2SNet/accuracy', {'test_easy': accuracy_easy_avg}, total_step)
-        writer.add_scalars('M2SNet/accuracy', {'test_hard': accuracy_hard_avg}, total_step)
-        writer.add_scalars('M2SNet/accuracy', {'test_superhard': accuracy_superhard_avg}, total_step)
-        writer.add_scalars('M2SNet/prediction_test', {'sync_easy': np.mean(sync_easy_all),
-                                                      'non_sync_easy': np.mean(non_sync_easy_all)}, total_step)
-        writer.add_scalars('M2SNet/prediction_test', {'sync_hard': np.mean(sync_hard_all),
-                                                      'non_sync_hard': np.mean(non_sync_hard_all)}, total_step)
-        writer.add_scalars('M2SNet/prediction_test', {'sync_superhard': np.mean(sync_superhard_all),
-                                                      'non_sync_superhard': np.mean(non_sync_superhard_all)}, total_step)
-
-        print('| Easy: %.5f | Hard: %.5f | Super-hard: %.5f' % (accuracy_easy_avg,accuracy_hard_avg,accuracy_superhard_avg))
-
-        music_features, motion_features = M2SNet.features(mel_1.cuda(), motion_1.cuda())
-        for i in range(len(music_features)):
-            feature = plot_hidden_feature(music_features[i].transpose(1, 2))
-            writer.add_image('M2SNet Music feature/layer {}'.format(i), feature, total_step, dataformats='HWC')
-        for i in range(len(motion_features)):
-            if i == 0 or i == len(motion_features) - 1 or i % 2 == 0:
-                feature = plot_hidden_feature(motion_features[i].transpose(1, 2))
-                writer.add_image('M2SNet Motion feature/layer {}'.format(i), feature, total_step, dataformats='HWC')
-
-        torch.save(M2SNet.state_dict(), '{}/M2SNet_{}_{}.pt'.format(self.save_path, epoch, total_step))
-        torch.save(M2SNet.state_dict(), '{}/M2SNet_last.pt'.format(self.save_path))
+                music = music[:size].type(torch.FloatTensor).to(self.device)
+                motion = motion[:size].type(torch.FloatTensor).to(self.device)
+
+                pairs = [self.pairBuilder.build_pairs(music, motion, strategy) for strategy, _ in DIFFICULTIES]
+                pred_11, pred_12 = self.score_pairs(M2SNet, pairs)
+                correct += (pred_11 > 0.5).flatten(start_dim=1).sum(dim=1) + \
+                           (pred_12 < 0.5).flatten(start_dim=1).sum(dim=1)
+                sync_sum += pred_11.flatten(start_dim=1).sum(dim=1)
+                non_sync_sum += pred_12.flatten(start_dim=1).sum(dim=1)
+                count += pred_11[0].numel()
+                num_samples += motion.shape[0]
+
+        accuracy, sync, non_sync = (torch.stack([correct / (2 * count), sync_sum / count, non_sync_sum / count])
+                                    .tolist())
+        elapsed = time.perf_counter() - start_time
+        throughput = num_samples / elapsed
+
+        for i, (_, name) in enumerate(DIFFICULTIES):
+            writer.add_scalars('M2SNet/accuracy', {'test_' + name: accuracy[i]}, total_step)
+            writer.add_scalars('M2SNet/prediction_test', {'sync_' + name: sync[i], 'non_sync_' + name: non_sync[i]},
+                               total_step)
+        writer.add_scalar('M2SNet/eval_samples_per_second', throughput, total_step)
+
+        print('| Easy: %.5f | Hard: %.5f | Super-hard: %.5f' % tuple(accuracy))
+        print('| %d samples in %.1f s (%.1f samples/s)' % (num_samples, elapsed, throughput))
+
+        num_motion_layers = len(M2SNet.motion_encoder.FEATURE_LAYERS)
+        motion_layers = [i for i in range(num_motion_layers) if i == num_motion_layers - 1 or i % 2 == 0]
+        mel_1, _, motion_1, _ = pairs[-1]
+        with torch.no_grad():
+            music_features, motion_features = M2SNet.features(mel_1, motion_1,
+                                                              motion_layers=motion_layers)
+        for name, layers, features in [('Music', range(len(music_features)), music_features),
+                                       ('Motion', motion_layers, motion_features)]:
+            for i, feature in zip(layers, features):
+                tag = 'M2SNet {} feature/layer {}'.format(name, i)
+                self.renderer.submit(lambda image, tag=tag: writer.add_image(tag, image, total_step, dataformats='HWC'),
+                                     render_hidden_feature, feature[0].float().cpu().numpy())
+
+        self.checkpoints.save(M2SNet.state_dict(), 'M2SNet_{}_{}.pt'.format(epoch, total_step), last='M2SNet_last.pt')
 
         M2SNet.train()
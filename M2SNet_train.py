@@ -1,3 +1,4 @@
+import os
 import argparse
 import tqdm
 import numpy as np
@@ -14,80 +15,193 @@ torch.backends.cudnn.enabled = True
 torch.backends.cudnn.benchmark = True
 
 import models.M2SNet
+from models.activation_checkpoint import set_checkpointing
 from utils.dataset import ConductorMotionDataset
 from M2SNet_eval import M2SNet_evaluator
-from utils.train_utils import PairBuilder
+from utils.train_utils import PairBuilder, ResumableSampler, StageTimer, StageProfiler
+from utils.checkpoint_utils import rng_state, set_rng_state, load_state
+from utils.metrics import MetricLogger
+from utils.amp_utils import AMP_MODES, autocast, grad_scaler
+from utils.dist_utils import init_distributed, barrier, cleanup, broadcast_parameters, all_reduce_gradients, \
+    average_buffers, all_gather_object
 
-torch.manual_seed(19990319)
-torch.cuda.manual_seed(19990319)
-np.random.seed(19990319)
+SEED = 19990319
+torch.manual_seed(SEED)
+torch.cuda.manual_seed(SEED)
+np.random.seed(SEED)
 
 
 def train(args):
     total_step = 0
+    rank, world_size, device = init_distributed(args.device, args.backend)
+    # different pair offsets on every process, the model is synchronized from rank 0
+    torch.manual_seed(SEED + rank)
+    np.random.seed(SEED + rank)
+    if args.batch_size < 2 or args.batch_size % 2 != 0:
+        raise RuntimeError('batch_size (per process) should be an even number (easy negatives flip the batch)')
+    if args.accumulation_steps < 1:
+        raise RuntimeError('accumulation_steps should be at least 1')
 
     training_set = ConductorMotionDataset(sample_length=args.sample_length,
                                           split=args.training_set,
                                           limit=args.training_set_limit,
                                           root_dir=args.dataset_dir)
-    train_loader = DataLoader(dataset=training_set, batch_size=args.batch_size, shuffle=False)
+    sampler = ResumableSampler(training_set, shuffle=False, seed=SEED, num_replicas=world_size, rank=rank)
+    train_loader = DataLoader(dataset=training_set, batch_size=args.batch_size, sampler=sampler)
 
-    M2SNet = models.M2SNet.M2SNet().cuda()
+    M2SNet = models.M2SNet.M2SNet().to(device)
     M2SNet.init_weight()
+    if len(args.checkpoint_blocks) > 0:
+        print('| Activation checkpointing:', ', '.join(set_checkpointing(args.checkpoint_blocks, M2SNet)))
+    broadcast_parameters(M2SNet)
     optimizer_M2S = torch.optim.Adam(M2SNet.parameters(), lr=0.001)
-
-    evatuator = M2SNet_evaluator(args)
-    pairBuilder = PairBuilder(args)
-    writer = SummaryWriter(comment='_M2SNet_[{}]'.format(args.mode))
-
-    ONE = torch.ones([args.batch_size, 1]).cuda()
-    ZERO = torch.zeros([args.batch_size, 1]).cuda()
+    scaler = grad_scaler(args.amp, device.type)
+
+    # evaluation, checkpoints and TensorBoard are handled by rank 0
+    evatuator = M2SNet_evaluator(args, device) if rank == 0 else None
+    pairBuilder = PairBuilder(args, device)
+    writer = SummaryWriter(comment='_M2SNet_[{}]'.format(args.mode)) if rank == 0 else None
+    logger = MetricLogger(writer, flush_steps=args.log_interval)
+    # --profile_steps: a short run of synchronized stage timing, without evaluation
+    profiling = args.profile_steps > 0
+    timer = StageProfiler(device, rank, warmup=args.profile_warmup) if profiling \
+        else StageTimer(enabled=False, device=device)
+
+    ONE = torch.ones([args.batch_size, 1], device=device)
+    ZERO = torch.zeros([args.batch_size, 1], device=device)
     BCE = nn.BCELoss()
 
-    for epoch in range(args.num_epoch):
-        pbar = tqdm.tqdm(enumerate(train_loader), total=len(train_loader))
+    start_epoch, start_step = 0, 0
+    if args.resume is not None:
+        state = load_state(args.resume)
+        M2SNet.load_state_dict(state['M2SNet'])
+        optimizer_M2S.load_state_dict(state['optimizer'])
+        scaler.load_state_dict(state['scaler'])
+        start_epoch, start_step, total_step = state['epoch'], state['step'], state['total_step']
+        set_rng_state(state['rng'][rank % len(state['rng'])])
+        print('| Resuming from {} at epoch {}, step {}'.format(args.resume, start_epoch, start_step))
+
+    for epoch in range(start_epoch, args.num_epoch):
+        # the batches of an interrupted epoch that were already trained on are skipped
+        first_step = start_step if epoch == start_epoch else 0
+        sampler.set_epoch(epoch, first_step * args.batch_size)
+        pbar = tqdm.tqdm(enumerate(timer.iterate(train_loader), first_step), total=len(train_loader),
+                         disable=rank != 0)
+        num_batches = first_step + len(train_loader)
+        micro_batches = []
         for step, (music, motion) in pbar:
-            if motion.shape[0] != args.batch_size:
+            # easy negatives flip the batch, so a partial batch of odd size leaves out its last sample
+            size = motion.shape[0] - motion.shape[0] % 2
+            if size > 0:
+                micro_batches.append((music[:size], motion[:size]))
+            # one update per accumulation_steps batches, the last (possibly partial) batches of an epoch included
+            if (len(micro_batches) < args.accumulation_steps and step + 1 < num_batches) or len(micro_batches) == 0:
                 continue
+            # the loss is a mean over the effective batch: the loss of a micro-batch is weighted by its share
+            effective_size = sum(len(motion) for _, motion in micro_batches)
 
             optimizer_M2S.zero_grad()
-            if epoch == 0:
-                # easy negatives are used for pre-training in the first epoch
-                # since we find the models under hard or super-hard negatives are difficult to train from scratch.
-                music_1, music_2, motion_1, motion_2 = pairBuilder.build_pairs(music, motion, sampling_strategy='easy')
-            else:
-                music_1, music_2, motion_1, motion_2 = pairBuilder.build_pairs(music, motion,
-                                                                               sampling_strategy=args.sampling_mode)
-
-            pred_11 = M2SNet(music_1, motion_1)
-            pred_12 = M2SNet(music_1, motion_2)
-            pred_22 = M2SNet(music_2, motion_2)
-            pred_21 = M2SNet(music_2, motion_1)
-            loss = BCE(pred_11.mean(dim=1), ONE) + BCE(pred_12.mean(dim=1), ZERO) + \
-                   BCE(pred_22.mean(dim=1), ONE) + BCE(pred_21.mean(dim=1), ZERO)
-
-            loss.backward()
-            optimizer_M2S.step()
+            for music, motion in micro_batches:
+                # the pairs are cropped on the host and copied to the device
+                with timer('build_pairs'):
+                    if epoch == 0:
+                        # easy negatives are used for pre-training in the first epoch
+                        # since we find the models under hard or super-hard negatives are difficult to train from
+                        # scratch.
+                        music_1, music_2, motion_1, motion_2 = pairBuilder.build_pairs(music, motion,
+                                                                                       sampling_strategy='easy')
+                    else:
+                        music_1, music_2, motion_1, motion_2 = \
+                            pairBuilder.build_pairs(music, motion, sampling_strategy=args.sampling_mode)
+
+                # each clip is encoded once, the four pairings are scored from the cached embeddings
+                with timer('forward'), autocast(args.amp, device.type):
+                    h_music_1, h_motion_1 = M2SNet.encode(music_1, motion_1)
+                    h_music_2, h_motion_2 = M2SNet.encode(music_2, motion_2)
+                    pred_11 = M2SNet.fuse(h_music_1, h_motion_1)
+                    pred_12 = M2SNet.fuse(h_music_1, h_motion_2)
+                    pred_22 = M2SNet.fuse(h_music_2, h_motion_2)
+                    pred_21 = M2SNet.fuse(h_music_2, h_motion_1)
+                # BCE is not autocast-safe, the loss is computed in float32
+                with timer('loss'):
+                    pred_11, pred_12, pred_22, pred_21 = \
+                        pred_11.float(), pred_12.float(), pred_22.float(), pred_21.float()
+                    one, zero = ONE[:len(motion)], ZERO[:len(motion)]
+                    loss = BCE(pred_11.mean(dim=1), one) + BCE(pred_12.mean(dim=1), zero) + \
+                           BCE(pred_22.mean(dim=1), one) + BCE(pred_21.mean(dim=1), zero)
+
+                with timer('backward'):
+                    scaler.scale(loss * len(motion) / effective_size).backward()
+            micro_batches = []
+            with timer('optimizer_step'):
+                all_reduce_gradients(M2SNet)
+                scaler.step(optimizer_M2S)
+                scaler.update()
 
             ###############################################
             #                    Logging                  #
             ###############################################
 
-            TP = np.sum(pred_11.detach().cpu().numpy() > 0.5)
-            TF = np.sum(pred_12.detach().cpu().numpy() < 0.5)
-            accuracy = (TP + TF) / (args.batch_size * args.clip_length * 2 * 30)
-
-            writer.add_scalars('M2SNet/loss', {'train': loss.item()}, total_step)
-            writer.add_scalars('M2SNet/accuracy', {'train': accuracy.item()}, total_step)
-            writer.add_scalars('M2SNet/prediction_train', {'sync_train': torch.mean(pred_11).item(),
-                                                           'non_sync_train': torch.mean(pred_12).item()}, total_step)
-            pbar.set_description('Epoch: %d | step: %d | total step: %d | loss: %.5f | training accuracy %.5f'
-                                 % (epoch, step, total_step, loss.item(), accuracy))
+            with timer('logging'):
+                # accumulated on the device and written every --log_interval steps, no host sync per step
+                TP = torch.sum(pred_11.detach() > 0.5)
+                TF = torch.sum(pred_12.detach() < 0.5)
+                accuracy = (TP + TF) / (2 * pred_11.numel())
+
+                logger.add('M2SNet/loss', 'train', loss)
+                logger.add('M2SNet/accuracy', 'train', accuracy)
+                logger.add('M2SNet/prediction_train', 'sync_train', torch.mean(pred_11))
+                logger.add('M2SNet/prediction_train', 'non_sync_train', torch.mean(pred_12))
+                logger.step(total_step)
+
+                latest = logger.latest
+                pbar.set_description('Epoch: %d | step: %d | total step: %d | loss: %.5f | training accuracy %.5f'
+                                     % (epoch, step, total_step, latest.get(('M2SNet/loss', 'train'), float('nan')),
+                                        latest.get(('M2SNet/accuracy', 'train'), float('nan'))))
             total_step += 1
+            if args.state_interval > 0 and total_step % args.state_interval == 0:
+                # everything needed to continue after this step, written in the background by rank 0
+                with timer('checkpoint'):
+                    # the BatchNorm statistics of every process are saved, averaged
+                    average_buffers(M2SNet)
+                    rng = all_gather_object(rng_state())
+                    # after the last batch of the epoch, training continues with the first batch of the next one
+                    next_epoch, next_step = (epoch + 1, 0) if step + 1 == num_batches else (epoch, step + 1)
+                    if rank == 0:
+                        evatuator.checkpoints.save({'M2SNet': M2SNet.state_dict(),
+                                                    'optimizer': optimizer_M2S.state_dict(),
+                                                    'scaler': scaler.state_dict(),
+                                                    'epoch': next_epoch, 'step': next_step, 'total_step': total_step,
+                                                    'rng': rng}, 'training_state.pt')
+            timer.step()
+            if profiling and timer.steps == args.profile_warmup + args.profile_steps:
+                break
+        if profiling:
+            if timer.steps == args.profile_warmup + args.profile_steps:
+                break
+            continue
         torch.cuda.empty_cache()
 
         if epoch % args.evaluate_epoch == 0:
-            evatuator.evaluate(M2SNet, writer, epoch, total_step)
+            logger.flush(total_step - 1)
+            logger.join()
+            average_buffers(M2SNet)
+            if rank == 0:
+                evatuator.evaluate(M2SNet, writer, epoch, total_step)
+            barrier()
+    logger.close()
+    if profiling:
+        if rank == 0:
+            timer.print_report()
+        # one trace per process, they can be opened together
+        root, ext = os.path.splitext(args.profile_trace)
+        trace = args.profile_trace if world_size == 1 else '{}_rank{}{}'.format(root, rank, ext)
+        timer.save_trace(trace)
+        print('| Profile trace written to {}'.format(trace))
+    if rank == 0:
+        evatuator.renderer.close()
+        evatuator.checkpoints.close()
+    cleanup()
 
 
 def main(args):
@@ -147,6 +261,39 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', default=10, type=int, help='batch size')
     parser.add_argument('--sample_length', default=30, help='sample length before random sampling (in second)')
     parser.add_argument('--clip_length', default=10, help='sampled pair length (in second)')
+    parser.add_argument('--accumulation_steps', default=1, type=int,
+                        help='gradient accumulation: every update averages the gradients of accumulation_steps '
+                             'batches of batch_size')
+    parser.add_argument('--eval_batch_size', default=16, type=int,
+                        help='evaluation batch size, must be even (easy negatives flip the batch)')
+    parser.add_argument('--keep_checkpoints', default=0, type=int,
+                        help='number of epoch checkpoints kept on disk per model (0: all)')
+    parser.add_argument('--background_plots', action='store_true',
+                        help='render evaluation figures in a background process')
+    parser.add_argument('--log_interval', default=20, type=int,
+                        help='training metrics are averaged on the GPU and written every log_interval steps')
+    parser.add_argument('--checkpoint_blocks', default=[], nargs='*',
+                        help='activation checkpointing: blocks whose activations are recomputed in backward instead '
+                             'of kept, as fnmatch patterns of their names, e.g. "music_encoder.conv*" '
+                             '"motion_encoder.st_gcn.st_gcn_networks.*" (less memory for longer sample_length)')
+    parser.add_argument('--profile_steps', default=0, type=int,
+                        help='profile profile_steps training steps (after profile_warmup steps) with the device '
+                             'synchronized around every stage, print the per-stage breakdown, write a Chrome trace '
+                             'and exit without evaluation. 0 to train normally')
+    parser.add_argument('--profile_warmup', default=5, type=int, help='steps left out of the profile report')
+    parser.add_argument('--profile_trace', default='M2SNet_profile.json',
+                        help='Chrome trace of the profiled steps (chrome://tracing, ui.perfetto.dev)')
+    parser.add_argument('--amp', default='fp32', choices=AMP_MODES,
+                        help='mixed precision: "bf16" autocast, or "fp16" autocast with loss scaling')
+    parser.add_argument('--state_interval', default=500, type=int,
+                        help='save the full training state (model, optimizer, RNG, data position) to '
+                             'checkpoints/M2SNet/<mode>/training_state.pt every state_interval steps, 0 to disable')
+    parser.add_argument('--resume', default=None, help='training state to resume from')
+    parser.add_argument('--device', default='cuda',
+                        help='"cuda" or "cpu". Launched with torchrun, every process trains on its own GPU '
+                             '(cuda:LOCAL_RANK) and batch_size is per process')
+    parser.add_argument('--backend', default=None,
+                        help='torch.distributed backend, by default nccl on CUDA and gloo on CPU')
 
     args = parser.parse_args()
 
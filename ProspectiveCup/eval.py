@@ -1,5 +1,7 @@
-import time
 import os
+import sys
+import importlib.util
+from functools import partial
 import tqdm
 import numpy as np
 
@@ -8,13 +10,36 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 from utils.dataset import ConductorMotionDataset
 from utils.loss import rhythm_density_error, strengh_contour_error
-from PIL import Image
-import matplotlib.pyplot as plt
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_shared(name):
+    """
+    Module utils/<name>.py of the repository root, imported from its file as 'shared_<name>': ProspectiveCup/utils
+    takes the name utils, the shared modules are not copied here. The module is registered in sys.modules, so that
+    its functions pickle by reference (background rendering).
+    """
+    module_name = 'shared_' + name
+    if module_name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_ROOT, 'utils', name + '.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    return sys.modules[module_name]
+
+
+CheckpointWriter = import_shared('checkpoint_utils').CheckpointWriter
+plot_utils = import_shared('plot_utils')
+FigureRenderer, render_motion = plot_utils.FigureRenderer, plot_utils.render_motion
+
+# the full-page layout of the ProspectiveCup baseline, picklable for background rendering
+render_testing_sample = partial(render_motion, figsize=(16, 16), linewidth=1, fontsize=10, fake_color='red')
 
 
 class Evaluator():
     def __init__(self, args):
-        self.batch_size = 1
+        self.batch_size = args.eval_batch_size
         self.sample_length = args.sample_length
         self.save_path = os.path.join(args.logdir, 'checkpoints')
         os.mkdir(self.save_path)
@@ -27,63 +52,61 @@ class Evaluator():
             )
         self.test_loader = DataLoader(
             dataset=self.testing_set, 
-            batch_size=self.batch_size
+            batch_size=self.batch_size,
+            shuffle=False
             )
         self.MSE = nn.MSELoss()
+        self.renderer = FigureRenderer(background=args.background_plots)
+        self.checkpoints = CheckpointWriter(self.save_path, keep=args.keep_checkpoints)
 
     def evaluate(self, G, writer, epoch, save_checkpoints=True):
         print('Start evaluation at epoch {}'.format(epoch))
         G.eval()
 
-        SD_fake_all = []
-        SD_real_all = []
-        MSE_all = []
-        RDE_all = []
-        SCE_all = []
+        # per-sample metrics, summed on the device and synced once after the loop
+        metrics = ['SD_fake', 'SD_real', 'MSE', 'SCE']
+        sums = {metric: torch.zeros([]).cuda() for metric in metrics}
+        RDE_sum = 0
+        num_samples = 0
 
         pbar = tqdm.tqdm(enumerate(self.test_loader), total=len(self.test_loader))
-        for step, (mel, real_motion) in pbar:
-            if real_motion.shape[0] != self.batch_size:
-                continue
-            mel = mel.type(torch.FloatTensor).cuda()
-            real_motion = real_motion.type(torch.FloatTensor).cuda()
-
-            fake_motion = G(mel)
+        with torch.no_grad():
+            for step, (mel, real_motion) in pbar:
+                batch_size = real_motion.shape[0]
+                mel = mel.type(torch.FloatTensor).cuda()
+                real_motion = real_motion.type(torch.FloatTensor).cuda()
 
-            fake_sd = torch.mean(torch.std(fake_motion, dim=1)).item()
-            real_sd = torch.mean(torch.std(real_motion, dim=1)).item()
-            SD_fake_all.append(fake_sd)
-            SD_real_all.append(real_sd)
+                fake_motion = G(mel)
 
-            mse = self.MSE(fake_motion, real_motion)
-            MSE_all.append(mse.item())
+                sums['SD_fake'] += torch.std(fake_motion, dim=1).flatten(start_dim=1).mean(dim=1).sum()
+                sums['SD_real'] += torch.std(real_motion, dim=1).flatten(start_dim=1).mean(dim=1).sum()
+                sums['MSE'] += ((fake_motion - real_motion) ** 2).flatten(start_dim=1).mean(dim=1).sum()
+                RDE_sum += rhythm_density_error(real_motion, fake_motion, per_sample=True).sum()
+                sums['SCE'] += strengh_contour_error(real_motion, fake_motion, per_sample=True).sum()
+                num_samples += batch_size
 
-            RDE = rhythm_density_error(real_motion, fake_motion)
-            RDE_all.append(RDE)
-
-            SCE = strengh_contour_error(real_motion, fake_motion)
-            SCE_all.append(SCE.item())
+        means = dict(zip(metrics, (torch.stack([sums[metric] for metric in metrics]) / num_samples).tolist()))
+        RDE = RDE_sum / num_samples
 
         writer.add_scalars('Evaluation/Standard Deviation',{
-            'generated': np.mean(SD_fake_all),
-            'real': np.mean(SD_real_all)}, epoch)
-        writer.add_scalar('Evaluation/Mean Squared Error (MSE)',  np.mean(MSE_all), epoch)
-        writer.add_scalar('Evaluation/Rhythm Density Error (RDE)', np.mean(RDE_all), epoch)
-        writer.add_scalar('Evaluation/Strengh Contour Error (SCE)', np.mean(SCE_all), epoch)
+            'generated': means['SD_fake'],
+            'real': means['SD_real']}, epoch)
+        writer.add_scalar('Evaluation/Mean Squared Error (MSE)', means['MSE'], epoch)
+        writer.add_scalar('Evaluation/Rhythm Density Error (RDE)', RDE, epoch)
+        writer.add_scalar('Evaluation/Strengh Contour Error (SCE)', means['SCE'], epoch)
 
         print(
-            f'MSE: {np.mean(MSE_all):.4f} | '
-            f'RDE: {np.mean(RDE_all):.4f} | '
-            f'SCE: {np.mean(SCE_all):.4f} | '
-            f'SDP: {np.mean(SD_fake_all)/np.mean(SD_real_all)*100:.2f}%'
+            f'MSE: {means["MSE"]:.4f} | '
+            f'RDE: {RDE:.4f} | '
+            f'SCE: {means["SCE"]:.4f} | '
+            f'SDP: {means["SD_fake"] / means["SD_real"] * 100:.2f}%'
               )
 
-        fig_motion = self.plot_motion(fake_motion, real_motion)
-        writer.add_image("testing sample", fig_motion, epoch, dataformats='HWC')
+        self.renderer.submit(lambda image: writer.add_image("testing sample", image, epoch, dataformats='HWC'),
+                             render_testing_sample, fake_motion[0].detach().cpu().numpy(), real_motion[0].cpu().numpy())
 
         if save_checkpoints:
-            torch.save(G.state_dict(), '{}/checkpoint_{}epoch.pt'.format(self.save_path, epoch))
-            torch.save(G.state_dict(), '{}/checkpoint_latest.pt'.format(self.save_path))
+            self.checkpoints.save(G.state_dict(), 'checkpoint_{}epoch.pt'.format(epoch), last='checkpoint_latest.pt')
 
         G.train()
         return
@@ -93,30 +116,4 @@ class Evaluator():
             fake_motion = fake_motion.cpu().detach().numpy()
         if type(motion) != np.ndarray:
             motion = motion.cpu().detach().numpy()
-        kept_names = ['nose', 'left eye', 'right eye', 'left ear', 'right ear', 'left shoulder', 'right shoulder',
-                      'left elbow', 'right elbow', 'left wrist', 'right wrist', 'left hip', 'right hip']
-        coordinate = ['x axis', 'y axis']
-
-        plt.figure(figsize=(16, 16))
-
-        for kept in range(13):
-            for xy in range(2):
-                plt.subplot(13, 2, kept * 2 + xy + 1)
-                plt.plot(motion[0, :, kept, xy], linewidth=1,
-                         label=kept_names[kept] + ' - ' + coordinate[xy] + '- real', color='gray')
-                plt.plot(fake_motion[0, :, kept, xy], linewidth=1,
-                         label=kept_names[kept] + ' - ' + coordinate[xy] + '- fake', color='red')
-                plt.legend(loc='upper right', fontsize=10)
-                plt.ylim(0, 1)
-                plt.xticks([])
-                plt.yticks([])
-        plt.subplots_adjust(wspace=0, hspace=0, left=0.05, right=0.95, top=0.95, bottom=0.05)
-
-        image_path = 'testing sample.png'
-        plt.savefig(image_path)
-        image_PIL = Image.open(image_path)
-        img = np.array(image_PIL)
-        plt.close()
-        time.sleep(0.5)
-        return img
-
+        return render_testing_sample(fake_motion[0], motion[0])
@@ -55,6 +55,8 @@ def train(args):
 
         if epoch % args.evaluate_epoch == 0 or epoch == args.epoch_num:
             evaluator.evaluate(G, writer, epoch)
+    evaluator.renderer.close()
+    evaluator.checkpoints.close()
 
 
 def main(args):
@@ -82,6 +84,11 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', default=1, type=int, help='batch size')
     parser.add_argument('--sample_length', default=30, type=int, help='in seconds')
     parser.add_argument('--lr', default=1e-3, type=float, help='learning rate')
+    parser.add_argument('--eval_batch_size', default=16, type=int, help='batch size of the evaluation')
+    parser.add_argument('--keep_checkpoints', default=0, type=int,
+                        help='number of epoch checkpoints kept on disk per model (0: all)')
+    parser.add_argument('--background_plots', action='store_true',
+                        help='render evaluation figures in a background process')
 
     args = parser.parse_args()
 
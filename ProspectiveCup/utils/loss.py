@@ -6,7 +6,10 @@ from scipy import signal
 MSE = nn.MSELoss()
 
 
-def strengh_contour_error(real_motion, fake_motion):
+def strengh_contour_error(real_motion, fake_motion, per_sample=False):
+    """
+    per_sample: return the error of every sample, (N,), instead of the error of the whole batch
+    """
     real_v = torch.zeros_like(real_motion)
     fake_v = torch.zeros_like(fake_motion)
     real_v[:, 1:, :, :] = real_motion[:, :-1, :, :] - real_motion[:, 1:, :, :]
@@ -22,12 +25,17 @@ def strengh_contour_error(real_motion, fake_motion):
     real_v_pool = pool(real_v.unsqueeze(0)).squeeze(0)
     fake_v_pool = pool(fake_v.unsqueeze(0)).squeeze(0)
 
+    if per_sample:
+        return torch.log(((fake_v_pool - real_v_pool) ** 2).mean(dim=1) * 1e7 + 1)
     strengh_contour_error = MSE(fake_v_pool, real_v_pool)
 
     return torch.log(strengh_contour_error * 1e7 + 1)
 
 
-def rhythm_density_error(real_motion_batch, fake_motion_batch):
+def rhythm_density_error(real_motion_batch, fake_motion_batch, per_sample=False):
+    """
+    per_sample: return the error of every sample, (N,), instead of the error of the whole batch
+    """
     N, T, J, C = real_motion_batch.size()
     real_motion_batch = real_motion_batch.detach().cpu().numpy()
     fake_motion_batch = fake_motion_batch.detach().cpu().numpy()
@@ -63,4 +71,6 @@ def rhythm_density_error(real_motion_batch, fake_motion_batch):
         RDE = ((PSD_real[threshold:bins] - PSD_fake[threshold:bins]) ** 2).mean()
         RDE_batch[n] = RDE
 
+    if per_sample:
+        return np.log(RDE_batch * 1e7 + 1)
     return np.log(RDE_batch.mean() * 1e7 + 1)
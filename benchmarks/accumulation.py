@@ -0,0 +1,96 @@
+"""
+Throughput and peak memory of one M2SGAN update (generator forward, CRITIC_ITERS critic updates, generator update)
+against the effective batch size, computed in one batch or accumulated over micro-batches as in
+M2SGAN_train.py --accumulation_steps. Peak memory is only reported on CUDA. Run from the repository root:
+
+    python -m benchmarks.accumulation --device cuda --batch_sizes 20 40 80 --micro_batch_sizes 10 20 --seconds 30
+"""
+import argparse
+import torch
+
+from models.Generator import Generator
+from models.Discriminator import Discriminator_1DCNN
+from utils.loss import calc_gradient_penalty_ST
+from benchmarks.common import get_device, synthetic_mel, synthetic_motion, time_it, print_table
+
+
+def accumulated_step(G, D, optimizer_G, optimizer_D, micro_batches, critic_iters):
+    effective_size = sum(len(real) for _, real, _ in micro_batches)
+    if len(micro_batches) == 1:
+        mel, real, noise = micro_batches[0]
+        fake = G(mel, noise)
+        critic_fakes = [fake.detach()]
+    else:
+        with torch.no_grad():
+            critic_fakes = [G(mel, noise) for mel, _, noise in micro_batches]
+
+    for _ in range(critic_iters):
+        optimizer_D.zero_grad()
+        for (_, real, _), critic_fake in zip(micro_batches, critic_fakes):
+            fraction = len(real) / effective_size
+            loss_D = fraction * (-torch.mean(D(real)) + torch.mean(D(critic_fake))) + \
+                10 * calc_gradient_penalty_ST(D, real, critic_fake, term=['real_fake'], batch_fraction=fraction)
+            loss_D.backward()
+        optimizer_D.step()
+
+    optimizer_G.zero_grad()
+    for mel, real, noise in micro_batches:
+        if len(micro_batches) > 1:
+            fake = G(mel, noise)
+        loss_G = -torch.mean(D(fake)) * len(real) / effective_size
+        loss_G.backward()
+    optimizer_G.step()
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+    G = Generator().to(device)
+    D = Discriminator_1DCNN().to(device)
+    optimizer_G = torch.optim.RMSprop(G.parameters(), lr=0.0005)
+    optimizer_D = torch.optim.RMSprop(D.parameters(), lr=0.0005)
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        for micro_batch_size in sorted(set(args.micro_batch_sizes + [batch_size]), reverse=True):
+            if micro_batch_size > batch_size or batch_size % micro_batch_size != 0:
+                continue
+            micro_batches = [(synthetic_mel(micro_batch_size, args.seconds, device),
+                              synthetic_motion(micro_batch_size, args.seconds, device),
+                              torch.randn([micro_batch_size, args.seconds, 8], device=device))
+                             for _ in range(batch_size // micro_batch_size)]
+            row = {'batch_size': batch_size, 'micro_batch': micro_batch_size,
+                   'accumulation_steps': len(micro_batches)}
+            try:
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+                    torch.cuda.reset_peak_memory_stats(device)
+                timing = time_it(lambda: accumulated_step(G, D, optimizer_G, optimizer_D, micro_batches,
+                                                          args.critic_iters),
+                                 device, warmup=args.warmup, repeat=args.repeat)
+                row['step_ms'] = timing['mean_ms']
+                row['samples/s'] = batch_size / timing['mean_ms'] * 1000
+                row['peak_MiB'] = '%.1f' % (torch.cuda.max_memory_allocated(device) / 2 ** 20) \
+                    if device.type == 'cuda' else 'n/a'
+            except torch.cuda.OutOfMemoryError:
+                row.update({'step_ms': 'OOM', 'samples/s': 'OOM', 'peak_MiB': 'OOM'})
+            rows.append(row)
+            del micro_batches
+
+    print(f'{args.seconds} s clips, {args.critic_iters} critic iterations, device: {device}')
+    print_table(rows, ['batch_size', 'micro_batch', 'accumulation_steps', 'step_ms', 'samples/s', 'peak_MiB'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='M2SGAN gradient accumulation benchmark')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch_sizes', default=[20, 40, 80], type=int, nargs='+', help='effective batch sizes')
+    parser.add_argument('--micro_batch_sizes', default=[5, 10, 20], type=int, nargs='+')
+    parser.add_argument('--seconds', default=30, type=int)
+    parser.add_argument('--critic_iters', default=5, type=int)
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,130 @@
+"""
+Throughput and numerical parity of the mixed precision modes (utils.amp_utils) on synthetic data:
+an M2SNet training step, a WGAN-GP critic step, a generator step and Generator inference.
+Parity is measured against fp32 from the same weights and inputs. Run from the repository root:
+
+    python -m benchmarks.amp --device cuda --batch_size 10 --seconds 30
+"""
+import argparse
+import copy
+import torch
+import torch.nn as nn
+
+from models.Generator import Generator
+from models.Discriminator import Discriminator_1DCNN
+from models.M2SNet import M2SNet
+from utils.amp_utils import autocast, grad_scaler
+from utils.loss import calc_gradient_penalty_ST
+from benchmarks.common import get_device, synthetic_mel, synthetic_motion, time_it, print_table
+
+
+def m2snet_step(model, optimizer, scaler, mel, motion, amp, device_type):
+    """ Positive / negative pairs from a shifted batch, as a stand-in for PairBuilder """
+    BCE = nn.BCELoss()
+    optimizer.zero_grad()
+    with autocast(amp, device_type):
+        h_music, h_motion = model.encode(mel, motion)
+        pred_sync = model.fuse(h_music, h_motion).float()
+        pred_non_sync = model.fuse(h_music, h_motion.roll(1, dims=0)).float()
+    loss = BCE(pred_sync, torch.ones_like(pred_sync)) + BCE(pred_non_sync, torch.zeros_like(pred_non_sync))
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    return loss
+
+
+def critic_step(G, D, optimizer, scaler, mel, noise, real, amp, device_type):
+    optimizer.zero_grad()
+    with autocast(amp, device_type):
+        with torch.no_grad():
+            fake = G(mel, noise).float()
+        gradient_penalty = calc_gradient_penalty_ST(D, real, fake, term=['real_fake'], scaler=scaler)
+        loss = -torch.mean(D(real)) + torch.mean(D(fake)) + 10 * gradient_penalty
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    return gradient_penalty
+
+
+def generator_step(G, D, optimizer, scaler, mel, noise, amp, device_type):
+    optimizer.zero_grad()
+    with autocast(amp, device_type):
+        loss = -torch.mean(D(G(mel, noise).float()))
+    scaler.scale(loss).backward()
+    scaler.step(optimizer)
+    scaler.update()
+    return loss
+
+
+def main(args):
+    device = get_device(args.device)
+    device_type = device.type
+    torch.manual_seed(args.seed)
+    modes = ['fp32', 'bf16'] + (['fp16'] if device_type == 'cuda' else [])
+
+    G = Generator().to(device)
+    D = Discriminator_1DCNN().to(device)
+    m2snet = M2SNet().to(device)
+    mel = synthetic_mel(args.batch_size, args.seconds, device)
+    motion = synthetic_motion(args.batch_size, args.seconds, device)
+    noise = torch.randn([args.batch_size, args.seconds, 8], device=device)
+
+    # parity references: eval-mode outputs and a gradient penalty in fp32
+    G.eval()
+    m2snet.eval()
+    with torch.no_grad():
+        G_reference = G(mel, noise)
+        m2snet_reference = m2snet(mel, motion)
+        fake = G_reference.clone()
+    torch.manual_seed(args.seed)
+    gp_reference = calc_gradient_penalty_ST(D, motion, fake, term=['real_fake']).item()
+
+    rows = []
+    for amp in modes:
+        with torch.no_grad(), autocast(amp, device_type):
+            G_error = (G(mel, noise).float() - G_reference).abs().max().item()
+            m2snet_error = (m2snet(mel, motion).float() - m2snet_reference).abs().max().item()
+            inference = time_it(lambda: G(mel, noise), device, warmup=args.warmup, repeat=args.repeat)
+        torch.manual_seed(args.seed)
+        with autocast(amp, device_type):
+            gp = calc_gradient_penalty_ST(D, motion, fake, term=['real_fake'], scaler=grad_scaler(amp, device_type))
+        gp_error = abs(gp.item() - gp_reference)
+
+        # training steps update copies, so every mode starts from the same weights
+        G_train, D_train, m2snet_train = copy.deepcopy(G).train(), copy.deepcopy(D), copy.deepcopy(m2snet).train()
+        optimizer_G = torch.optim.RMSprop(G_train.parameters(), lr=0.0005)
+        optimizer_D = torch.optim.RMSprop(D_train.parameters(), lr=0.0005)
+        optimizer_M2S = torch.optim.Adam(m2snet_train.parameters(), lr=0.001)
+        scaler_G, scaler_D, scaler_M2S = [grad_scaler(amp, device_type) for _ in range(3)]
+        m2snet_time = time_it(lambda: m2snet_step(m2snet_train, optimizer_M2S, scaler_M2S, mel, motion, amp,
+                                                  device_type), device, warmup=args.warmup, repeat=args.repeat)
+        critic_time = time_it(lambda: critic_step(G_train, D_train, optimizer_D, scaler_D, mel, noise, motion, amp,
+                                                  device_type), device, warmup=args.warmup, repeat=args.repeat)
+        generator_time = time_it(lambda: generator_step(G_train, D_train, optimizer_G, scaler_G, mel, noise, amp,
+                                                        device_type), device, warmup=args.warmup, repeat=args.repeat)
+
+        audio_seconds = args.batch_size * args.seconds
+        rows.append({'amp': amp,
+                     'M2SNet_train_audio_s/s': audio_seconds / m2snet_time['mean_ms'] * 1000,
+                     'critic_step_ms': critic_time['mean_ms'],
+                     'generator_step_ms': generator_time['mean_ms'],
+                     'G_inference_audio_s/s': audio_seconds / inference['mean_ms'] * 1000,
+                     'G_max_abs_error': '%.2e' % G_error,
+                     'M2SNet_max_abs_error': '%.2e' % m2snet_error,
+                     'GP_abs_error': '%.2e' % gp_error})
+
+    print(f'batch size {args.batch_size}, {args.seconds} s clips, device: {device}')
+    print_table(rows, list(rows[0].keys()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mixed precision benchmark')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch_size', default=10, type=int)
+    parser.add_argument('--seconds', default=10, type=int)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
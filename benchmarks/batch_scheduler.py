@@ -0,0 +1,106 @@
+"""
+Synthetic load benchmark for utils.batch_scheduler.BatchScheduler.
+
+Requests arrive as a Poisson process with clip lengths drawn uniformly from [min_seconds, max_seconds].
+Every (max_batch_size, max_latency) combination is replayed on the same arrival trace, batch size 1 being
+the unbatched baseline. Run from the repository root:
+
+    python -m benchmarks.batch_scheduler --device cpu --rate 4 --num_requests 100
+"""
+import argparse
+import time
+import numpy as np
+import torch
+
+from models.Generator import Generator
+from utils.batch_scheduler import BatchScheduler
+from benchmarks.common import get_device, print_table, MUSIC_FPS, N_MELS
+
+
+def run_load(G, mels, arrivals, args, device, max_batch_size, max_latency):
+    scheduler = BatchScheduler(G,
+                               buckets=args.buckets,
+                               max_batch_size=max_batch_size,
+                               max_batch_seconds=args.max_batch_seconds,
+                               max_latency=max_latency,
+                               device=device)
+    latencies = np.zeros(len(mels))
+    submitted = 0
+    num_finished = 0
+
+    start = time.perf_counter()
+    while num_finished < len(mels):
+        now = time.perf_counter() - start
+        while submitted < len(mels) and arrivals[submitted] <= now:
+            scheduler.submit(mels[submitted])
+            submitted += 1
+
+        finished = scheduler.flush() if submitted == len(mels) else scheduler.step()
+        for request in finished:
+            latencies[request.request_id] = request.finish_time - start - arrivals[request.request_id]
+        num_finished += len(finished)
+        if not finished:
+            time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+
+    audio_seconds = sum(mel.shape[0] for mel in mels) / MUSIC_FPS
+    return {'max_batch_size': max_batch_size,
+            'max_latency_s': max_latency,
+            'requests/s': len(mels) / elapsed,
+            'audio_s/s': audio_seconds / elapsed,
+            'avg_batch': scheduler.num_segments / scheduler.num_batches,
+            'p50_latency_s': float(np.percentile(latencies, 50)),
+            'p95_latency_s': float(np.percentile(latencies, 95))}
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+    G = Generator().to(device)
+    if args.model is not None:
+        G.load_state_dict(torch.load(args.model, map_location=device))
+
+    rng = np.random.RandomState(args.seed)
+    arrivals = np.cumsum(rng.exponential(1 / args.rate, args.num_requests))
+    lengths = rng.randint(args.min_seconds, args.max_seconds + 1, args.num_requests)
+    mels = [torch.rand([length * MUSIC_FPS, N_MELS]) for length in lengths]
+
+    # warm up kernels / cudnn autotuning for every bucket shape
+    warmup = BatchScheduler(G, buckets=args.buckets, max_batch_size=1, device=device)
+    for bucket in args.buckets:
+        warmup.submit(torch.rand([bucket * MUSIC_FPS, N_MELS]))
+    warmup.flush()
+
+    rows = []
+    for max_batch_size in args.batch_sizes:
+        for max_latency in args.latencies:
+            if max_batch_size == 1 and max_latency != args.latencies[0]:
+                continue
+            rows.append(run_load(G, mels, arrivals, args, device, max_batch_size, max_latency))
+            print_table(rows[-1:], list(rows[-1].keys()))
+
+    print()
+    print(f'{args.num_requests} requests, {args.rate} requests/s, {args.min_seconds}-{args.max_seconds} s clips, '
+          f'device: {device}')
+    print_table(rows, list(rows[0].keys()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generator request batching benchmark')
+    parser.add_argument('--model', default=None, help='optional Generator checkpoint')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--seed', default=0, type=int)
+
+    parser.add_argument('--num_requests', default=100, type=int)
+    parser.add_argument('--rate', default=4., type=float, help='mean arrival rate (requests per second)')
+    parser.add_argument('--min_seconds', default=5, type=int)
+    parser.add_argument('--max_seconds', default=90, type=int)
+
+    parser.add_argument('--buckets', default=[10, 20, 30, 60], type=int, nargs='+', help='in: seconds')
+    parser.add_argument('--max_batch_seconds', default=960, type=int, help='memory budget: bucket length x batch size')
+    parser.add_argument('--batch_sizes', default=[1, 4, 8, 16], type=int, nargs='+')
+    parser.add_argument('--latencies', default=[0., 0.05, 0.2], type=float, nargs='+', help='in: seconds')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,71 @@
+"""
+Activation checkpointing (models.activation_checkpoint) of the MusicEncoder conv1-3 blocks and the ST-GCN layers:
+memory saved and compute overhead of an M2SNet forward and backward pass in training mode, against clip length.
+Memory is measured as in benchmarks.memory (saved_MiB on any device, peak_MiB on CUDA); saved_MiB leaves out the block
+inputs that checkpointing keeps, peak_MiB includes them. Gradients are compared with the run without checkpointing.
+Run from the repository root:
+
+    python -m benchmarks.checkpointing --device cuda --batch_size 10 --seconds 10 30 60
+"""
+import argparse
+import torch
+
+from models.M2SNet import M2SNet
+from models.activation_checkpoint import set_checkpointing
+from benchmarks.common import get_device, synthetic_mel, synthetic_motion, time_it, print_table
+from benchmarks.memory import measure
+
+CONFIGS = [('none', []),
+           ('music_encoder', ['music_encoder.conv*']),
+           ('st_gcn', ['motion_encoder.st_gcn.st_gcn_networks.*']),
+           ('all', ['*'])]
+
+
+def gradients(model, inputs):
+    model.zero_grad(set_to_none=True)
+    model(*inputs).float().mean().backward()
+    return [p.grad.clone() for p in model.parameters() if p.grad is not None]
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+    model = M2SNet().to(device).train()
+
+    rows = []
+    for seconds in args.seconds:
+        inputs = (synthetic_mel(args.batch_size, seconds, device), synthetic_motion(args.batch_size, seconds, device))
+        baseline = None
+        for name, patterns in CONFIGS:
+            set_checkpointing(patterns, model)
+            memory, _ = measure(model, inputs, 'train', device)
+            # in training mode BatchNorm normalizes with batch statistics, the gradients are comparable across runs
+            grads = gradients(model, inputs)
+            timing = time_it(lambda: gradients(model, inputs), device, warmup=args.warmup, repeat=args.repeat)
+            row = {'seconds': seconds, 'checkpointed': name, 'saved_MiB': memory['saved_MiB'],
+                   'peak_MiB': memory['peak_MiB'] if memory['peak_MiB'] is not None else 'n/a',
+                   'forward_backward_ms': timing['mean_ms']}
+            if baseline is None:
+                baseline = row, grads
+            row['memory_saved'] = '%.1f%%' % (100 * (1 - row['saved_MiB'] / baseline[0]['saved_MiB']))
+            row['overhead'] = '%.1f%%' % (100 * (row['forward_backward_ms'] / baseline[0]['forward_backward_ms'] - 1))
+            row['max_grad_error'] = '%.2e' % max((a - b).abs().max().item() for a, b in zip(grads, baseline[1]))
+            rows.append(row)
+    set_checkpointing([], model)
+
+    print(f'M2SNet forward and backward, batch size {args.batch_size}, device: {device}')
+    print_table(rows, ['seconds', 'checkpointed', 'saved_MiB', 'peak_MiB', 'memory_saved', 'forward_backward_ms',
+                       'overhead', 'max_grad_error'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Activation checkpointing benchmark')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch_size', default=10, type=int)
+    parser.add_argument('--seconds', default=[10, 30], type=int, nargs='+')
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,61 @@
+import time
+import numpy as np
+import torch
+
+MUSIC_FPS = 90
+MOTION_FPS = 30
+N_MELS = 128
+
+
+def get_device(device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def synthetic_mel(batch_size, seconds, device='cpu'):
+    """ Mel spectrogram shaped like ConductorMotion100: (N, 90 * seconds, 128) in [0, 1] """
+    return torch.rand([batch_size, seconds * MUSIC_FPS, N_MELS], device=device)
+
+
+def synthetic_motion(batch_size, seconds, device='cpu'):
+    """ Motion shaped like ConductorMotion100: (N, 30 * seconds, 13, 2) in [0, 1] """
+    return torch.rand([batch_size, seconds * MOTION_FPS, 13, 2], device=device)
+
+
+def time_it(fn, device='cpu', warmup=3, repeat=10):
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return {'mean_ms': float(times.mean()),
+            'std_ms': float(times.std()),
+            'min_ms': float(times.min()),
+            'p50_ms': float(np.percentile(times, 50)),
+            'p95_ms': float(np.percentile(times, 95))}
+
+
+def print_table(rows, columns):
+    widths = [max(len(column), *[len(_format(row[column])) for row in rows]) for column in columns]
+    print(' | '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    print('-+-'.join('-' * width for width in widths))
+    for row in rows:
+        print(' | '.join(_format(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def _format(value):
+    if isinstance(value, float):
+        return '%.3f' % value
+    return str(value)
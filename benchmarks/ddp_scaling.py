@@ -0,0 +1,161 @@
+"""
+Data-parallel scaling of the M2SNet and M2SGAN training steps: steps/s and samples/s against the number of
+processes, with the per-process batch size fixed (weak scaling). Every process runs the same step as the trainers,
+gradients are averaged with utils.dist_utils.all_reduce_gradients, or for M2SNet with --sync ddp by the
+DistributedDataParallel wrapper (bucketed, overlapped with backward) for comparison. On CPU the processes use the gloo
+backend and share the cores (--threads per process). Run from the repository root:
+
+    python -m benchmarks.ddp_scaling --device cpu --processes 1 2 4 --threads 2 --model m2snet --sync all_reduce ddp
+"""
+import os
+import argparse
+import time
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+import models.M2SNet
+from models.Generator import Generator
+from models.Discriminator import Discriminator_1DCNN
+from utils.dist_utils import init_distributed, is_distributed, all_reduce_gradients, barrier, cleanup
+from utils.loss import calc_gradient_penalty_ST
+from benchmarks.common import synthetic_mel, synthetic_motion, synchronize, print_table
+
+
+class M2SNetPairs(nn.Module):
+    """ The four pairings scored by an M2SNet_train.py step, in one forward() for DistributedDataParallel """
+
+    def __init__(self, M2SNet):
+        super(M2SNetPairs, self).__init__()
+        self.M2SNet = M2SNet
+
+    def forward(self, music, motion):
+        h_music_1, h_motion_1 = self.M2SNet.encode(music, motion)
+        h_music_2, h_motion_2 = self.M2SNet.encode(music.flip(dims=[0]), motion.flip(dims=[0]))
+        return self.M2SNet.fuse(h_music_1, h_motion_1), self.M2SNet.fuse(h_music_1, h_motion_2), \
+            self.M2SNet.fuse(h_music_2, h_motion_2), self.M2SNet.fuse(h_music_2, h_motion_1)
+
+
+def m2snet_step(args, device):
+    M2SNet = models.M2SNet.M2SNet().to(device)
+    optimizer = torch.optim.Adam(M2SNet.parameters(), lr=0.001)
+    pairs = M2SNetPairs(M2SNet)
+    if args.sync == 'ddp' and is_distributed():
+        pairs = DistributedDataParallel(pairs, device_ids=[device.index] if device.type == 'cuda' else None)
+    BCE = nn.BCELoss()
+    music = synthetic_mel(args.batch_size, args.seconds, device)
+    motion = synthetic_motion(args.batch_size, args.seconds, device)
+    ONE = torch.ones([args.batch_size, 1], device=device)
+    ZERO = torch.zeros([args.batch_size, 1], device=device)
+
+    def step():
+        optimizer.zero_grad()
+        out_11, out_12, out_22, out_21 = pairs(music, motion)
+        loss = BCE(out_11.mean(dim=1), ONE) + BCE(out_12.mean(dim=1), ZERO) + \
+            BCE(out_22.mean(dim=1), ONE) + BCE(out_21.mean(dim=1), ZERO)
+        loss.backward()
+        if args.sync == 'all_reduce':
+            all_reduce_gradients(M2SNet)
+        optimizer.step()
+
+    return step
+
+
+def m2sgan_step(args, device):
+    G = Generator().to(device)
+    D = Discriminator_1DCNN().to(device)
+    optimizer_G = torch.optim.RMSprop(G.parameters(), lr=0.0005)
+    optimizer_D = torch.optim.RMSprop(D.parameters(), lr=0.0005)
+    mel = synthetic_mel(args.batch_size, args.seconds, device)
+    real = synthetic_motion(args.batch_size, args.seconds, device)
+    noise = torch.randn([args.batch_size, args.seconds, 8], device=device)
+
+    def step():
+        fake = G(mel, noise)
+        for _ in range(args.critic_iters):
+            optimizer_D.zero_grad()
+            loss_D = -torch.mean(D(real)) + torch.mean(D(fake.detach())) + \
+                10 * calc_gradient_penalty_ST(D, real, fake.detach(), term=['real_fake'])
+            loss_D.backward()
+            all_reduce_gradients(D)
+            optimizer_D.step()
+        optimizer_G.zero_grad()
+        loss_G = -torch.mean(D(fake))
+        loss_G.backward()
+        all_reduce_gradients(G)
+        optimizer_G.step()
+
+    return step
+
+
+def worker(rank, world_size, args, results):
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(world_size), LOCAL_RANK=str(rank))
+    torch.set_num_threads(args.threads)
+    _, _, device = init_distributed(args.device, args.backend)
+    torch.manual_seed(rank)
+    step = {'m2snet': m2snet_step, 'm2sgan': m2sgan_step}[args.model](args, device)
+
+    for _ in range(args.warmup):
+        step()
+    synchronize(device)
+    barrier()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        step()
+    synchronize(device)
+    barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        results.put(elapsed)
+    cleanup()
+
+
+def main(args):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    context = mp.get_context('spawn')
+
+    if args.model == 'm2sgan' and 'ddp' in args.sync:
+        # the generator step runs D, and the gradient penalty differentiates D twice: M2SGAN_train.py has no DDP setup
+        raise RuntimeError('--sync ddp is only available for --model m2snet')
+
+    rows = []
+    for sync in args.sync:
+        group = []
+        for processes in args.processes:
+            # a fresh port for every process group
+            os.environ['MASTER_PORT'] = str(args.port + len(rows) + len(group))
+            results = context.SimpleQueue()
+            mp.spawn(worker, args=(processes, argparse.Namespace(**{**vars(args), 'sync': sync}), results),
+                     nprocs=processes, join=True)
+            elapsed = results.get()
+            group.append({'sync': sync, 'processes': processes, 'steps/s': args.repeat / elapsed,
+                          'samples/s': args.repeat * args.batch_size * processes / elapsed})
+        for row in group:
+            row['efficiency'] = row['samples/s'] / (group[0]['samples/s'] * row['processes'] / group[0]['processes'])
+        rows += group
+
+    print(f'{args.model}, batch size {args.batch_size} per process, {args.seconds} s clips, device: {args.device}, '
+          f'{args.threads} threads per process')
+    print_table(rows, ['sync', 'processes', 'steps/s', 'samples/s', 'efficiency'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel scaling benchmark')
+    parser.add_argument('--device', default='cpu', help='"cpu" (gloo) or "cuda" (one GPU per process)')
+    parser.add_argument('--backend', default=None)
+    parser.add_argument('--model', default='m2snet', choices=['m2snet', 'm2sgan'])
+    parser.add_argument('--sync', default=['all_reduce'], nargs='+', choices=['all_reduce', 'ddp'],
+                        help='gradient averaging: utils.dist_utils.all_reduce_gradients (as the trainers) or the '
+                             'DistributedDataParallel wrapper')
+    parser.add_argument('--processes', default=[1, 2, 4], type=int, nargs='+')
+    parser.add_argument('--threads', default=1, type=int, help='torch threads per process')
+    parser.add_argument('--batch_size', default=4, type=int, help='per process')
+    parser.add_argument('--seconds', default=10, type=int)
+    parser.add_argument('--critic_iters', default=5, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--port', default=29511, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,97 @@
+"""
+M2SGAN evaluation on synthetic clips: the previous loop (batch size 1, autograd on, one .item() per metric and
+sample) vs batched no_grad evaluation with on-device sums, as in M2SGAN_Evaluator. Both report the per-sample
+means. Run from the repository root:
+
+    python -m benchmarks.evaluation --device cuda --num_samples 64 --batch_size 16 --seconds 30
+"""
+import argparse
+import time
+import numpy as np
+import torch
+
+from models.Generator import Generator
+from models.Discriminator import Discriminator_1DCNN
+from models.MotionEncoder import MotionEncoder_STGCN
+from utils.loss import SyncLoss, rhythm_density_error, strengh_contour_error
+from benchmarks.common import get_device, synthetic_mel, synthetic_motion, synchronize, print_table
+
+METRICS = ['SD_fake', 'W_dis', 'MSE', 'MPE', 'SCE', 'RDE']
+
+
+def per_sample_evaluation(G, D, sync_loss, mel, real, noise, rde):
+    values = {metric: [] for metric in METRICS}
+    for i in range(len(mel)):
+        fake = G(mel[i:i + 1], noise[i:i + 1])
+        values['SD_fake'].append(torch.mean(torch.std(fake, dim=1)).item())
+        values['W_dis'].append((D(real[i:i + 1]) - D(fake.detach())).detach().cpu().numpy().mean())
+        values['MSE'].append(torch.nn.functional.mse_loss(fake, real[i:i + 1]).item())
+        values['MPE'].append(sync_loss(fake, real[i:i + 1]).item())
+        values['SCE'].append(strengh_contour_error(real[i:i + 1], fake).item())
+        if rde:
+            values['RDE'].append(rhythm_density_error(real[i:i + 1], fake))
+    return {metric: float(np.mean(value)) if value else float('nan') for metric, value in values.items()}
+
+
+def batched_evaluation(G, D, sync_loss, mel, real, noise, rde, batch_size):
+    sums = {metric: torch.zeros([], device=mel.device) for metric in METRICS[:-1]}
+    RDE_sum = 0
+    with torch.no_grad():
+        for start in range(0, len(mel), batch_size):
+            m, r, n = mel[start:start + batch_size], real[start:start + batch_size], noise[start:start + batch_size]
+            fake = G(m, n)
+            sums['SD_fake'] += torch.std(fake, dim=1).flatten(start_dim=1).mean(dim=1).sum()
+            sums['W_dis'] += (D(r) - D(fake)).sum()
+            sums['MSE'] += ((fake - r) ** 2).flatten(start_dim=1).mean(dim=1).sum()
+            sums['MPE'] += sync_loss(fake, r) * len(m)
+            sums['SCE'] += strengh_contour_error(r, fake, per_sample=True).sum()
+            if rde:
+                RDE_sum += rhythm_density_error(r, fake, per_sample=True).sum()
+    means = dict(zip(sums.keys(), (torch.stack(list(sums.values())) / len(mel)).tolist()))
+    means['RDE'] = RDE_sum / len(mel) if rde else float('nan')
+    return means
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+    G = Generator().to(device).eval()
+    D = Discriminator_1DCNN().to(device).eval()
+    sync_loss = SyncLoss(MotionEncoder_STGCN().to(device))
+    mel = synthetic_mel(args.num_samples, args.seconds, device)
+    real = synthetic_motion(args.num_samples, args.seconds, device)
+    noise = torch.randn([args.num_samples, args.seconds, 8], device=device)
+
+    rows = []
+    results = {}
+    for name, evaluate in [('per_sample', lambda: per_sample_evaluation(G, D, sync_loss, mel, real, noise, args.rde)),
+                           ('batched', lambda: batched_evaluation(G, D, sync_loss, mel, real, noise, args.rde,
+                                                                  args.batch_size))]:
+        evaluate()
+        synchronize(device)
+        start = time.perf_counter()
+        results[name] = evaluate()
+        synchronize(device)
+        elapsed = time.perf_counter() - start
+        rows.append({'evaluation': name, 'seconds': elapsed, 'samples/s': args.num_samples / elapsed})
+    for row in rows:
+        row['speedup'] = rows[0]['seconds'] / row['seconds']
+
+    print(f'{args.num_samples} samples of {args.seconds} s, batch size {args.batch_size}, device: {device}')
+    print_table(rows, ['evaluation', 'seconds', 'samples/s', 'speedup'])
+    print_table([{'metric': metric, 'per_sample': results['per_sample'][metric], 'batched': results['batched'][metric]}
+                 for metric in METRICS], ['metric', 'per_sample', 'batched'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='M2SGAN evaluation benchmark')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--num_samples', default=64, type=int)
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--seconds', default=30, type=int)
+    parser.add_argument('--rde', default=True, type=lambda x: x.lower() == 'true',
+                        help='include the (CPU) Rhythm Density Error')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,84 @@
+"""
+Parity and CPU latency of eager vs exported (TorchScript, ONNX Runtime) models. Run from the repository root:
+
+    python -m benchmarks.export --batch_size 1 --seconds 30
+"""
+import argparse
+import os
+import tempfile
+import torch
+
+from models.Generator import Generator
+from models.M2SNet import M2SNet
+from utils.export_utils import example_inputs, export_torchscript, export_onnx, load_torchscript, \
+    ONNXRuntimeModel, max_abs_error
+from benchmarks.common import time_it, print_table
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    G = Generator()
+    m2snet = M2SNet()
+    if args.generator is not None:
+        G.load_state_dict(torch.load(args.generator, map_location='cpu'))
+    if args.M2SNet is not None:
+        m2snet.load_state_dict(torch.load(args.M2SNet, map_location='cpu'))
+    models = {'Generator': G,
+              'M2SNet': m2snet,
+              'MusicEncoder': m2snet.music_encoder,
+              'MotionEncoder_STGCN': m2snet.motion_encoder}
+
+    rows = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for name, model in models.items():
+            model.eval()
+            # trace with a different shape than the benchmarked one to exercise the dynamic axes
+            trace_inputs = example_inputs(model, batch_size=1, seconds=10)
+            inputs = example_inputs(model, batch_size=args.batch_size, seconds=args.seconds)
+
+            runtimes = {'eager': model}
+            ts_path = os.path.join(out_dir, name + '.ts.pt')
+            export_torchscript(model, trace_inputs, ts_path)
+            runtimes['torchscript'] = load_torchscript(ts_path)
+
+            onnx_path = os.path.join(out_dir, name + '.onnx')
+            export_onnx(model, trace_inputs, onnx_path)
+            try:
+                runtimes['onnxruntime'] = ONNXRuntimeModel(onnx_path, num_threads=args.num_threads)
+            except RuntimeError as e:
+                print(e)
+
+            for runtime, fn in runtimes.items():
+                error = 0. if runtime == 'eager' else max_abs_error(model, fn, inputs)
+                if error > args.tolerance:
+                    raise RuntimeError(f'{name} ({runtime}) does not match the eager model: max abs error {error}')
+
+                with torch.no_grad():
+                    timing = time_it(lambda: fn(*inputs), 'cpu', warmup=args.warmup, repeat=args.repeat)
+                if runtime == 'eager':
+                    eager_ms = timing['mean_ms']
+                rows.append({'model': name, 'runtime': runtime, 'max_abs_error': '%.2e' % error,
+                             'mean_ms': timing['mean_ms'], 'p95_ms': timing['p95_ms'],
+                             'speedup': eager_ms / timing['mean_ms']})
+
+    print(f'batch size {args.batch_size}, {args.seconds} s clips, {torch.get_num_threads()} threads')
+    print_table(rows, ['model', 'runtime', 'max_abs_error', 'mean_ms', 'p95_ms', 'speedup'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exported model parity and latency benchmark')
+    parser.add_argument('--generator', default=None, help='optional Generator checkpoint')
+    parser.add_argument('--M2SNet', default=None, help='optional M2SNet checkpoint')
+    parser.add_argument('--batch_size', default=1, type=int)
+    parser.add_argument('--seconds', default=30, type=int)
+    parser.add_argument('--num_threads', default=None, type=int)
+    parser.add_argument('--tolerance', default=1e-3, type=float, help='max abs error accepted for parity')
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--repeat', default=10, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,78 @@
+"""
+Hook-based single-pass feature extraction (FeatureExtractor.features) vs the previous implementations:
+MotionEncoder_STGCN ran the ST-GCN twice (forward + extract_feature), MusicEncoder repeated its forward code.
+Run from the repository root:
+
+    python -m benchmarks.features --device cuda --batch_size 20 --seconds 30
+"""
+import argparse
+import torch
+
+from models.MusicEncoder import MusicEncoder
+from models.MotionEncoder import MotionEncoder_STGCN
+from benchmarks.common import get_device, synthetic_mel, synthetic_motion, time_it, print_table
+
+
+def previous_motion_features(encoder, motion):
+    """ MotionEncoder_STGCN.features before the hook-based API, for reference """
+    input = motion.transpose(1, 2).transpose(1, 3).unsqueeze(4)
+    output = encoder.st_gcn(input)
+    output = torch.flatten(output.transpose(1, 2), start_dim=2)
+    output = encoder.fc(output.transpose(1, 2)).transpose(1, 2)
+    features = encoder.st_gcn.extract_feature(input)
+    features.append(output.transpose(1, 2))
+    return features
+
+
+def previous_music_features(encoder, x):
+    """ MusicEncoder.features before the hook-based API, for reference """
+    h1 = encoder.conv1(x.unsqueeze(1))
+    h2 = encoder.conv2(h1)
+    h3 = encoder.conv3(h2)
+    h3 = h3.transpose(1, 2).flatten(start_dim=2).transpose(1, 2)
+    h4 = encoder.conv4(h3)
+    h1 = h1.transpose(1, 2).flatten(start_dim=2).transpose(1, 2)
+    h2 = h2.transpose(1, 2).flatten(start_dim=2).transpose(1, 2)
+    return [x.transpose(1, 2), h1, h2, h3, h4]
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+    music_encoder = MusicEncoder().to(device).eval()
+    motion_encoder = MotionEncoder_STGCN().to(device).eval()
+    mel = synthetic_mel(args.batch_size, args.seconds, device)
+    motion = synthetic_motion(args.batch_size, args.seconds, device)
+
+    cases = [('MotionEncoder_STGCN', 'all layers', lambda: previous_motion_features(motion_encoder, motion),
+              lambda: motion_encoder.features(motion)),
+             ('MotionEncoder_STGCN', 'last layer (SyncLoss)', lambda: previous_motion_features(motion_encoder, motion)[-1:],
+              lambda: motion_encoder.features(motion, layers=[-1])),
+             ('MusicEncoder', 'all layers', lambda: previous_music_features(music_encoder, mel),
+              lambda: music_encoder.features(mel))]
+
+    rows = []
+    for model, layers, previous, hooked in cases:
+        with torch.no_grad():
+            error = max((a - b).abs().max().item() for a, b in zip(previous(), hooked()))
+            previous_time = time_it(previous, device, warmup=args.warmup, repeat=args.repeat)
+            hooked_time = time_it(hooked, device, warmup=args.warmup, repeat=args.repeat)
+        rows.append({'model': model, 'layers': layers, 'previous_ms': previous_time['mean_ms'],
+                     'hooked_ms': hooked_time['mean_ms'], 'speedup': previous_time['mean_ms'] / hooked_time['mean_ms'],
+                     'max_abs_error': '%.2e' % error})
+
+    print(f'batch size {args.batch_size}, {args.seconds} s clips, device: {device}')
+    print_table(rows, ['model', 'layers', 'previous_ms', 'hooked_ms', 'speedup', 'max_abs_error'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Single-pass feature extraction benchmark')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--seconds', default=30, type=int)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,59 @@
+"""
+Numerical equivalence and per-forward speedup of utils.fold_utils.fold_for_inference. Run from the repository root:
+
+    python -m benchmarks.folding --device cuda --batch_size 10 --seconds 30
+"""
+import argparse
+import torch
+
+from models.Generator import Generator
+from models.M2SNet import M2SNet
+from utils.export_utils import example_inputs
+from utils.fold_utils import fold_for_inference, verify_equivalence
+from benchmarks.common import get_device, time_it, print_table
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+
+    G = Generator()
+    m2snet = M2SNet()
+    if args.generator is not None:
+        G.load_state_dict(torch.load(args.generator, map_location='cpu'))
+    if args.M2SNet is not None:
+        m2snet.load_state_dict(torch.load(args.M2SNet, map_location='cpu'))
+    models = {'Generator': G.to(device), 'M2SNet': m2snet.to(device)}
+
+    rows = []
+    for name, model in models.items():
+        model.eval()
+        folded = fold_for_inference(model)
+        inputs = tuple(x.to(device) for x in example_inputs(model, args.batch_size, args.seconds))
+        error = verify_equivalence(model, folded, inputs, atol=args.tolerance)
+
+        with torch.no_grad():
+            eager = time_it(lambda: model(*inputs), device, warmup=args.warmup, repeat=args.repeat)
+            fused = time_it(lambda: folded(*inputs), device, warmup=args.warmup, repeat=args.repeat)
+        rows.append({'model': name, 'folded_bn': folded.num_folded_bn, 'max_abs_error': '%.2e' % error,
+                     'eager_ms': eager['mean_ms'], 'folded_ms': fused['mean_ms'],
+                     'speedup': eager['mean_ms'] / fused['mean_ms']})
+
+    print(f'batch size {args.batch_size}, {args.seconds} s clips, device: {device}')
+    print_table(rows, ['model', 'folded_bn', 'max_abs_error', 'eager_ms', 'folded_ms', 'speedup'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BatchNorm / weight_norm folding benchmark')
+    parser.add_argument('--generator', default=None, help='optional Generator checkpoint')
+    parser.add_argument('--M2SNet', default=None, help='optional M2SNet checkpoint')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch_size', default=10, type=int)
+    parser.add_argument('--seconds', default=10, type=int)
+    parser.add_argument('--tolerance', default=1e-4, type=float)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
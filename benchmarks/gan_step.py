@@ -0,0 +1,85 @@
+"""
+Peak memory and time of one M2SGAN training step (generator forward, CRITIC_ITERS critic updates, generator update)
+with the generator graph kept alive through the critic updates vs generation under no_grad into a replay buffer
+(M2SGAN_train.py --critic_replay_size). Peak memory is only reported on CUDA. Run from the repository root:
+
+    python -m benchmarks.gan_step --device cuda --batch_sizes 10 20 40 --seconds 30
+"""
+import argparse
+import torch
+
+from models.Generator import Generator
+from models.Discriminator import Discriminator_1DCNN
+from utils.loss import calc_gradient_penalty_ST
+from utils.train_utils import FakeReplayBuffer
+from benchmarks.common import get_device, synthetic_mel, synthetic_motion, time_it, print_table
+
+
+def gan_step(G, D, optimizer_G, optimizer_D, mel, noise, real, critic_iters, replay_buffer=None):
+    if replay_buffer is not None:
+        with torch.no_grad():
+            replay_buffer.push(G(mel, noise))
+    else:
+        fake = G(mel, noise)
+
+    for _ in range(critic_iters):
+        optimizer_D.zero_grad()
+        critic_fake = replay_buffer.sample(len(real)) if replay_buffer is not None else fake.detach()
+        loss_D = -torch.mean(D(real)) + torch.mean(D(critic_fake)) + \
+                 10 * calc_gradient_penalty_ST(D, real, critic_fake, term=['real_fake'])
+        loss_D.backward()
+        optimizer_D.step()
+
+    optimizer_G.zero_grad()
+    if replay_buffer is not None:
+        fake = G(mel, noise)
+    loss_G = -torch.mean(D(fake))
+    loss_G.backward()
+    optimizer_G.step()
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+    G = Generator().to(device)
+    D = Discriminator_1DCNN().to(device)
+    optimizer_G = torch.optim.RMSprop(G.parameters(), lr=0.0005)
+    optimizer_D = torch.optim.RMSprop(D.parameters(), lr=0.0005)
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        mel = synthetic_mel(batch_size, args.seconds, device)
+        real = synthetic_motion(batch_size, args.seconds, device)
+        noise = torch.randn([batch_size, args.seconds, 8], device=device)
+        for name, replay_size in [('retain_graph', 0), ('no_grad + replay', batch_size * args.replay_batches)]:
+            replay_buffer = FakeReplayBuffer(replay_size) if replay_size > 0 else None
+            step = lambda: gan_step(G, D, optimizer_G, optimizer_D, mel, noise, real, args.critic_iters, replay_buffer)
+            try:
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+                    torch.cuda.reset_peak_memory_stats(device)
+                timing = time_it(step, device, warmup=args.warmup, repeat=args.repeat)
+                peak = '%.1f' % (torch.cuda.max_memory_allocated(device) / 2 ** 20) if device.type == 'cuda' else 'n/a'
+                rows.append({'batch_size': batch_size, 'critic_input': name, 'step_ms': timing['mean_ms'],
+                             'peak_MiB': peak})
+            except torch.cuda.OutOfMemoryError:
+                rows.append({'batch_size': batch_size, 'critic_input': name, 'step_ms': 'OOM', 'peak_MiB': 'OOM'})
+            del replay_buffer
+
+    print(f'{args.seconds} s clips, {args.critic_iters} critic iterations, device: {device}')
+    print_table(rows, ['batch_size', 'critic_input', 'step_ms', 'peak_MiB'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='M2SGAN training step memory benchmark')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch_sizes', default=[10, 20, 40], type=int, nargs='+')
+    parser.add_argument('--seconds', default=30, type=int)
+    parser.add_argument('--critic_iters', default=5, type=int)
+    parser.add_argument('--replay_batches', default=4, type=int, help='replay buffer size, in batches')
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
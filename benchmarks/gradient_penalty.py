@@ -0,0 +1,97 @@
+"""
+Per-critic-step cost of the fused gradient penalty (one D forward / double backward for all enabled terms) vs the
+previous one-pass-per-term implementation. Run from the repository root:
+
+    python -m benchmarks.gradient_penalty --device cuda --batch_size 20 --seconds 30
+"""
+import argparse
+import torch
+import torch.autograd as autograd
+
+from models.Discriminator import Discriminator_1DCNN
+from utils.loss import calc_gradient_penalty_ST
+from benchmarks.common import get_device, synthetic_motion, time_it, print_table
+
+ALL_TERMS = ['real', 'fake', 'real_fake', 'real_motion', 'fake_motion']
+
+
+def separate_gradient_penalty(D, real_data, fake_data, term):
+    """
+    calc_gradient_penalty_ST as implemented before fusing: one D forward and double backward per term and new
+    grad_outputs every time. Alphas are drawn in the same order as the fused version, so both agree for a seed.
+    """
+    real_structure = real_data.mean(dim=1).unsqueeze(1)
+    fake_structure = fake_data.mean(dim=1).unsqueeze(1)
+    inputs = []
+    if 'real' in term:
+        inputs.append(('real', real_data))
+    if 'fake' in term:
+        inputs.append(('fake', fake_data))
+    if 'real_motion' in term:
+        alpha = torch.rand(1, device=real_data.device)
+        inputs.append(('real_motion', alpha * (real_data - real_structure) + alpha * fake_structure +
+                       (1 - alpha) * real_structure))
+    if 'fake_motion' in term:
+        alpha = torch.rand(1, device=real_data.device)
+        inputs.append(('fake_motion', alpha * (fake_data - fake_structure) + alpha * fake_structure +
+                       (1 - alpha) * real_structure))
+    if 'real_fake' in term:
+        alpha = torch.rand([real_data.size(0), 1, 1, 1], device=real_data.device)
+        inputs.append(('real_fake', alpha * real_data + ((1 - alpha) * fake_data)))
+
+    loss = 0
+    for name, input in inputs:
+        input = input.detach().requires_grad_(True)
+        output = D(input)
+        gradients = autograd.grad(outputs=output, inputs=input,
+                                  grad_outputs=torch.ones(output.size(), device=input.device),
+                                  create_graph=True, retain_graph=True, only_inputs=True)[0]
+        norm = gradients.norm() if name == 'real_fake' else gradients.norm(2, dim=1)
+        loss += (norm ** 2).mean()
+    return loss
+
+
+def critic_step(D, optimizer, real, fake, penalty, term):
+    optimizer.zero_grad()
+    loss = -torch.mean(D(real)) + torch.mean(D(fake)) + 10 * penalty(D, real, fake, term)
+    loss.backward()
+    optimizer.step()
+
+
+def main(args):
+    device = get_device(args.device)
+    D = Discriminator_1DCNN().to(device)
+    optimizer = torch.optim.RMSprop(D.parameters(), lr=0.0005)
+    real = synthetic_motion(args.batch_size, args.seconds, device)
+    fake = synthetic_motion(args.batch_size, args.seconds, device)
+
+    rows = []
+    for terms in [['real_fake'], ALL_TERMS]:
+        torch.manual_seed(args.seed)
+        expected = separate_gradient_penalty(D, real, fake, terms).item()
+        torch.manual_seed(args.seed)
+        actual = calc_gradient_penalty_ST(D, real, fake, term=terms).item()
+
+        separate = time_it(lambda: critic_step(D, optimizer, real, fake, separate_gradient_penalty, terms), device,
+                           warmup=args.warmup, repeat=args.repeat)
+        fused = time_it(lambda: critic_step(D, optimizer, real, fake, calc_gradient_penalty_ST, terms), device,
+                        warmup=args.warmup, repeat=args.repeat)
+        rows.append({'terms': '+'.join(terms), 'separate_ms': separate['mean_ms'], 'fused_ms': fused['mean_ms'],
+                     'speedup': separate['mean_ms'] / fused['mean_ms'],
+                     'relative_error': '%.2e' % (abs(expected - actual) / max(abs(expected), 1e-12))})
+
+    print(f'critic step, batch size {args.batch_size}, {args.seconds} s clips, device: {device}')
+    print_table(rows, ['terms', 'separate_ms', 'fused_ms', 'speedup', 'relative_error'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Gradient penalty benchmark')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch_size', default=20, type=int)
+    parser.add_argument('--seconds', default=30, type=int)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
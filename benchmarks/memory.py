@@ -0,0 +1,191 @@
+"""
+Memory of the models against clip length and batch size, for inference (eval mode, no_grad, as in test_unseen.py)
+and training (forward and backward). For every configuration it records
+    peak_MiB:   peak allocated memory above the parameters and inputs (CUDA only),
+    saved_MiB:  activations kept for backward (training, any device), measured with saved-tensor hooks,
+    layer_MiB:  largest output of a single layer (a lower bound of the inference peak, any device),
+prints the largest per-layer activations of one configuration and recommends, for a memory budget, the longest clip
+(in whole seconds: the Generator noise is upsampled 30x to the 30 fps motion) that fits, from a linear fit of memory
+against clip length. On CPU the recommendation uses saved_MiB (training) and layer_MiB (inference). Run from the
+repository root:
+
+    python -m benchmarks.memory --device cuda --models Generator MusicEncoder --seconds 10 30 60 --budget_mib 4096
+"""
+import argparse
+import numpy as np
+import torch
+
+from models.MusicEncoder import MusicEncoder
+from models.MotionEncoder import MotionEncoder_STGCN
+from models.M2SNet import M2SNet
+from models.Generator import Generator
+from models.Discriminator import Discriminator_1DCNN
+from benchmarks.common import get_device, synthetic_mel, synthetic_motion, print_table
+
+MODELS = {'MusicEncoder': (MusicEncoder, lambda n, s, device: (synthetic_mel(n, s, device),)),
+          'MotionEncoder_STGCN': (MotionEncoder_STGCN, lambda n, s, device: (synthetic_motion(n, s, device),)),
+          'M2SNet': (M2SNet, lambda n, s, device: (synthetic_mel(n, s, device), synthetic_motion(n, s, device))),
+          'Generator': (Generator, lambda n, s, device: (synthetic_mel(n, s, device),
+                                                         torch.randn([n, s, 8], device=device))),
+          'Discriminator_1DCNN': (Discriminator_1DCNN, lambda n, s, device: (synthetic_motion(n, s, device),))}
+MiB = 2 ** 20
+
+
+def _nbytes(value):
+    if torch.is_tensor(value):
+        return value.numel() * value.element_size()
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(item) for item in value)
+    return 0
+
+
+class LayerActivations:
+    """ Output size of every leaf module of model, by module name (summed over the calls of the module) """
+
+    def __init__(self, model):
+        self.sizes = {}
+        self.handles = [module.register_forward_hook(self._hook(name)) for name, module in model.named_modules()
+                        if len(list(module.children())) == 0]
+
+    def _hook(self, name):
+        def hook(module, input, output):
+            self.sizes[name] = self.sizes.get(name, 0) + _nbytes(output)
+        return hook
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+def saved_tensor_bytes(fn, parameters):
+    """ Bytes of the tensors autograd saves for backward while running fn, parameters and duplicates left out """
+    exclude = {p.data_ptr() for p in parameters}
+    storages = {}
+
+    def pack(tensor):
+        ptr = tensor.untyped_storage().data_ptr()
+        if ptr not in exclude:
+            storages[ptr] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = fn()
+    return output, sum(storages.values())
+
+
+def measure(model, inputs, mode, device):
+    model.zero_grad(set_to_none=True)
+    model.train(mode == 'train')
+    layers = LayerActivations(model)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+    saved = None
+    try:
+        if mode == 'train':
+            output, saved = saved_tensor_bytes(lambda: model(*inputs), model.parameters())
+            output.float().mean().backward()
+        else:
+            with torch.no_grad():
+                model(*inputs)
+    finally:
+        layers.remove()
+    result = {'peak_MiB': (torch.cuda.max_memory_allocated(device) - base) / MiB if device.type == 'cuda' else None,
+              'saved_MiB': saved / MiB if saved is not None else None,
+              'layer_MiB': max(layers.sizes.values()) / MiB}
+    model.zero_grad(set_to_none=True)
+    return result, layers.sizes
+
+
+def recommend(rows, budget_mib, metric):
+    """ Longest clip (whole seconds) whose memory, linear in the clip length, fits in budget_mib """
+    recommendations = []
+    groups = {}
+    for row in rows:
+        if isinstance(row.get(metric), float):
+            groups.setdefault((row['model'], row['mode'], row['batch_size']), []).append(row)
+    for (model, mode, batch_size), group in groups.items():
+        seconds = np.array([row['seconds'] for row in group], dtype=np.float64)
+        memory = np.array([row[metric] for row in group])
+        if len(set(seconds)) < 2:
+            continue
+        slope, intercept = np.polyfit(seconds, memory, 1)
+        max_seconds = int((budget_mib - intercept) // slope) if slope > 0 else None
+        recommendations.append({'model': model, 'mode': mode, 'batch_size': batch_size,
+                                'MiB_per_second': float(slope), 'fixed_MiB': float(intercept),
+                                'max_seconds': max(max_seconds, 0) if max_seconds is not None else 'unbounded',
+                                '60s_chunk': 'fits' if slope * 60 + intercept <= budget_mib else 'too large'})
+    return recommendations
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+
+    rows, layer_rows = [], []
+    for name in args.models:
+        model_class, make_inputs = MODELS[name]
+        model = model_class().to(device)
+        parameters_mib = sum(p.numel() * p.element_size() for p in model.parameters()) / MiB
+        for mode in args.modes:
+            for batch_size in args.batch_sizes:
+                for seconds in args.seconds:
+                    row = {'model': name, 'mode': mode, 'batch_size': batch_size, 'seconds': seconds,
+                           'params_MiB': parameters_mib}
+                    try:
+                        inputs = make_inputs(batch_size, seconds, device)
+                        result, sizes = measure(model, inputs, mode, device)
+                        row.update({key: value if value is not None else 'n/a' for key, value in result.items()})
+                        del inputs
+                    except (torch.cuda.OutOfMemoryError, RuntimeError) as error:
+                        # CPU allocation failures are RuntimeErrors
+                        if not isinstance(error, torch.cuda.OutOfMemoryError) and 'memory' not in str(error):
+                            raise
+                        row.update({'peak_MiB': 'OOM', 'saved_MiB': 'OOM', 'layer_MiB': 'OOM'})
+                        sizes = None
+                    rows.append(row)
+                    if sizes is not None and mode == args.modes[-1] and batch_size == args.batch_sizes[0] \
+                            and seconds == max(args.seconds):
+                        top = sorted(sizes.items(), key=lambda item: -item[1])[:args.layers]
+                        layer_rows += [{'model': name, 'layer': layer, 'output_MiB': size / MiB}
+                                       for layer, size in top]
+        del model
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    print(f'device: {device}')
+    print_table(rows, ['model', 'mode', 'batch_size', 'seconds', 'params_MiB', 'peak_MiB', 'saved_MiB',
+                       'layer_MiB'])
+    if len(layer_rows) > 0:
+        print()
+        print(f'largest layer outputs ({args.modes[-1]}, batch size {args.batch_sizes[0]}, {max(args.seconds)} s)')
+        print_table(layer_rows, ['model', 'layer', 'output_MiB'])
+
+    if args.budget_mib is not None:
+        recommendations = []
+        for mode in args.modes:
+            metric = 'peak_MiB' if device.type == 'cuda' else 'saved_MiB' if mode == 'train' else 'layer_MiB'
+            recommendations += recommend([row for row in rows if row['mode'] == mode], args.budget_mib, metric)
+        print()
+        print(f'longest clip within {args.budget_mib} MiB (test_unseen.py generates 60 s chunks)')
+        print_table(recommendations, ['model', 'mode', 'batch_size', 'MiB_per_second', 'fixed_MiB', 'max_seconds',
+                                      '60s_chunk'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory against clip length and batch size')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--models', default=list(MODELS), nargs='+', choices=list(MODELS))
+    parser.add_argument('--modes', default=['inference', 'train'], nargs='+', choices=['inference', 'train'])
+    parser.add_argument('--batch_sizes', default=[1, 10], type=int, nargs='+')
+    parser.add_argument('--seconds', default=[10, 30, 60], type=int, nargs='+', help='clip lengths')
+    parser.add_argument('--layers', default=8, type=int, help='number of per-layer activations printed per model')
+    parser.add_argument('--budget_mib', default=None, type=float,
+                        help='recommend the longest clip that fits in this much memory '
+                             '(MiB, above the parameters and inputs)')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
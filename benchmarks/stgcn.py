@@ -0,0 +1,75 @@
+"""
+ST-GCN graph convolution: matmul implementation vs the previous per-layer A * importance + einsum + contiguous,
+at the shapes M2SNet actually uses. Run from the repository root:
+
+    python -m benchmarks.stgcn --device cuda
+"""
+import argparse
+import torch
+
+from models.MotionEncoder import MotionEncoder_STGCN
+from benchmarks.common import get_device, synthetic_motion, time_it, print_table
+
+# (name, batch size, clip length in seconds)
+SHAPES = [('M2SNet_train', 10, 10),
+          # M2SNet_evaluator.score_pairs: motion_1 and motion_2 of 3 difficulties per --eval_batch_size 16 batch
+          ('M2SNet_eval', 6 * 16, 10),
+          ('SyncLoss', 20, 30)]
+
+
+def einsum_forward(st_gcn, x):
+    """ ST_GCN.forward as implemented before the matmul graph convolution, for reference """
+    N, C, T, V, M = x.size()
+    x = x.permute(0, 4, 3, 1, 2).contiguous()
+    x = x.view(N * M, V * C, T)
+    x = st_gcn.data_bn(x)
+    x = x.view(N, M, V, C, T)
+    x = x.permute(0, 1, 3, 4, 2).contiguous()
+    x = x.view(N * M, C, T, V)
+
+    for gcn, importance in zip(st_gcn.st_gcn_networks, st_gcn.edge_importance):
+        A = st_gcn.A * importance
+        res = gcn.residual(x) if gcn.residual is not None else 0
+        y = gcn.gcn.conv(x)
+        n, kc, t, v = y.size()
+        y = y.view(n, gcn.gcn.kernel_size, kc // gcn.gcn.kernel_size, t, v)
+        y = torch.einsum('nkctv,kvw->nctw', (y, A)).contiguous()
+        x = gcn.relu(gcn.tcn(y) + res)
+    return x
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+    st_gcn = MotionEncoder_STGCN().st_gcn.to(device)
+    st_gcn.train(not args.eval)
+
+    rows = []
+    for name, batch_size, seconds in SHAPES:
+        # (N, T, 13, 2) -> (N, 2, T, 13, 1), as in MotionEncoder_STGCN.forward
+        x = synthetic_motion(batch_size, seconds, device).permute(0, 3, 1, 2).unsqueeze(4).contiguous()
+
+        with torch.no_grad():
+            error = (einsum_forward(st_gcn, x) - st_gcn(x)).abs().max().item()
+        for impl, fn in [('einsum', lambda: einsum_forward(st_gcn, x)), ('matmul', lambda: st_gcn(x))]:
+            with torch.no_grad():
+                forward = time_it(fn, device, warmup=args.warmup, repeat=args.repeat)
+            backward = time_it(lambda: fn().sum().backward(), device, warmup=args.warmup, repeat=args.repeat)
+            rows.append({'shape': f'{name} ({batch_size}x{seconds * 30})', 'impl': impl,
+                         'forward_ms': forward['mean_ms'], 'forward_backward_ms': backward['mean_ms'],
+                         'max_abs_error': '%.2e' % error})
+
+    print(f'device: {device}, {"eval" if args.eval else "train"} mode')
+    print_table(rows, ['shape', 'impl', 'forward_ms', 'forward_backward_ms', 'max_abs_error'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ST-GCN graph convolution benchmark')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--eval', default=True, type=lambda x: x.lower() == 'true', help='benchmark in eval mode')
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    main(args)
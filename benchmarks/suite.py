@@ -0,0 +1,194 @@
+"""
+Benchmark suite of the models, losses and data pipeline on synthetic data shaped like ConductorMotion100 (mel: 90 fps
+x 128, motion: 30 fps x 13 x 2), runnable on CPU. Results are written as JSON, together with the commit and the
+environment, so that runs can be compared across commits (--compare). Run from the repository root:
+
+    python -m benchmarks.suite --device cpu --output suite.json
+    python -m benchmarks.suite --device cpu --compare suite.json --only models
+
+Groups whose optional dependencies are missing (audio: librosa, video: cv2) are reported as skipped.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import numpy as np
+import torch
+
+from models.MusicEncoder import MusicEncoder
+from models.MotionEncoder import MotionEncoder_STGCN
+from models.M2SNet import M2SNet
+from models.Generator import Generator
+from models.Discriminator import Discriminator_1DCNN
+from utils.loss import rhythm_density_error, strengh_contour_error, calc_gradient_penalty_ST
+from utils.train_utils import PairBuilder
+from benchmarks.common import get_device, synthetic_mel, synthetic_motion, time_it, print_table, MUSIC_FPS, \
+    MOTION_FPS, N_MELS
+
+
+def model_cases(args, device):
+    mel = synthetic_mel(args.batch_size, args.seconds, device)
+    motion = synthetic_motion(args.batch_size, args.seconds, device)
+    noise = torch.randn([args.batch_size, args.seconds, 8], device=device)
+    models = [('MusicEncoder', MusicEncoder(), (mel,)),
+              ('MotionEncoder_STGCN', MotionEncoder_STGCN(), (motion,)),
+              ('M2SNet', M2SNet(), (mel, motion)),
+              ('Generator', Generator(), (mel, noise)),
+              ('Discriminator_1DCNN', Discriminator_1DCNN(), (motion,))]
+    for name, model, inputs in models:
+        model = model.to(device)
+
+        def forward(model=model, inputs=inputs):
+            with torch.no_grad():
+                model(*inputs)
+
+        def forward_backward(model=model, inputs=inputs):
+            model.zero_grad(set_to_none=True)
+            model(*inputs).float().mean().backward()
+
+        yield 'models/{}/forward'.format(name), forward, 1
+        yield 'models/{}/forward_backward'.format(name), forward_backward, 1
+
+
+def loss_cases(args, device):
+    real = synthetic_motion(args.batch_size, args.seconds, device)
+    fake = synthetic_motion(args.batch_size, args.seconds, device)
+    D = Discriminator_1DCNN().to(device)
+
+    def gradient_penalty():
+        D.zero_grad(set_to_none=True)
+        calc_gradient_penalty_ST(D, real, fake, term=['real_fake']).backward()
+
+    yield 'losses/rhythm_density_error', lambda: rhythm_density_error(real, fake), 1
+    yield 'losses/strengh_contour_error', lambda: strengh_contour_error(real, fake), 1
+    yield 'losses/calc_gradient_penalty_ST', gradient_penalty, 1
+
+
+def data_cases(args, device, workdir):
+    music = synthetic_mel(args.batch_size, args.seconds)
+    motion = synthetic_motion(args.batch_size, args.seconds)
+    pair_builder = PairBuilder(argparse.Namespace(sample_length=args.seconds, clip_length=args.clip_length), device)
+    for strategy in ['easy', 'hard', 'super_hard']:
+        yield 'data/build_pairs/{}'.format(strategy), \
+            lambda strategy=strategy: pair_builder.build_pairs(music, motion, strategy), 1
+
+    # a ConductorMotion100-like split on disk: dataset_size one-minute performances
+    from utils.dataset import ConductorMotionDataset
+    for i in range(args.dataset_size):
+        sample_dir = os.path.join(workdir, 'dataset', 'train', 'performance_{}'.format(i))
+        os.makedirs(sample_dir, exist_ok=True)
+        np.save(os.path.join(sample_dir, 'mel.npy'), np.random.rand(60 * MUSIC_FPS, N_MELS).astype(np.float32))
+        np.save(os.path.join(sample_dir, 'motion.npy'), np.random.rand(60 * MOTION_FPS, 13, 2).astype(np.float32))
+    dataset = ConductorMotionDataset(sample_length=args.seconds, split='train',
+                                     root_dir=os.path.join(workdir, 'dataset'))
+    yield 'data/ConductorMotionDataset.__getitem__', lambda: [dataset[i] for i in range(len(dataset))], len(dataset)
+
+
+def audio_cases(args, workdir):
+    from utils.music_utils import extract_mel_feature
+    import scipy.io.wavfile
+    sample_rate = 22050
+    audio_file = os.path.join(workdir, 'audio.wav')
+    t = np.arange(args.seconds * sample_rate) / sample_rate
+    audio = 0.5 * np.sin(2 * np.pi * 440 * t) + 0.1 * np.random.randn(len(t))
+    scipy.io.wavfile.write(audio_file, sample_rate, audio.astype(np.float32))
+    yield 'audio/extract_mel_feature', lambda: extract_mel_feature(audio_file), 1
+
+
+def video_cases(args, workdir):
+    from utils.motion_utils import vis_motion
+    vis = np.random.rand(args.vis_seconds * MOTION_FPS, 13, 2) * 0.5 + 0.25
+    # vis_motion scales the motion in place
+    yield 'video/vis_motion', lambda: vis_motion([vis.copy()], save_path=workdir + os.sep, name='vis'), 1
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    rows = []
+    for name, result in results.items():
+        before = baseline['results'].get(name, {}).get('mean_ms')
+        if before is None or 'mean_ms' not in result:
+            continue
+        ratio = result['mean_ms'] / before
+        rows.append({'case': name, 'baseline_ms': before, 'current_ms': result['mean_ms'], 'ratio': ratio,
+                     'status': 'REGRESSION' if ratio > 1 + threshold else
+                     'improved' if ratio < 1 - threshold else ''})
+    print('compared with {} (commit {})'.format(baseline_path, baseline['meta'].get('commit')))
+    print_table(rows, ['case', 'baseline_ms', 'current_ms', 'ratio', 'status'])
+    return any(row['status'] == 'REGRESSION' for row in rows)
+
+
+def main(args):
+    device = get_device(args.device)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        groups = {'models': lambda: model_cases(args, device),
+                  'losses': lambda: loss_cases(args, device),
+                  'data': lambda: data_cases(args, device, workdir),
+                  'audio': lambda: audio_cases(args, workdir),
+                  'video': lambda: video_cases(args, workdir)}
+        for group, cases in groups.items():
+            if args.only is not None and group not in args.only:
+                continue
+            try:
+                for name, fn, calls in cases():
+                    timing = time_it(fn, device, warmup=args.warmup, repeat=args.repeat)
+                    results[name] = dict(timing, calls=calls, per_call_ms=timing['mean_ms'] / calls)
+            except ImportError as error:
+                results['{}/skipped'.format(group)] = {'skipped': str(error)}
+
+    rows = [{'case': name, 'mean_ms': result.get('mean_ms', 'skipped'), 'p95_ms': result.get('p95_ms', ''),
+             'per_call_ms': result.get('per_call_ms', result.get('skipped'))} for name, result in results.items()]
+    print(f'batch size {args.batch_size}, {args.seconds} s samples, device: {device}, '
+          f'{torch.get_num_threads()} threads')
+    print_table(rows, ['case', 'mean_ms', 'p95_ms', 'per_call_ms'])
+
+    if args.output is not None:
+        meta = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'device': str(device),
+                'torch': torch.__version__, 'python': platform.python_version(), 'platform': platform.platform(),
+                'threads': torch.get_num_threads(), 'args': vars(args)}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        print('results written to {}'.format(args.output))
+
+    if args.compare is not None and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark suite of models, losses and data pipeline')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--batch_size', default=4, type=int)
+    parser.add_argument('--seconds', default=30, type=int, help='sample length')
+    parser.add_argument('--clip_length', default=10, type=int, help='PairBuilder clip length')
+    parser.add_argument('--dataset_size', default=4, type=int, help='number of synthetic one-minute performances')
+    parser.add_argument('--vis_seconds', default=2, type=int, help='length of the video rendered by vis_motion')
+    parser.add_argument('--only', default=None, nargs='+', choices=['models', 'losses', 'data', 'audio', 'video'])
+    parser.add_argument('--threads', default=None, type=int, help='torch threads, for comparable CPU runs')
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON file of an earlier run to compare with')
+    parser.add_argument('--threshold', default=0.1, type=float,
+                        help='relative slowdown reported as a regression (exit code 1)')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,46 @@
+from functools import partial
+from torch import nn
+
+
+def feature_map(x):
+    """ (N, C, T, W) -> (N, C * W, T), (N, C, T) is kept as is """
+    if x.dim() == 4:
+        x = x.transpose(1, 2).flatten(start_dim=2).transpose(1, 2)
+    return x
+
+
+def _capture(captured, name, module, inputs, output):
+    if isinstance(output, tuple):
+        output = output[0]
+    captured[(name, 'input')] = inputs[0]
+    captured[(name, 'output')] = output
+
+
+class FeatureExtractor(nn.Module):
+    """
+    Base class of encoders whose hidden feature maps are used as losses or visualized.
+    Subclasses list their layers in FEATURE_LAYERS as (submodule name, 'input' or 'output'); features() collects any
+    subset of them with forward hooks during a single forward pass.
+    """
+    FEATURE_LAYERS = []
+
+    def features(self, *inputs, layers=None):
+        """
+        Feature maps of the requested layer indices (all layers by default, negative indices allowed),
+        each as (N, C, T)
+        """
+        if layers is None:
+            layers = range(len(self.FEATURE_LAYERS))
+        requested = [self.FEATURE_LAYERS[i] for i in layers]
+
+        captured = {}
+        modules = dict(self.named_modules())
+        handles = [modules[name].register_forward_hook(partial(_capture, captured, name))
+                   for name in {name for name, _ in requested}]
+        try:
+            self(*inputs)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        return [feature_map(captured[layer]) for layer in requested]
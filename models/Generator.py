@@ -66,6 +66,12 @@ class Generator(nn.Module):
 
     def forward(self, x, noise):
         hx = self.music_encoder(x)
+        return self.decode(hx, noise)
+
+    def decode(self, hx, noise):
+        """
+        Generate motion from music-encoder outputs hx (N, 30 * seconds, 64), e.g. precomputed by a frozen encoder
+        """
         hnoise = self.noise_convTranspose(noise.transpose(1, 2))
         hnoise = self.noise_BN(hnoise).transpose(1, 2)
 
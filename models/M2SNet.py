@@ -23,13 +23,23 @@ class M2SNet(nn.Module):
                 nn.init.kaiming_normal_(m.weight.data, mode='fan_out', nonlinearity='relu')
 
     def forward(self, x, y):
+        hx, hy = self.encode(x, y)
+        return self.fuse(hx, hy)
+
+    def encode(self, x, y):
+        """
+        Encode music and motion clips once, the embeddings can then be scored in any pairing with fuse()
+        """
         hx = self.music_encoder(x)
         hy = self.motion_encoder(y)
+        return hx, hy
+
+    def fuse(self, hx, hy):
         h_fuse = torch.cat([hx, hy], dim=2)
         out = self.fuse_layer(h_fuse.transpose(1, 2)).transpose(1, 2)
         return out
 
-    def features(self, x, y):
-        x_features = self.music_encoder.features(x)
-        y_features = self.motion_encoder.features(y)
+    def features(self, x, y, music_layers=None, motion_layers=None):
+        x_features = self.music_encoder.features(x, layers=music_layers)
+        y_features = self.motion_encoder.features(y, layers=motion_layers)
         return x_features, y_features
\ No newline at end of file
@@ -1,9 +1,15 @@
 import torch
 import torch.nn as nn
 from models.ST_GCN.ST_GCN import ST_GCN
+from models.FeatureExtractor import FeatureExtractor
 
 
-class MotionEncoder_STGCN(nn.Module):
+class MotionEncoder_STGCN(FeatureExtractor):
+    # normalized input of the ST-GCN, outputs of its 10 layers, encoder output
+    FEATURE_LAYERS = [('st_gcn.st_gcn_networks.0', 'input')] + \
+                     [('st_gcn.st_gcn_networks.{}'.format(i), 'output') for i in range(10)] + \
+                     [('fc', 'output')]
+
     def __init__(self):
         super(MotionEncoder_STGCN, self).__init__()
         self.graph_args = {}
@@ -26,21 +32,6 @@ class MotionEncoder_STGCN(nn.Module):
 
         return output
 
-    def features(self, input):
-        input = input.transpose(1, 2)
-        input = input.transpose(1, 3)
-        input = input.unsqueeze(4)
-
-        output = self.st_gcn(input)
-        output = output.transpose(1, 2)
-        output = torch.flatten(output, start_dim=2)
-        output = self.fc(output.transpose(1, 2)).transpose(1, 2)
-
-        features = self.st_gcn.extract_feature(input)
-        features.append(output.transpose(1, 2))
-
-        return features
-
 
 class MotionAutoEncoder(nn.Module):
     def __init__(self):
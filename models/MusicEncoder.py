@@ -1,5 +1,7 @@
 import torch
 from torch import nn
+from models.FeatureExtractor import FeatureExtractor
+from models.activation_checkpoint import checkpoint_block
 
 
 class Conv2dResLayer(nn.Module):
@@ -14,20 +16,27 @@ class Conv2dResLayer(nn.Module):
                                           nn.BatchNorm2d(out_channels),
                                           nn.ReLU())
         if not residual:
-            self.residual = lambda x: 0
+            self.residual = None
         elif in_channels == out_channels:
-            self.residual = lambda x: x
+            self.residual = nn.Identity()
         else:
             self.residual = nn.Sequential(nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=1),
                                           nn.BatchNorm2d(out_channels))
 
     def forward(self, x):
         out = self.conv2d_layer(x)
-        res = self.residual(x)
-        return out + res
+        if self.residual is None:
+            return out
+        return out + self.residual(x)
 
 
-class MusicEncoder(nn.Module):
+class MusicEncoder(FeatureExtractor):
+    # mel input, conv1-3 outputs, encoder output
+    FEATURE_LAYERS = [('conv1', 'input'), ('conv1', 'output'), ('conv2', 'output'), ('conv3', 'output'),
+                      ('conv4', 'output')]
+    # blocks whose activations can be recomputed in backward instead of kept, see models.activation_checkpoint
+    CHECKPOINT_BLOCKS = ['conv1', 'conv2', 'conv3']
+
     def __init__(self):
         super(MusicEncoder, self).__init__()
 
@@ -45,26 +54,9 @@ class MusicEncoder(nn.Module):
 
     def forward(self, x):
         mel = x.unsqueeze(1)
-        h1 = self.conv1(mel)
-        h2 = self.conv2(h1)
-        h3 = self.conv3(h2)
+        h1 = checkpoint_block(self.conv1, mel)
+        h2 = checkpoint_block(self.conv2, h1)
+        h3 = checkpoint_block(self.conv3, h2)
         h3 = h3.transpose(1, 2).flatten(start_dim=2).transpose(1, 2)
         h4 = self.conv4(h3).transpose(1, 2)
         return h4
-
-    def features(self, x):
-        mel = x.unsqueeze(1)
-        h1 = self.conv1(mel)
-        h2 = self.conv2(h1)
-        h3 = self.conv3(h2)
-        h3 = h3.transpose(1, 2).flatten(start_dim=2).transpose(1, 2)
-        h4 = self.conv4(h3).transpose(1, 2)
-
-        h1 = torch.transpose(h1, 1, 2)
-        h1 = torch.flatten(h1, 2)
-        h2 = torch.transpose(h2, 1, 2)
-        h2 = torch.flatten(h2, 2)
-        h3 = torch.transpose(h3, 1, 2)
-        h3 = torch.flatten(h3, 2)
-
-        return [x.transpose(1, 2), h1.transpose(1, 2), h2.transpose(1, 2), h3.transpose(1, 2), h4.transpose(1, 2)]
@@ -5,6 +5,7 @@ from torch.autograd import Variable
 
 from models.ST_GCN.st_gcn_utils.tgcn import ConvTemporalGraphical
 from models.ST_GCN.st_gcn_utils.graph import Graph
+from models.activation_checkpoint import checkpoint_block
 import os
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
@@ -29,6 +30,8 @@ class ST_GCN(nn.Module):
             :math:`V_{in}` is the number of graph nodes,
             :math:`M_{in}` is the number of instance in a frame.
     """
+    # every layer of st_gcn_networks can be recomputed in backward instead of kept, see models.activation_checkpoint
+    CHECKPOINT_BLOCKS = ['st_gcn_networks']
 
     def __init__(self, in_channels, out_channels, graph_args,
                  edge_importance_weighting, mode, **kwargs):
@@ -83,6 +86,14 @@ class ST_GCN(nn.Module):
         # fcn for prediction
         self.fcn = nn.Conv2d(256, out_channels, kernel_size=1)
 
+    def effective_adjacency(self):
+        """
+        Adjacency of every layer, A * edge_importance, computed with one op per forward: (num_layers, K, V, V)
+        """
+        if isinstance(self.edge_importance, nn.ParameterList):
+            return self.A.unsqueeze(0) * torch.stack(list(self.edge_importance))
+        return self.A.unsqueeze(0).expand(len(self.st_gcn_networks), -1, -1, -1)
+
     def forward(self, x):
         """
         Shape:
@@ -102,8 +113,8 @@ class ST_GCN(nn.Module):
         x = x.permute(0, 1, 3, 4, 2).contiguous()
         x = x.view(N * M, C, T, V)
 
-        for gcn, importance in zip(self.st_gcn_networks, self.edge_importance):
-            x, _ = gcn(x, self.A * importance)
+        for gcn, A in zip(self.st_gcn_networks, self.effective_adjacency()):
+            x, _ = checkpoint_block(gcn, x, A)
 
         '''# global pooling
         x = F.avg_pool2d(x, x.size()[2:])
@@ -130,8 +141,8 @@ class ST_GCN(nn.Module):
 
         # forward
         feature_maps = [x.transpose(1,2).flatten(start_dim=2).transpose(1,2)]
-        for gcn, importance in zip(self.st_gcn_networks, self.edge_importance):
-            x, _ = gcn(x, self.A * importance)
+        for gcn, A in zip(self.st_gcn_networks, self.effective_adjacency()):
+            x, _ = gcn(x, A)
             feature_maps.append(x.transpose(1,2).flatten(start_dim=2).transpose(1,2))
 
         '''_, c, t, v = x.size()
@@ -200,10 +211,10 @@ class st_gcn(nn.Module):
         )
 
         if not residual:
-            self.residual = lambda x: 0
+            self.residual = None
 
         elif (in_channels == out_channels) and (stride == 1):
-            self.residual = lambda x: x
+            self.residual = nn.Identity()
 
         else:
             self.residual = nn.Sequential(
@@ -219,9 +230,11 @@ class st_gcn(nn.Module):
 
     def forward(self, x, A):
 
-        res = self.residual(x)
+        res = self.residual(x) if self.residual is not None else None
         x, A = self.gcn(x, A)
-        x = self.tcn(x) + res
+        x = self.tcn(x)
+        if res is not None:
+            x = x + res
 
         return self.relu(x), A
 
@@ -59,8 +59,13 @@ class ConvTemporalGraphical(nn.Module):
 
         x = self.conv(x)
 
+        # V is the innermost dimension of x, so the graph aggregation einsum('nkctv,kvw->nctw') is a matmul on a
+        # view of x, and its output is already contiguous
         n, kc, t, v = x.size()
-        x = x.view(n, self.kernel_size, kc//self.kernel_size, t, v)
-        x = torch.einsum('nkctv,kvw->nctw', (x, A))
+        c = kc // self.kernel_size
+        if self.kernel_size == 1:
+            x = torch.matmul(x.view(n, c * t, v), A[0])
+        else:
+            x = torch.matmul(x.view(n, self.kernel_size, c * t, v), A.unsqueeze(0)).sum(dim=1)
 
-        return x.contiguous(), A
+        return x.view(n, c, t, -1), A
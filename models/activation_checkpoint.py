@@ -0,0 +1,71 @@
+import contextlib
+import fnmatch
+import torch
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+
+@contextlib.contextmanager
+def frozen_batch_norm(module):
+    """
+    BatchNorm layers of module don't update their running statistics inside the block, for forwards that repeat one
+    whose update already counted (checkpoint recomputation, no_grad passes re-run for the graph)
+    """
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(norms, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_block(block, *inputs):
+    """
+    block(*inputs). If checkpointing was enabled for block (set_checkpointing) and gradients are being recorded, the
+    activations inside block are not kept for backward but recomputed from its inputs during backward.
+    """
+    if not getattr(block, 'checkpointed', False) or not torch.is_grad_enabled():
+        return block(*inputs)
+    return checkpoint(block, *inputs, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), frozen_batch_norm(block)))
+
+
+def checkpoint_blocks(model):
+    """
+    Qualified names of the blocks of model that support checkpointing. Modules list them in the class attribute
+    CHECKPOINT_BLOCKS, a listed ModuleList stands for each of its layers.
+    """
+    names = []
+    for prefix, module in model.named_modules():
+        for name in getattr(type(module), 'CHECKPOINT_BLOCKS', []):
+            block = module.get_submodule(name)
+            children = [name + '.' + child for child, _ in block.named_children()] \
+                if isinstance(block, nn.ModuleList) else [name]
+            names += [prefix + '.' + child if prefix else child for child in children]
+    return names
+
+
+def set_checkpointing(patterns, *models):
+    """
+    Enable activation checkpointing for the blocks of models whose qualified names match any of the fnmatch patterns
+    (e.g. 'music_encoder.conv*', 'motion_encoder.st_gcn.st_gcn_networks.*'), disable it for the others. Returns the
+    names of the checkpointed blocks.
+    """
+    enabled, matched = [], set()
+    for model in models:
+        modules = dict(model.named_modules())
+        for name in checkpoint_blocks(model):
+            hits = {pattern for pattern in patterns if fnmatch.fnmatchcase(name, pattern)}
+            modules[name].checkpointed = len(hits) > 0
+            if len(hits) > 0:
+                enabled.append(name)
+                matched |= hits
+    unmatched = [pattern for pattern in patterns if pattern not in matched]
+    if len(unmatched) > 0:
+        raise RuntimeError('no checkpointable block matches {}, the blocks are: {}'.format(
+            unmatched, sorted({name for model in models for name in checkpoint_blocks(model)})))
+    return enabled
@@ -39,6 +39,12 @@ python -c "import torch; print('CUDA available:', torch.cuda.is_available()); pr
 #python admin_test_unseen.py --model 'checkpoints/M2SGAN/M2SGAN_official_pretrained.pt'
 
 echo "Starting M2SNet_train.py..."
-python M2SNet_train.py --dataset_dir dataset
+# a requeued or resubmitted job continues from the last saved training state
+STATE=checkpoints/M2SNet/hard/training_state.pt
+if [ -f "$STATE" ]; then
+    python M2SNet_train.py --dataset_dir dataset --resume "$STATE"
+else
+    python M2SNet_train.py --dataset_dir dataset
+fi
 
 echo "Job finished at: $(date)"
\ No newline at end of file
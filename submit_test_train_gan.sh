@@ -39,6 +39,13 @@ python -c "import torch; print('CUDA available:', torch.cuda.is_available()); pr
 #python admin_test_unseen.py --model 'checkpoints/M2SGAN/M2SGAN_official_pretrained.pt'
 
 echo "Starting M2SGAN_train.py..."
-python M2SGAN_train.py --dataset_dir dataset
+# a requeued or resubmitted job continues from the last saved training state. Every M2SGAN run writes to its own
+# timestamped directory (checkpoints/M2SGAN/<mode>_<time>), the most recently written state is resumed from
+STATE=$(ls -t checkpoints/M2SGAN/hard_*/training_state.pt 2>/dev/null | head -n 1)
+if [ -n "$STATE" ]; then
+    python M2SGAN_train.py --dataset_dir dataset --resume "$STATE"
+else
+    python M2SGAN_train.py --dataset_dir dataset
+fi
 
 echo "Job finished at: $(date)"
\ No newline at end of file
@@ -8,6 +8,7 @@ import torch.utils.data as Data
 from utils.music_utils import extract_mel_feature
 import time
 from utils.motion_utils import vis_motion
+from utils.amp_utils import AMP_MODES, autocast
 
 
 class TestDataset(Data.Dataset):
@@ -36,7 +37,7 @@ class TestDataset(Data.Dataset):
         return feature, name
 
 
-def test(G, test_samles_dir='test/test_samples/', save_path='test/result'):
+def test(G, test_samles_dir='test/test_samples/', save_path='test/result', device='cuda', amp='fp32'):
     G.eval()
     dataset = TestDataset(test_samles_dir=test_samles_dir)
     testloader = Data.DataLoader(dataset=dataset, batch_size=1)
@@ -56,10 +57,11 @@ def test(G, test_samles_dir='test/test_samples/', save_path='test/result'):
                 if end - split * 60 * music_sr < 5 * music_sr:
                     continue
 
-            mel_step = mel_step.type(torch.FloatTensor).cuda()
+            mel_step = mel_step.type(torch.FloatTensor).to(device)
             noise = torch.randn([1, int(mel_step.size()[1] / music_sr), 8])
-            fake_step = G(mel_step, noise.cuda())
-            fake_step = fake_step.detach().cpu().numpy()[0]
+            with torch.no_grad(), autocast(amp, torch.device(device).type):
+                fake_step = G(mel_step, noise.to(device))
+            fake_step = fake_step.float().cpu().numpy()[0]
             motion[split * 60 * 30:split * 60 * 30 + fake_step.shape[0], :, :] = fake_step
         print(f'motion generated in {round(time.time()-end_time,2)} seconds')
         print('rendering video...')
@@ -78,12 +80,15 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--model')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--amp', default='fp32', choices=AMP_MODES,
+                        help='mixed precision inference: "bf16" (CPU or CUDA) or "fp16" (CUDA)')
     args = parser.parse_args()
 
-    G = Generator().cuda()
-    G.load_state_dict(torch.load(args.model))
+    G = Generator().to(args.device)
+    G.load_state_dict(torch.load(args.model, map_location=args.device))
 
     save_path = 'test/result/' + time.strftime("%Y-%m-%d_%H-%M-%S/", time.localtime())
     os.mkdir(save_path)
 
-    test(G=G, save_path=save_path)
+    test(G=G, save_path=save_path, device=args.device, amp=args.amp)
@@ -0,0 +1,79 @@
+"""
+Parity of the TorchScript and ONNX exports (utils.export_utils) with the eager models, on CPU. The ONNX tests are
+skipped when onnx or onnxruntime is not installed. Run from the repository root:
+
+    python -m pytest -q tests
+"""
+import pytest
+import torch
+from torch import nn
+
+from models.Generator import Generator
+from models.MusicEncoder import MusicEncoder
+from models.MotionEncoder import MotionEncoder_STGCN
+from models.M2SNet import M2SNet
+from utils.export_utils import example_inputs, export_torchscript, export_onnx, load_torchscript, ONNXRuntimeModel
+
+MODELS = {'Generator': Generator,
+          'MusicEncoder': MusicEncoder,
+          'MotionEncoder_STGCN': MotionEncoder_STGCN,
+          'M2SNet': M2SNet}
+# BatchNorm folding and weight_norm materialization reorder the float32 arithmetic
+TOLERANCE = {'rtol': 1e-4, 'atol': 1e-4}
+
+
+def build(name):
+    """ Eval-mode model with random (not identity) BatchNorm statistics, so that folding them is exercised """
+    torch.manual_seed(0)
+    model = MODELS[name]()
+    for module in model.modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+    return model.eval()
+
+
+def expected_output(model, inputs):
+    with torch.no_grad():
+        return model(*inputs)
+
+
+@pytest.mark.parametrize('name', list(MODELS))
+def test_torchscript_matches_eager(name, tmp_path):
+    model = build(name)
+    inputs = example_inputs(model, batch_size=2, seconds=4)
+    expected = expected_output(model, inputs)
+
+    path = str(tmp_path / (name + '.ts.pt'))
+    export_torchscript(model, inputs, path)
+    with torch.no_grad():
+        actual = load_torchscript(path)(*inputs)
+
+    torch.testing.assert_close(actual, expected, **TOLERANCE)
+
+
+@pytest.mark.parametrize('name', list(MODELS))
+def test_onnx_matches_eager(name, tmp_path):
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    model = build(name)
+    inputs = example_inputs(model, batch_size=2, seconds=4)
+    expected = expected_output(model, inputs)
+
+    path = str(tmp_path / (name + '.onnx'))
+    export_onnx(model, inputs, path)
+    actual = ONNXRuntimeModel(path)(*inputs)
+
+    torch.testing.assert_close(actual, expected, **TOLERANCE)
+
+
+def test_export_leaves_model_unchanged(tmp_path):
+    model = build('Generator')
+    inputs = example_inputs(model, batch_size=2, seconds=4)
+    state = {key: value.clone() for key, value in model.state_dict().items()}
+
+    export_torchscript(model, inputs, str(tmp_path / 'Generator.ts.pt'))
+
+    assert not model.training
+    for key, value in model.state_dict().items():
+        torch.testing.assert_close(value, state[key], rtol=0, atol=0)
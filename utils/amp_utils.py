@@ -0,0 +1,30 @@
+import contextlib
+import torch
+
+# fp32: full precision, bf16: bfloat16 autocast (CPU or CUDA), fp16: float16 autocast with loss scaling (CUDA only)
+AMP_MODES = ['fp32', 'bf16', 'fp16']
+AMP_DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def check_amp(mode, device_type='cuda'):
+    if mode not in AMP_MODES:
+        raise RuntimeError('Invalid amp mode {}, expected one of {}!'.format(mode, AMP_MODES))
+    if mode == 'fp16' and device_type != 'cuda':
+        raise RuntimeError('fp16 autocast requires CUDA, use bf16 on CPU!')
+
+
+def autocast(mode, device_type='cuda'):
+    """ Autocast context of an amp mode, a no-op for fp32 """
+    check_amp(mode, device_type)
+    if mode == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type, dtype=AMP_DTYPES[mode])
+
+
+def grad_scaler(mode, device_type='cuda'):
+    """
+    GradScaler of an amp mode: only fp16 needs loss scaling, for the other modes the scaler is disabled and
+    scale() / step() / update() fall through to the plain calls
+    """
+    check_amp(mode, device_type)
+    return torch.amp.GradScaler(device_type, enabled=mode == 'fp16')
@@ -0,0 +1,124 @@
+import math
+import time
+from collections import deque
+
+import torch
+
+
+class GenerationRequest:
+    """
+    A music clip waiting for motion generation.
+    mel: (T_mel, 128) at 90 Hz
+    motion: (T_mel // 3, 13, 2) at 30 Hz, filled in once every segment of the request has been generated
+    """
+
+    def __init__(self, request_id, mel, noise=None):
+        self.request_id = request_id
+        self.mel = torch.as_tensor(mel, dtype=torch.float32)
+        self.num_frames = self.mel.shape[0] // 3
+        self.seconds = math.ceil(self.mel.shape[0] / 90)
+        self.noise = torch.randn([self.seconds, 8]) if noise is None else torch.as_tensor(noise, dtype=torch.float32)
+        self.motion = torch.zeros([self.seconds * 30, 13, 2])
+        self.pending_segments = 0
+        self.submit_time = time.perf_counter()
+        self.finish_time = None
+
+    @property
+    def done(self):
+        return self.finish_time is not None
+
+    @property
+    def latency(self):
+        return self.finish_time - self.submit_time
+
+
+class BatchScheduler:
+    """
+    Dynamic batching in front of Generator.forward.
+
+    Requests are split into segments of at most max(buckets) seconds (the same windowing as test_unseen.py),
+    each segment is zero-padded (silence) to the smallest bucket that holds it, and segments sharing a bucket
+    are packed into one batch. A bucket is run when it is full or when its oldest segment has waited longer
+    than max_latency seconds. The batch size of a bucket is capped by max_batch_size and by the memory budget
+    max_batch_seconds (bucket length x batch size), since activations grow linearly with both.
+
+    Frames close to the end of a padded segment see silence instead of reflect padding, so they can differ
+    slightly from an unpadded batch-size-1 forward.
+    """
+
+    def __init__(self, G, buckets=(10, 20, 30, 60), max_batch_size=16, max_batch_seconds=960, max_latency=0.1,
+                 device='cuda'):
+        self.G = G.eval()
+        self.buckets = sorted(buckets)
+        self.max_batch_size = max_batch_size
+        self.max_batch_seconds = max_batch_seconds
+        self.max_latency = max_latency
+        self.device = device
+
+        self.queues = {bucket: deque() for bucket in self.buckets}
+        self.num_batches = 0
+        self.num_segments = 0
+        self._next_id = 0
+
+    def capacity(self, bucket):
+        return max(1, min(self.max_batch_size, self.max_batch_seconds // bucket))
+
+    def pending(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def submit(self, mel, noise=None):
+        request = GenerationRequest(self._next_id, mel, noise)
+        # a request without segments would never be finished by step()
+        if request.seconds == 0:
+            raise ValueError('cannot generate motion for an empty mel spectrogram')
+        self._next_id += 1
+
+        window = self.buckets[-1]
+        for start in range(0, request.seconds, window):
+            seconds = min(window, request.seconds - start)
+            bucket = next(b for b in self.buckets if b >= seconds)
+            self.queues[bucket].append((request, start, seconds))
+            request.pending_segments += 1
+        return request
+
+    def step(self, force=False):
+        """
+        Run every bucket that is full or has exceeded its latency budget (or every non-empty bucket if force).
+        Returns the requests finished by this call.
+        """
+        finished = []
+        now = time.perf_counter()
+        for bucket in self.buckets:
+            queue = self.queues[bucket]
+            capacity = self.capacity(bucket)
+            while queue and (force or len(queue) >= capacity or now - queue[0][0].submit_time >= self.max_latency):
+                segments = [queue.popleft() for _ in range(min(capacity, len(queue)))]
+                finished += self._run_batch(bucket, segments)
+        return finished
+
+    def flush(self):
+        return self.step(force=True)
+
+    def _run_batch(self, bucket, segments):
+        mel = torch.zeros([len(segments), bucket * 90, 128])
+        noise = torch.randn([len(segments), bucket, 8])
+        for i, (request, start, seconds) in enumerate(segments):
+            mel_segment = request.mel[start * 90:(start + seconds) * 90]
+            mel[i, :mel_segment.shape[0]] = mel_segment
+            noise[i, :seconds] = request.noise[start:start + seconds]
+
+        with torch.no_grad():
+            motion = self.G(mel.to(self.device), noise.to(self.device)).cpu()
+        self.num_batches += 1
+        self.num_segments += len(segments)
+
+        finished = []
+        now = time.perf_counter()
+        for i, (request, start, seconds) in enumerate(segments):
+            request.motion[start * 30:(start + seconds) * 30] = motion[i, :seconds * 30]
+            request.pending_segments -= 1
+            if request.pending_segments == 0:
+                request.motion = request.motion[:request.num_frames]
+                request.finish_time = now
+                finished.append(request)
+        return finished
@@ -0,0 +1,159 @@
+import os
+import re
+import queue
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(state):
+    """
+    Copy of a (nested) state dict in CPU memory. CUDA tensors are copied non-blocking into pinned memory, the copies
+    are ordered on the current stream before any later update of the parameters. Returns (copy, event), event is
+    None when nothing was on the GPU.
+    """
+    copied = {'cuda': False}
+
+    def copy(value):
+        if torch.is_tensor(value):
+            value = value.detach()
+            if value.is_cuda:
+                copied['cuda'] = True
+                host = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+                return host.copy_(value, non_blocking=True)
+            return value.clone()
+        if isinstance(value, dict):
+            result = type(value)((key, copy(item)) for key, item in value.items())
+            if hasattr(value, '_metadata'):
+                result._metadata = value._metadata
+            return result
+        if isinstance(value, (list, tuple)):
+            return type(value)(copy(item) for item in value)
+        return value
+
+    state = copy(state)
+    event = None
+    if copied['cuda']:
+        event = torch.cuda.Event()
+        event.record()
+    return state, event
+
+
+def rng_state():
+    """ States of every random number generator used in training: Python, NumPy (PairBuilder), torch and CUDA """
+    return {'python': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if len(state['cuda']) > 0:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_state(path):
+    """ Training state written by CheckpointWriter, it holds RNG states as well as tensors """
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def atomic_save(state, path):
+    """ torch.save to a temporary file renamed over path, a crash never leaves a truncated checkpoint """
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_link(target, path):
+    """ Point path at target: a relative symlink, or a hard link / copy where symlinks are not supported """
+    tmp_path = path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.symlink(os.path.basename(target), tmp_path)
+    except OSError:
+        try:
+            os.link(target, tmp_path)
+        except OSError:
+            shutil.copyfile(target, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints from a background thread, so training only waits for the copy of the state to CPU memory.
+    save(state, filename, last) writes save_path/filename atomically and points save_path/last at it instead of
+    serializing the state twice. Checkpoints saved with the same last name form a series, of which only the newest
+    keep are kept on disk (keep=0: all). A series starts from the files already in save_path whose names match the
+    first saved filename with its numbers as wildcards (e.g. M2SNet_*_*.pt, written before a resume), oldest first.
+    """
+
+    def __init__(self, save_path, keep=0):
+        self.save_path = save_path
+        self.keep = keep
+        self.series = {}
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def save(self, state, filename, last=None):
+        self._raise()
+        state, event = snapshot(state)
+        self.queue.put((state, event, filename, last))
+
+    def join(self):
+        """ Wait until every checkpoint saved so far is on disk """
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def _write(self, state, event, filename, last):
+        if event is not None:
+            event.synchronize()
+        path = os.path.join(self.save_path, filename)
+        atomic_save(state, path)
+        if last is not None:
+            atomic_link(path, os.path.join(self.save_path, last))
+
+        if last not in self.series:
+            self.series[last] = self._existing(filename)
+        series = self.series[last]
+        if path in series:
+            series.remove(path)
+        series.append(path)
+        while self.keep > 0 and len(series) > self.keep:
+            os.remove(series.pop(0))
+
+    def _existing(self, filename):
+        """ Paths of the files in save_path named like filename up to its numbers, by modification time """
+        pattern = re.compile(r'\d+'.join(re.escape(part) for part in re.split(r'\d+', filename)))
+        paths = [os.path.join(self.save_path, name) for name in os.listdir(self.save_path) if pattern.fullmatch(name)]
+        return sorted((path for path in paths if os.path.isfile(path) and not os.path.islink(path)),
+                      key=os.path.getmtime)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                self._write(*item)
+            except Exception as error:
+                self.error = error
+            self.queue.task_done()
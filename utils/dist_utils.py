@@ -0,0 +1,131 @@
+import os
+import contextlib
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(device='cuda', backend=None):
+    """
+    Join the process group described by the torchrun environment (RANK, WORLD_SIZE, LOCAL_RANK), or run as a single
+    process when it is not set. Every process gets its own GPU (cuda:LOCAL_RANK); with device='cpu' the processes
+    share the CPU through the gloo backend. Returns (rank, world_size, device).
+    """
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+
+    device = torch.device(device)
+    if device.type == 'cuda':
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    if world_size > 1:
+        if backend is None:
+            backend = 'nccl' if device.type == 'cuda' else 'gloo'
+        dist.init_process_group(backend, rank=rank, world_size=world_size)
+    return rank, world_size, device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """ The main process runs the block first (e.g. building a feature store), the others wait and then reuse it """
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def broadcast_parameters(module, src=0):
+    """ Start every process from the parameters and buffers of rank src """
+    if not is_distributed():
+        return
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src)
+
+
+def all_reduce_gradients(module, bucket_mib=25):
+    """
+    Average the gradients of module over all processes, with one all_reduce per bucket of about bucket_mib MiB (the
+    bucket size of DistributedDataParallel). Called between backward() and the optimizer step, this is the gradient
+    synchronization of DDP; unlike the DDP wrapper it does not depend on how many times (and through which methods)
+    the module ran before backward(). A parameter left without gradient on this process (unused by its batch) gets a
+    zero gradient, so that every process reduces the same buffers and the average divides by the number of processes.
+    """
+    if not is_distributed():
+        return
+    parameters = [p for p in module.parameters() if p.requires_grad]
+    for p in parameters:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    buckets, size = [], None
+    for p in parameters:
+        nbytes = p.grad.numel() * p.grad.element_size()
+        if len(buckets) == 0 or p.grad.dtype != buckets[-1][0].dtype or size + nbytes > bucket_mib * 2 ** 20:
+            buckets.append([])
+            size = 0
+        buckets[-1].append(p.grad)
+        size += nbytes
+    for grads in buckets:
+        flat = torch.cat([grad.reshape(-1) for grad in grads])
+        dist.all_reduce(flat)
+        flat /= get_world_size()
+        offset = 0
+        for grad in grads:
+            grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
+
+
+def average_buffers(module):
+    """
+    Average the floating point buffers of module (BatchNorm running statistics) over all processes. Every process
+    normalizes its training batches with their own statistics, so the running estimates drift apart between
+    processes; they are averaged before rank 0 evaluates or checkpoints the module. Integer buffers (BatchNorm
+    num_batches_tracked) advance in lockstep and are left as they are.
+    """
+    if not is_distributed():
+        return
+    buffers = [b for b in module.buffers() if b.is_floating_point()]
+    if len(buffers) == 0:
+        return
+    flat = torch.cat([buffer.reshape(-1) for buffer in buffers])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    offset = 0
+    for buffer in buffers:
+        buffer.copy_(flat[offset:offset + buffer.numel()].view_as(buffer))
+        offset += buffer.numel()
+
+
+def all_gather_object(obj):
+    """ obj of every process, in rank order """
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
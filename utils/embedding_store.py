@@ -0,0 +1,103 @@
+import os
+import json
+import hashlib
+import tqdm
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+
+def module_fingerprint(module):
+    sha = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def build_store(encode, dataset, path, meta, batch_size=32, device='cuda'):
+    """
+    Run encode(mel, motion) over every sample of dataset (in order) and store the outputs as a memory-mapped
+    .npy file of shape (len(dataset), ...). The store is reused as long as its .json metadata matches meta.
+    """
+    meta = dict(meta, num_samples=len(dataset))
+    meta_path = path + '.json'
+    if os.path.isfile(path) and os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == meta:
+                print(f'Using precomputed features from {path}')
+                return np.load(path, mmap_mode='r')
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+
+    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False)
+    store = None
+    start = 0
+    with torch.no_grad():
+        for mel, motion in tqdm.tqdm(loader, desc=f'Precomputing {path}'):
+            out = encode(mel.type(torch.FloatTensor).to(device), motion.type(torch.FloatTensor).to(device))
+            out = out.cpu().numpy()
+            if store is None:
+                store = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                                  shape=(len(dataset),) + out.shape[1:])
+            store[start:start + len(out)] = out
+            start += len(out)
+    store.flush()
+    del store
+
+    # written last, so an interrupted run is recomputed
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return np.load(path, mmap_mode='r')
+
+
+def precompute_music_embedding(music_encoder, dataset, store_dir, split, limit, device='cuda'):
+    """
+    Outputs of a frozen music encoder for every sample of a ConductorMotionDataset, (num_samples, 30 * sample_length, 64).
+    The encoder runs in eval mode (BatchNorm running statistics), the only mode in which its output is a
+    function of the sample alone.
+    """
+    music_encoder.eval()
+    path = os.path.join(store_dir, f'music_embedding_{split}_{dataset.sample_length}s.npy')
+    meta = {'split': split, 'limit': limit, 'sample_length': dataset.sample_length,
+            'music_encoder': module_fingerprint(music_encoder)}
+    return build_store(lambda mel, motion: music_encoder(mel), dataset, path, meta, device=device)
+
+
+def precompute_sync_feature(sync_loss, dataset, store_dir, split, limit, device='cuda'):
+    """
+    SyncLoss features of the real motion of every sample, sync_loss.real_feature(motion): (num_samples, 64, 30 * sample_length)
+    """
+    path = os.path.join(store_dir, f'sync_feature_{split}_{dataset.sample_length}s.npy')
+    meta = {'split': split, 'limit': limit, 'sample_length': dataset.sample_length, 'layers': [-1],
+            'motion_encoder': module_fingerprint(sync_loss.motion_encoder)}
+    return build_store(lambda mel, motion: sync_loss.real_feature(motion), dataset, path, meta, device=device)
+
+
+class StoredFeatureDataset(Dataset):
+    """
+    ConductorMotionDataset backed by feature stores, keyed by sample index:
+    returns (music embedding if given else mel, motion[, real-motion SyncLoss feature if given])
+    """
+
+    def __init__(self, dataset, music_embedding=None, sync_feature=None):
+        for store in [music_embedding, sync_feature]:
+            if store is not None and len(store) != len(dataset):
+                raise RuntimeError('feature store does not match the dataset!')
+        self.dataset = dataset
+        self.music_embedding = music_embedding
+        self.sync_feature = sync_feature
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        music, motion = self.dataset[index]
+        if self.music_embedding is not None:
+            music = np.array(self.music_embedding[index])
+        if self.sync_feature is None:
+            return music, motion
+        return music, motion, np.array(self.sync_feature[index])
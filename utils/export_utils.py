@@ -0,0 +1,140 @@
+import argparse
+import os
+import torch
+
+from utils.fold_utils import fold_for_inference
+
+# input names of every exportable model, in forward() order
+EXPORT_INPUTS = {
+    'Generator': ['mel', 'noise'],
+    'M2SNet': ['mel', 'motion'],
+    'MusicEncoder': ['mel'],
+    'MotionEncoder_STGCN': ['motion'],
+}
+DYNAMIC_AXES = {
+    'mel': {0: 'batch', 1: 'mel_frames'},
+    'noise': {0: 'batch', 1: 'seconds'},
+    'motion': {0: 'batch', 1: 'motion_frames'},
+    'output': {0: 'batch', 1: 'frames'},
+}
+
+
+def example_inputs(model, batch_size=1, seconds=10):
+    inputs = {'mel': torch.rand([batch_size, seconds * 90, 128]),
+              'noise': torch.randn([batch_size, seconds, 8]),
+              'motion': torch.rand([batch_size, seconds * 30, 13, 2])}
+    return tuple(inputs[name] for name in EXPORT_INPUTS[type(model).__name__])
+
+
+def prepare_for_export(model):
+    """ Eval-mode CPU copy of the model with weight_norm materialized and BatchNorm folded into the convolutions """
+    return fold_for_inference(model).cpu()
+
+
+def export_torchscript(model, inputs, path):
+    """
+    Trace the folded model and freeze it. Freezing inlines the parameters as constants and folds what is left
+    (e.g. conv + add) into the convolutions.
+    """
+    model = prepare_for_export(model)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, inputs)
+    frozen = torch.jit.freeze(traced)
+    torch.jit.save(frozen, path)
+    return frozen
+
+
+def export_onnx(model, inputs, path, opset_version=17):
+    """
+    Export the folded model in eval mode with constant folding. Batch size and clip length are dynamic.
+    """
+    model = prepare_for_export(model)
+    input_names = EXPORT_INPUTS[type(model).__name__]
+    with torch.no_grad():
+        torch.onnx.export(model, inputs, path,
+                          input_names=input_names,
+                          output_names=['output'],
+                          dynamic_axes={name: DYNAMIC_AXES[name] for name in input_names + ['output']},
+                          opset_version=opset_version,
+                          do_constant_folding=True,
+                          training=torch.onnx.TrainingMode.EVAL)
+    return path
+
+
+def load_torchscript(path, num_threads=None):
+    """ Load an exported TorchScript model for CPU inference (oneDNN layouts, fused ops) """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    model = torch.jit.load(path, map_location='cpu')
+    return torch.jit.optimize_for_inference(model)
+
+
+class ONNXRuntimeModel:
+    """ Callable wrapper of an onnxruntime CPU session, taking and returning torch tensors """
+
+    def __init__(self, path, num_threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError('onnxruntime is required to run exported ONNX models: pip install onnxruntime')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        feed = {name: x.detach().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        return torch.from_numpy(self.session.run(None, feed)[0])
+
+
+def max_abs_error(model, exported, inputs):
+    """ Parity between an eval-mode eager model and its exported counterpart """
+    with torch.no_grad():
+        expected = model(*inputs).cpu()
+        actual = exported(*inputs)
+    return (expected - actual).abs().max().item()
+
+
+def export_all(models, out_dir, seconds=10):
+    os.makedirs(out_dir, exist_ok=True)
+    for name, model in models.items():
+        model.eval()
+        inputs = example_inputs(model, seconds=seconds)
+
+        ts_path = os.path.join(out_dir, name + '.ts.pt')
+        export_torchscript(model, inputs, ts_path)
+        error = max_abs_error(model.cpu(), load_torchscript(ts_path), inputs)
+        print(f'{name}: TorchScript saved to {ts_path}, max abs error {error:.2e}')
+
+        onnx_path = os.path.join(out_dir, name + '.onnx')
+        export_onnx(model, inputs, onnx_path)
+        try:
+            error = max_abs_error(model.cpu(), ONNXRuntimeModel(onnx_path), inputs)
+            print(f'{name}: ONNX saved to {onnx_path}, max abs error {error:.2e}')
+        except RuntimeError as e:
+            print(f'{name}: ONNX saved to {onnx_path}, parity not checked ({e})')
+
+
+if __name__ == '__main__':
+    from models.Generator import Generator
+    from models.M2SNet import M2SNet
+
+    parser = argparse.ArgumentParser(description='Export Generator and M2SNet to TorchScript and ONNX')
+    parser.add_argument('--generator', default='checkpoints/M2SGAN/M2SGAN_official_pretrained.pt')
+    parser.add_argument('--M2SNet', default='checkpoints/M2SNet/M2SNet_official_pretrained.pt')
+    parser.add_argument('--out_dir', default='checkpoints/exported')
+    parser.add_argument('--seconds', default=10, type=int, help='clip length of the tracing example')
+    args = parser.parse_args()
+
+    G = Generator()
+    G.load_state_dict(torch.load(args.generator, map_location='cpu'))
+    m2snet = M2SNet()
+    m2snet.load_state_dict(torch.load(args.M2SNet, map_location='cpu'))
+
+    export_all({'Generator': G,
+                'M2SNet': m2snet,
+                'MusicEncoder': m2snet.music_encoder,
+                'MotionEncoder_STGCN': m2snet.motion_encoder}, args.out_dir, args.seconds)
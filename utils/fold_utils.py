@@ -0,0 +1,88 @@
+import copy
+import torch
+from torch import nn
+from torch.nn.utils import parametrize
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from models.TCN import Chomp1d
+
+CONV_TYPES = (nn.Conv1d, nn.Conv2d)
+BN_TYPES = (nn.BatchNorm1d, nn.BatchNorm2d)
+# layers allowed between a convolution and its BatchNorm: they keep every channel apart, so they commute with the
+# per-channel affine transform of an eval-mode BatchNorm (e.g. conv -> chomp -> bn in TemporalBlock)
+PASSTHROUGH_TYPES = (Chomp1d,)
+
+
+def copy_model(model):
+    """ Deep copy of model that leaves model untouched (its weight_norm weights stay attached to weight_g, weight_v) """
+    # weight_norm keeps its recomputed weight as a plain non-leaf tensor, which deepcopy refuses to copy: the copy
+    # gets a detached clone of it through the memo instead
+    memo = {}
+    for module in model.modules():
+        if hasattr(module, 'weight_g') and isinstance(module.weight, torch.Tensor) and not module.weight.is_leaf:
+            memo[id(module.weight)] = module.weight.detach().clone()
+    return copy.deepcopy(model, memo)
+
+
+def strip_weight_norm(model):
+    for module in model.modules():
+        if hasattr(module, 'weight_g'):
+            nn.utils.remove_weight_norm(module)
+        elif parametrize.is_parametrized(module, 'weight'):
+            parametrize.remove_parametrizations(module, 'weight', leave_parametrized=True)
+    return model
+
+
+def replace_module(root, old, new):
+    """ Replace every reference to old in root (a module can be registered twice, e.g. TemporalBlock.conv1) """
+    for module in list(root.modules()):
+        for name, child in module._modules.items():
+            if child is old:
+                module._modules[name] = new
+
+
+def fold_batchnorm(model):
+    """
+    Fold every eval-mode BatchNorm that follows a Conv1d/Conv2d inside an nn.Sequential into the convolution,
+    replacing the BatchNorm by nn.Identity. Returns the number of folded pairs.
+    """
+    num_folded = 0
+    for sequential in list(model.modules()):
+        if not isinstance(sequential, nn.Sequential):
+            continue
+        layers = list(sequential)
+        for i, conv in enumerate(layers):
+            if not isinstance(conv, CONV_TYPES):
+                continue
+            j = i + 1
+            while j < len(layers) and isinstance(layers[j], PASSTHROUGH_TYPES):
+                j += 1
+            if j == len(layers) or not isinstance(layers[j], BN_TYPES) or not layers[j].track_running_stats:
+                continue
+            replace_module(model, conv, fuse_conv_bn_eval(conv, layers[j]))
+            replace_module(model, layers[j], nn.Identity())
+            num_folded += 1
+    return num_folded
+
+
+def fold_for_inference(model):
+    """
+    Inference-only copy of a trained Generator / M2SNet (or any of their sub-modules): eval mode, no gradients,
+    weight_norm materialized into plain conv weights and BatchNorm folded into the preceding convolutions.
+    The number of folded BatchNorm layers is stored in model.num_folded_bn.
+    """
+    model = copy_model(model).eval()
+    strip_weight_norm(model)
+    model.num_folded_bn = fold_batchnorm(model)
+    for param in model.parameters():
+        param.requires_grad = False
+    return model
+
+
+def verify_equivalence(model, folded, inputs, atol=1e-4):
+    """ Max abs difference between the eval-mode model and its folded copy, raises if it exceeds atol """
+    with torch.no_grad():
+        error = (model.eval()(*inputs) - folded(*inputs)).abs().max().item()
+    if error > atol:
+        raise RuntimeError(f'Folded {type(model).__name__} does not match the original: max abs error {error}')
+    return error
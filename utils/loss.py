@@ -8,13 +8,14 @@ MSE = nn.MSELoss()
 
 
 class FeatureMatchingLoss(nn.Module):
-    def __init__(self):
+    def __init__(self, layers=None):
         super(FeatureMatchingLoss, self).__init__()
+        self.layers = layers
         self.criterion = nn.MSELoss()
 
     def forward(self, motion_encoder, fake_motion, motion):
-        real_feature = motion_encoder.features(motion)
-        fake_feature = motion_encoder.features(fake_motion)
+        real_feature = motion_encoder.features(motion, layers=self.layers)
+        fake_feature = motion_encoder.features(fake_motion, layers=self.layers)
         loss_all = 0
         for i in range(len(real_feature)):
             loss_all += self.criterion(real_feature[i], fake_feature[i])
@@ -26,12 +27,22 @@ class SyncLoss(nn.Module):
     def __init__(self, motion_encoder):
         super(SyncLoss, self).__init__()
         self.motion_encoder = motion_encoder.eval()
+        self.motion_encoder.requires_grad_(False)
         self.criterion = nn.L1Loss()
 
-    def forward(self, fake_motion, motion):
-        real_feature = self.motion_encoder.features(motion)
-        fake_feature = self.motion_encoder.features(fake_motion)
-        loss_all = self.criterion(real_feature[-1], fake_feature[-1])
+    def real_feature(self, motion):
+        """ Only the encoder output (the last feature layer) is compared """
+        with torch.no_grad():
+            return self.motion_encoder.features(motion, layers=[-1])[0]
+
+    def forward(self, fake_motion, motion, real_feature=None):
+        """
+        real_feature: optional precomputed self.real_feature(motion), e.g. from a feature store
+        """
+        if real_feature is None:
+            real_feature = self.real_feature(motion)
+        fake_feature = self.motion_encoder.features(fake_motion, layers=[-1])[0]
+        loss_all = self.criterion(real_feature, fake_feature)
         '''loss_all = 0
         for i in range(len(self.weights)):
             fake = torch.max_pool1d(fake_feature[i], kernel_size=5, stride=3)
@@ -41,70 +52,100 @@ class SyncLoss(nn.Module):
         return loss_all
 
 
-def calc_gradient_penalty_ST(D, real_data, fake_data, term=None):
+def input_gradients(D, input, scaler=None):
+    """
+    d sum(D(input)) / d input with the graph kept for the double backward, always in float32.
+    With an enabled GradScaler (fp16 autocast) the output is scaled before autograd.grad so that small gradients
+    don't underflow in half precision, and the gradients are unscaled again.
+    """
+    output = D(input)
+    scale = None
+    if scaler is not None and scaler.is_enabled():
+        # the current scale as a device tensor, without a host sync
+        scale = scaler.scale(torch.ones((), device=output.device))
+        output = output * scale
+    # grad of the sum: the ones seeding the backward are an expanded scalar, no grad_outputs tensor per call
+    gradients = autograd.grad(outputs=output.sum(), inputs=input,
+                              create_graph=True, retain_graph=True, only_inputs=True)[0]
+    if scale is not None:
+        gradients = gradients / scale
+    return gradients.float()
+
+
+def calc_gradient_penalty_ST(D, real_data, fake_data, term=None, scaler=None, batch_fraction=1):
+    """
+    The inputs of all enabled terms are concatenated into one batch, so D runs a single forward and double backward
+    per call. This equals penalizing every term separately as long as D scores every sample independently
+    (Discriminator_1DCNN has no batch statistics).
+    scaler: the GradScaler of the discriminator loss when training with fp16 autocast
+    batch_fraction: share of the batch in real_data when the batch is split into micro-batches (gradient
+    accumulation). The per-sample terms are means over the batch and are weighted by it; the real_fake term is the
+    squared norm of the whole batch gradient, a sum over samples, and is not. The penalties of the micro-batches
+    then add up to the penalty of the whole batch.
+    """
     if term is None:
         term = ['real', 'fake', 'real_fake', 'real_motion', 'fake_motion']
-    loss = 0
+    real_data = real_data.detach().float()
+    fake_data = fake_data.detach().float()
+    real_structure = real_data.mean(dim=1).unsqueeze(1)
+    fake_structure = fake_data.mean(dim=1).unsqueeze(1)
     center = 0
+
+    names, inputs = [], []
     if 'real' in term:
-        output = D(real_data.requires_grad_(True))
-        gradients = autograd.grad(outputs=output, inputs=real_data, grad_outputs=torch.ones(output.size()).cuda(),
-                                  create_graph=True, retain_graph=True, only_inputs=True)[0]
-        norm_real = gradients.norm(2, dim=1)
-        GP_real = ((norm_real - center) ** 2).mean()
-        loss += GP_real
+        names.append('real')
+        inputs.append(real_data)
 
     if 'fake' in term:
-        output = D(fake_data.requires_grad_(True))
-        gradients = autograd.grad(outputs=output, inputs=fake_data, grad_outputs=torch.ones(output.size()).cuda(),
-                                  create_graph=True, retain_graph=True, only_inputs=True)[0]
-        norm_fake = gradients.norm(2, dim=1)
-        GP_fake = ((norm_fake - center) ** 2).mean()
-        loss += GP_fake
+        names.append('fake')
+        inputs.append(fake_data)
 
     if 'real_motion' in term:
-        real_motion = real_data - real_data.mean(dim=1).unsqueeze(1)
-        real_structure = real_data.mean(dim=1).unsqueeze(1)
-        fake_structure = fake_data.mean(dim=1).unsqueeze(1)
-
-        alpha = torch.rand(1).cuda()
-        input = (alpha * real_motion + alpha * fake_structure + (1 - alpha) * real_structure).requires_grad_(True)
-        output = D(input)
-        gradients = autograd.grad(outputs=output, inputs=input, grad_outputs=torch.ones(output.size()).cuda(),
-                                  create_graph=True, retain_graph=True, only_inputs=True)[0]
-        norm_real_motion = gradients.norm(2, dim=1)
-        GP_real_motion = ((norm_real_motion - center) ** 2).mean()
-        loss += GP_real_motion
+        alpha = torch.rand(1, device=real_data.device)
+        names.append('real_motion')
+        inputs.append(alpha * (real_data - real_structure) + alpha * fake_structure + (1 - alpha) * real_structure)
 
     if 'fake_motion' in term:
-        fake_motion = fake_data - fake_data.mean(dim=1).unsqueeze(1)
-        real_structure = real_data.mean(dim=1).unsqueeze(1)
-        fake_structure = fake_data.mean(dim=1).unsqueeze(1)
-
-        alpha = torch.rand(1).cuda()
-        input = (alpha * fake_motion + alpha * fake_structure + (1 - alpha) * real_structure).requires_grad_(True)
-        output = D(input)
-        gradients = autograd.grad(outputs=output, inputs=input, grad_outputs=torch.ones(output.size()).cuda(),
-                                  create_graph=True, retain_graph=True, only_inputs=True)[0]
-        norm_fake_motion = gradients.norm(2, dim=1)
-        GP_fake_motion = ((norm_fake_motion - center) ** 2).mean()
-        loss += GP_fake_motion
+        alpha = torch.rand(1, device=real_data.device)
+        names.append('fake_motion')
+        inputs.append(alpha * (fake_data - fake_structure) + alpha * fake_structure + (1 - alpha) * real_structure)
 
     if 'real_fake' in term:
-        alpha = torch.Tensor(np.random.random((real_data.size(0), 1, 1, 1))).cuda()
-        interpolates = (alpha * real_data + ((1 - alpha) * fake_data)).requires_grad_(True)
-        disc_interpolates = D(interpolates)
-        gradients = autograd.grad(outputs=disc_interpolates, inputs=interpolates,
-                                  grad_outputs=torch.ones(disc_interpolates.size()).cuda(),
-                                  create_graph=True, retain_graph=True, only_inputs=True)[0]
-        norm_real_fake = gradients.norm()
-        gradient_penalty = ((norm_real_fake - center) ** 2).mean()
-        loss += gradient_penalty
+        alpha = torch.rand([real_data.size(0), 1, 1, 1], device=real_data.device)
+        names.append('real_fake')
+        inputs.append(alpha * real_data + ((1 - alpha) * fake_data))
+
+    if len(inputs) == 0:
+        return 0
+    input = torch.cat(inputs).requires_grad_(True)
+    gradients = input_gradients(D, input, scaler).split(real_data.size(0))
+
+    loss = 0
+    for name, gradient in zip(names, gradients):
+        # the real / fake interpolation is penalized on the norm of the whole batch gradient
+        if name == 'real_fake':
+            loss += (gradient.norm() - center) ** 2
+        else:
+            loss += batch_fraction * ((gradient.norm(2, dim=1) - center) ** 2).mean()
 
     return loss
 
 
-def strengh_contour_error(real_motion, fake_motion):
+def lazy_gradient_penalty(D, real_data, fake_data, critic_step, interval=1, term=None, scaler=None, batch_fraction=1):
+    """
+    Lazy regularization: the penalty is computed only every interval critic steps and weighted by interval,
+    which keeps its average contribution to the critic loss. Returns None on the steps in between.
+    """
+    if critic_step % interval != 0:
+        return None
+    return interval * calc_gradient_penalty_ST(D, real_data, fake_data, term=term, scaler=scaler,
+                                               batch_fraction=batch_fraction)
+
+
+def strengh_contour_error(real_motion, fake_motion, per_sample=False):
+    """
+    per_sample: return the error of every sample, (N,), instead of the error of the whole batch
+    """
     real_v = torch.zeros_like(real_motion)
     fake_v = torch.zeros_like(fake_motion)
     real_v[:, 1:, :, :] = real_motion[:, :-1, :, :] - real_motion[:, 1:, :, :]
@@ -125,12 +166,17 @@ def strengh_contour_error(real_motion, fake_motion):
         real_v_pool = real_v_pool.detach().cpu().numpy()
         fake_v_pool = fake_v_pool.detach().cpu().numpy()'''
 
+    if per_sample:
+        return torch.log(((fake_v_pool - real_v_pool) ** 2).mean(dim=1) * 1e7 + 1)
     strengh_contour_error = MSE(fake_v_pool, real_v_pool)
 
     return torch.log(strengh_contour_error * 1e7 + 1)
 
 
-def rhythm_density_error(real_motion_batch, fake_motion_batch):
+def rhythm_density_error(real_motion_batch, fake_motion_batch, per_sample=False):
+    """
+    per_sample: return the error of every sample, (N,), instead of the error of the whole batch
+    """
     N, T, J, C = real_motion_batch.size()
     real_motion_batch = real_motion_batch.detach().cpu().numpy()
     fake_motion_batch = fake_motion_batch.detach().cpu().numpy()
@@ -166,4 +212,6 @@ def rhythm_density_error(real_motion_batch, fake_motion_batch):
         RDE = ((PSD_real[threshold:bins] - PSD_fake[threshold:bins]) ** 2).mean()
         RDE_batch[n] = RDE
 
+    if per_sample:
+        return np.log(RDE_batch * 1e7 + 1)
     return np.log(RDE_batch.mean() * 1e7 + 1)
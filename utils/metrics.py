@@ -0,0 +1,87 @@
+import queue
+import threading
+import torch
+
+
+class MetricLogger:
+    """
+    Running means of training metrics for TensorBoard. Tensor metrics are accumulated on their device, so add()
+    never synchronizes with the GPU. flush() copies all means to the host with one non-blocking copy and a
+    background thread waits for it and writes the scalars, add_scalars(tag, {name: value}, step) as before.
+    latest holds the last flushed means by (tag, name), e.g. for progress bars. With writer=None (e.g. on processes
+    other than rank 0) the means are only kept in latest.
+    """
+
+    def __init__(self, writer, flush_steps=20):
+        self.writer = writer
+        self.flush_steps = flush_steps
+        self.sums, self.counts = {}, {}
+        self.host_sums, self.host_counts = {}, {}
+        self.latest = {}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def add(self, tag, name, value):
+        """ value: a tensor (averaged on its device) or a host number """
+        key = (tag, name)
+        if torch.is_tensor(value):
+            value = value.detach().float()
+            if key in self.sums:
+                self.sums[key] += value
+            else:
+                self.sums[key] = value.clone()
+            self.counts[key] = self.counts.get(key, 0) + 1
+        else:
+            self.host_sums[key] = self.host_sums.get(key, 0) + float(value)
+            self.host_counts[key] = self.host_counts.get(key, 0) + 1
+
+    def step(self, total_step):
+        if (total_step + 1) % self.flush_steps == 0:
+            self.flush(total_step)
+
+    def flush(self, total_step):
+        keys, host, event = list(self.sums.keys()), None, None
+        if len(keys) > 0:
+            means = torch.stack([self.sums[key] / self.counts[key] for key in keys])
+            if means.is_cuda:
+                host = torch.empty(means.shape, dtype=means.dtype, pin_memory=True)
+                host.copy_(means, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+            else:
+                host = means
+        host_means = {key: self.host_sums[key] / self.host_counts[key] for key in self.host_sums}
+        self.queue.put((keys, host, event, host_means, total_step))
+        self.sums, self.counts = {}, {}
+        self.host_sums, self.host_counts = {}, {}
+
+    def join(self):
+        """ Wait until everything flushed so far is written """
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            keys, host, event, host_means, total_step = item
+            if event is not None:
+                event.synchronize()
+            means = dict(host_means)
+            if host is not None:
+                means.update(zip(keys, host.tolist()))
+
+            scalars = {}
+            for (tag, name), value in means.items():
+                scalars.setdefault(tag, {})[name] = value
+            if self.writer is not None:
+                for tag, values in scalars.items():
+                    self.writer.add_scalars(tag, values, total_step)
+            self.latest.update(means)
+            self.queue.task_done()
@@ -0,0 +1,68 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+KEPT_NAMES = ['nose', 'left eye', 'right eye', 'left ear', 'right ear', 'left shoulder', 'right shoulder',
+              'left elbow', 'right elbow', 'left wrist', 'right wrist', 'left hip', 'right hip']
+COORDINATE = ['x axis', 'y axis']
+
+
+def figure_to_array(fig):
+    """ Draw a figure on the Agg canvas into an RGB array (H, W, 3), no file I/O and no pyplot state """
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())[:, :, :3].copy()
+
+
+def render_motion(fake_motion, motion, figsize=(18, 6), linewidth=0.5, fontsize=8, fake_color='r'):
+    """ Real (gray) and generated trajectories of every joint and axis, fake_motion / motion: (T, 13, 2) arrays """
+    fig = Figure(figsize=figsize)
+    for kept in range(13):
+        for xy in range(2):
+            ax = fig.add_subplot(13, 2, kept * 2 + xy + 1)
+            ax.plot(motion[:, kept, xy], linewidth=linewidth,
+                    label=KEPT_NAMES[kept] + ' - ' + COORDINATE[xy] + '- real', color='gray')
+            ax.plot(fake_motion[:, kept, xy], linewidth=linewidth,
+                    label=KEPT_NAMES[kept] + ' - ' + COORDINATE[xy] + '- fake', color=fake_color)
+            ax.legend(loc='upper right', fontsize=fontsize)
+            ax.set_ylim(0, 1)
+            ax.set_xticks([])
+            ax.set_yticks([])
+    fig.subplots_adjust(wspace=0, hspace=0, left=0.05, right=0.95, top=0.95, bottom=0.05)
+    return figure_to_array(fig)
+
+
+def render_hidden_feature(hidden_feature):
+    """ hidden_feature: (C, T) array """
+    fig = Figure(figsize=(20, 2))
+    ax = fig.add_subplot(1, 1, 1)
+    image = ax.imshow(hidden_feature, cmap='plasma', aspect='auto')
+    fig.colorbar(image, ax=ax)
+    return figure_to_array(fig)
+
+
+class FigureRenderer:
+    """
+    Runs render functions inline, or with background=True in a separate process so that evaluation never waits on
+    matplotlib. submit(callback, render, *args) calls callback(image) once the figure is rendered; render and its
+    arguments (numpy arrays) must be picklable.
+    """
+
+    def __init__(self, background=False):
+        self.executor = None
+        if background:
+            self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, callback, render, *args):
+        if self.executor is None:
+            callback(render(*args))
+            return
+        future = self.executor.submit(render, *args)
+        future.add_done_callback(lambda f: callback(f.result()))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
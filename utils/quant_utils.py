@@ -0,0 +1,147 @@
+import argparse
+import time
+import tqdm
+import numpy as np
+
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from utils.export_utils import prepare_for_export
+from utils.loss import rhythm_density_error, strengh_contour_error
+
+
+def quantize_generator(G, mode='static', calibration_loader=None, num_calibration_batches=8, backend='x86'):
+    """
+    Post-training int8 quantization of a Generator for CPU inference. Returns a quantized copy.
+
+    'dynamic': int8 weights, activations quantized on the fly. PyTorch only provides dynamic kernels for
+               nn.Linear, so this covers the fully connected head of PoseDecoderTCN.
+    'static':  int8 weights and activations for the Conv1d/Conv2d/ConvTranspose1d/Linear layers of
+               MusicEncoder, PoseDecoderTCN and the noise upsampler (FX graph mode), with activation ranges
+               calibrated on batches of (mel, motion) from calibration_loader.
+    """
+    torch.backends.quantized.engine = backend
+    G = prepare_for_export(G)
+
+    if mode == 'dynamic':
+        return quantize_dynamic(G, {nn.Linear}, dtype=torch.qint8)
+    elif mode != 'static':
+        raise RuntimeError('Invalid quantization mode!')
+    if calibration_loader is None:
+        raise RuntimeError('Static quantization needs a calibration_loader!')
+
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    mel = torch.rand([1, 90 * 10, 128])
+    noise = torch.randn([1, 10, 8])
+    with torch.no_grad():
+        tcn_input = G.features(mel, noise)
+    G.music_encoder = prepare_fx(G.music_encoder, qconfig_mapping, (mel,))
+    G.noise_convTranspose = prepare_fx(G.noise_convTranspose, qconfig_mapping, (noise.transpose(1, 2),))
+    G.tcn = prepare_fx(G.tcn, qconfig_mapping, (tcn_input,))
+
+    with torch.no_grad():
+        for step, (mel, _) in enumerate(calibration_loader):
+            if step == num_calibration_batches:
+                break
+            mel = mel.type(torch.FloatTensor)
+            noise = torch.randn([mel.shape[0], mel.shape[1] // 90, 8])
+            G(mel, noise)
+
+    G.music_encoder = convert_fx(G.music_encoder)
+    G.noise_convTranspose = convert_fx(G.noise_convTranspose)
+    G.tcn = convert_fx(G.tcn)
+    return G
+
+
+def evaluate_generator(G, test_loader, perceptual_loss, seed=0):
+    """ MPE / RDE / SCE as in M2SGAN_Evaluator, plus Generator latency per batch, all on CPU """
+    torch.manual_seed(seed)
+    MPE_all = []
+    RDE_all = []
+    SCE_all = []
+    time_all = []
+    with torch.no_grad():
+        for mel, real_motion in tqdm.tqdm(test_loader):
+            mel = mel.type(torch.FloatTensor)
+            real_motion = real_motion.type(torch.FloatTensor)
+            noise = torch.randn([mel.shape[0], mel.shape[1] // 90, 8])
+
+            start = time.perf_counter()
+            fake_motion = G(mel, noise)
+            time_all.append(time.perf_counter() - start)
+
+            MPE_all.append(perceptual_loss(fake_motion, real_motion).item())
+            RDE_all.append(rhythm_density_error(real_motion, fake_motion))
+            SCE_all.append(strengh_contour_error(real_motion, fake_motion).item())
+
+    return {'MPE': np.mean(MPE_all), 'RDE': np.mean(RDE_all), 'SCE': np.mean(SCE_all),
+            'ms/batch': np.mean(time_all) * 1000}
+
+
+if __name__ == '__main__':
+    from torch.utils.data import DataLoader, Subset
+    from models.Generator import Generator
+    from models.M2SNet import M2SNet
+    from utils.dataset import ConductorMotionDataset
+    from utils.loss import SyncLoss
+
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization of the Generator')
+    parser.add_argument('--model', default='checkpoints/M2SGAN/M2SGAN_official_pretrained.pt')
+    parser.add_argument('--M2SNet', default='checkpoints/M2SNet/M2SNet_official_pretrained.pt',
+                        help='to calculate Mean Perceptual Error (MPE)')
+    parser.add_argument('--mode', default='static', help='"dynamic" or "static"')
+    parser.add_argument('--backend', default='x86', help='quantized engine: "x86", "fbgemm" or "qnnpack"')
+    parser.add_argument('--num_threads', default=None, type=int)
+
+    parser.add_argument('--dataset_dir', default='Dataset')
+    parser.add_argument('--calibration_set', default='train')
+    parser.add_argument('--calibration_set_limit', default=1, type=float, help='in: hours')
+    parser.add_argument('--num_calibration', default=64, type=int, help='number of calibration samples')
+    parser.add_argument('--testing_set', default='test')
+    parser.add_argument('--testing_set_limit', default=None, type=float, help='in: hours')
+    parser.add_argument('--batch_size', default=4, type=int)
+    parser.add_argument('--sample_length', default=30, type=int, help='in: seconds')
+    parser.add_argument('--save', default=None, help='optional path to save the quantized Generator (TorchScript)')
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    G = Generator()
+    G.load_state_dict(torch.load(args.model, map_location='cpu'))
+    G.eval()
+    m2snet = M2SNet()
+    m2snet.load_state_dict(torch.load(args.M2SNet, map_location='cpu'))
+    perceptual_loss = SyncLoss(m2snet.motion_encoder)
+
+    calibration_set = ConductorMotionDataset(sample_length=args.sample_length,
+                                             split=args.calibration_set,
+                                             limit=args.calibration_set_limit,
+                                             root_dir=args.dataset_dir)
+    calibration_idx = np.random.RandomState(0).permutation(len(calibration_set))[:args.num_calibration]
+    calibration_loader = DataLoader(Subset(calibration_set, calibration_idx), batch_size=args.batch_size)
+    testing_set = ConductorMotionDataset(sample_length=args.sample_length,
+                                         split=args.testing_set,
+                                         limit=args.testing_set_limit,
+                                         root_dir=args.dataset_dir)
+    test_loader = DataLoader(testing_set, batch_size=args.batch_size, shuffle=False)
+
+    G_int8 = quantize_generator(G, args.mode, calibration_loader,
+                                num_calibration_batches=len(calibration_loader), backend=args.backend)
+
+    fp32 = evaluate_generator(G, test_loader, perceptual_loss)
+    int8 = evaluate_generator(G_int8, test_loader, perceptual_loss)
+
+    print('-' * 64)
+    print(f'{"":>10}{"fp32":>12}{"int8":>12}{"change":>12}')
+    for key in ['MPE', 'RDE', 'SCE', 'ms/batch']:
+        print(f'{key:>10}{fp32[key]:>12.5f}{int8[key]:>12.5f}{int8[key] - fp32[key]:>+12.5f}')
+    print(f'speedup: {fp32["ms/batch"] / int8["ms/batch"]:.2f}x ({args.mode}, {torch.get_num_threads()} threads)')
+    print('-' * 64)
+
+    if args.save is not None:
+        traced = torch.jit.trace(G_int8, (torch.rand([1, 900, 128]), torch.randn([1, 10, 8])))
+        torch.jit.save(torch.jit.freeze(traced), args.save)
+        print('quantized Generator saved to', args.save)
@@ -1,8 +1,9 @@
 import time
+import json
+import contextlib
 import torch
-from PIL import Image
-import matplotlib.pyplot as plt
 import numpy as np
+from utils.plot_utils import render_motion, render_hidden_feature
 
 
 class PairBuilder:
@@ -12,11 +13,23 @@ class PairBuilder:
     motion sampling rate: 30 Hz
     """
 
-    def __init__(self, args):
+    def __init__(self, args, device='cuda'):
         if args.clip_length > args.sample_length / 3:
             raise RuntimeError('part_length should less than sample_length/3')
         self.sample_length = args.sample_length
         self.clip_length = args.clip_length
+        # every clip has exactly this many frames, wherever it starts
+        self.music_frames = round(self.clip_length * 90)
+        self.motion_frames = round(self.clip_length * 30)
+        self.device = device
+        self.random = np.random.rand
+
+    def seed(self, seed):
+        """
+        Draw the clip offsets from a dedicated, seeded generator instead of the global NumPy state, so that the
+        same pairs are built every time (e.g. for evaluation)
+        """
+        self.random = np.random.default_rng(seed).random
 
     def build_pairs(self, music, motion, sampling_strategy):
 
@@ -25,15 +38,14 @@ class PairBuilder:
             Easy negative pairs are select from different samples 
             (i.e. different piece of music) within a mini-batch. 
             '''
-            start = np.random.rand() * (self.sample_length - self.clip_length)
-            end = start + self.clip_length
-            music_start, music_end = int(start * 90), int(end * 90)
-            motion_start, motion_end = int(start * 30), int(end * 30)
+            start = self.random() * (self.sample_length - self.clip_length)
+            music_start, music_end = int(start * 90), int(start * 90) + self.music_frames
+            motion_start, motion_end = int(start * 30), int(start * 30) + self.motion_frames
 
-            music_1 = music[:, music_start:music_end, :].type(torch.FloatTensor).cuda()
-            motion_1 = motion[:, motion_start:motion_end, :].type(torch.FloatTensor).cuda()
-            music_2 = music[:, music_start:music_end, :].type(torch.FloatTensor).cuda().flip(dims=[0])
-            motion_2 = motion[:, motion_start:motion_end, :].type(torch.FloatTensor).cuda().flip(dims=[0])
+            music_1 = music[:, music_start:music_end, :].type(torch.FloatTensor).to(self.device)
+            motion_1 = motion[:, motion_start:motion_end, :].type(torch.FloatTensor).to(self.device)
+            music_2 = music[:, music_start:music_end, :].type(torch.FloatTensor).to(self.device).flip(dims=[0])
+            motion_2 = motion[:, motion_start:motion_end, :].type(torch.FloatTensor).to(self.device).flip(dims=[0])
 
             return music_1, music_2, motion_1, motion_2
 
@@ -43,20 +55,18 @@ class PairBuilder:
             We force the sampled to pairs have a range of at least 10 seconds.
             '''
 
-            start_1 = np.random.rand() * (self.sample_length - self.clip_length - 10)
-            start_2 = start_1 + 10 + np.random.rand() * (self.sample_length - self.clip_length - start_1 - 10)
-            end_1 = start_1 + self.clip_length
-            end_2 = start_2 + self.clip_length
+            start_1 = self.random() * (self.sample_length - self.clip_length - 10)
+            start_2 = start_1 + 10 + self.random() * (self.sample_length - self.clip_length - start_1 - 10)
 
-            music_start_1, music_end_1 = int(start_1 * 90), int(end_1 * 90)
-            motion_start_1, motion_end_1 = int(start_1 * 30), int(end_1 * 30)
-            music_start_2, music_end_2 = int(start_2 * 90), int(end_2 * 90)
-            motion_start_2, motion_end_2 = int(start_2 * 30), int(end_2 * 30)
+            music_start_1, music_end_1 = int(start_1 * 90), int(start_1 * 90) + self.music_frames
+            motion_start_1, motion_end_1 = int(start_1 * 30), int(start_1 * 30) + self.motion_frames
+            music_start_2, music_end_2 = int(start_2 * 90), int(start_2 * 90) + self.music_frames
+            motion_start_2, motion_end_2 = int(start_2 * 30), int(start_2 * 30) + self.motion_frames
 
-            music_1 = music[:, music_start_1:music_end_1, :].type(torch.FloatTensor).cuda()
-            motion_1 = motion[:, motion_start_1:motion_end_1, :].type(torch.FloatTensor).cuda()
-            music_2 = music[:, music_start_2:music_end_2, :].type(torch.FloatTensor).cuda()
-            motion_2 = motion[:, motion_start_2:motion_end_2, :].type(torch.FloatTensor).cuda()
+            music_1 = music[:, music_start_1:music_end_1, :].type(torch.FloatTensor).to(self.device)
+            motion_1 = motion[:, motion_start_1:motion_end_1, :].type(torch.FloatTensor).to(self.device)
+            music_2 = music[:, music_start_2:music_end_2, :].type(torch.FloatTensor).to(self.device)
+            motion_2 = motion[:, motion_start_2:motion_end_2, :].type(torch.FloatTensor).to(self.device)
 
             return music_1, music_2, motion_1, motion_2
 
@@ -65,20 +75,18 @@ class PairBuilder:
             Super-hard negative pairs are also select from same samples, 
             but they are sampled by random temporal shifts within the range of 0.5 second to 5 seconds
             '''
-            start_1 = np.random.rand() * (self.sample_length - self.clip_length - 5)
-            start_2 = np.random.rand() * (5 - 0.5) + start_1
-            end_1 = start_1 + self.clip_length
-            end_2 = start_2 + self.clip_length
+            start_1 = self.random() * (self.sample_length - self.clip_length - 5)
+            start_2 = self.random() * (5 - 0.5) + start_1
 
-            music_start_1, music_end_1 = int(start_1 * 90), int(end_1 * 90)
-            motion_start_1, motion_end_1 = int(start_1 * 30), int(end_1 * 30)
-            music_start_2, music_end_2 = int(start_2 * 90), int(end_2 * 90)
-            motion_start_2, motion_end_2 = int(start_2 * 30), int(end_2 * 30)
+            music_start_1, music_end_1 = int(start_1 * 90), int(start_1 * 90) + self.music_frames
+            motion_start_1, motion_end_1 = int(start_1 * 30), int(start_1 * 30) + self.motion_frames
+            music_start_2, music_end_2 = int(start_2 * 90), int(start_2 * 90) + self.music_frames
+            motion_start_2, motion_end_2 = int(start_2 * 30), int(start_2 * 30) + self.motion_frames
 
-            music_1 = music[:, music_start_1:music_end_1, :].type(torch.FloatTensor).cuda()
-            motion_1 = motion[:, motion_start_1:motion_end_1, :].type(torch.FloatTensor).cuda()
-            music_2 = music[:, music_start_2:music_end_2, :].type(torch.FloatTensor).cuda()
-            motion_2 = motion[:, motion_start_2:motion_end_2, :].type(torch.FloatTensor).cuda()
+            music_1 = music[:, music_start_1:music_end_1, :].type(torch.FloatTensor).to(self.device)
+            motion_1 = motion[:, motion_start_1:motion_end_1, :].type(torch.FloatTensor).to(self.device)
+            music_2 = music[:, music_start_2:music_end_2, :].type(torch.FloatTensor).to(self.device)
+            motion_2 = motion[:, motion_start_2:motion_end_2, :].type(torch.FloatTensor).to(self.device)
 
             return music_1, music_2, motion_1, motion_2
 
@@ -95,50 +103,236 @@ def unfreeze(layer):
             param.requires_grad = True
 
 
+class FakeReplayBuffer:
+    """
+    Recently generated (detached) motion for the critic, kept on the device in a ring of size samples.
+    sample() draws a random batch from it; latest(position, n) returns exactly the n fakes pushed at position, as
+    long as no more than size samples were pushed since.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buffer = None
+        self.count = 0
+
+    def push(self, fake):
+        """ Adds fake to the ring and returns its position, for latest() """
+        if len(fake) > self.size:
+            raise RuntimeError('replay buffer should hold at least one batch!')
+        fake = fake.detach()
+        if self.buffer is None:
+            self.buffer = torch.empty((self.size,) + fake.shape[1:], dtype=fake.dtype, device=fake.device)
+        index = (torch.arange(len(fake)) + self.count) % self.size
+        self.buffer[index.to(fake.device)] = fake
+        position = self.count
+        self.count += len(fake)
+        return position
+
+    def latest(self, position, batch_size):
+        index = (torch.arange(batch_size) + position) % self.size
+        return self.buffer[index.to(self.buffer.device)]
+
+    def sample(self, batch_size):
+        filled = min(self.count, self.size)
+        return self.buffer[torch.randint(filled, (batch_size,), device=self.buffer.device)]
+
+    def state_dict(self):
+        return {'buffer': self.buffer, 'count': self.count}
+
+    def load_state_dict(self, state, device='cuda'):
+        self.count = state['count']
+        self.buffer = state['buffer'].to(device) if state['buffer'] is not None else None
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Sample order of an epoch derived from (seed, epoch) only, so that training can be resumed at any batch of an
+    epoch: set_epoch(epoch, start) skips the first start samples of that epoch's order. With num_replicas processes,
+    every process draws the same order and takes every num_replicas-th sample from position rank; the last
+    len % num_replicas samples of the order are left out, so that all processes run the same number of steps.
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.num_samples = len(data_source) // num_replicas
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+        self.total_size = len(data_source)
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.total_size, generator=generator).tolist()
+        else:
+            order = list(range(self.total_size))
+        order = order[self.rank:self.num_samples * self.num_replicas:self.num_replicas]
+        return iter(order[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class StageTimer:
+    """
+    Accumulates the wall-clock time of named training stages. On CUDA the stages are timed with events, so timing
+    doesn't synchronize the host; collect() waits for the recorded events and returns (and resets) the totals in ms.
+    """
+
+    def __init__(self, enabled=True, device='cuda'):
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == 'cuda'
+        self.records = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.cuda:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+        else:
+            start = time.perf_counter()
+            yield
+            end = time.perf_counter()
+        self.records.setdefault(name, []).append((start, end))
+
+    def collect(self):
+        totals = {}
+        for name, records in self.records.items():
+            if self.cuda:
+                records[-1][1].synchronize()
+                totals[name] = sum(start.elapsed_time(end) for start, end in records)
+            else:
+                totals[name] = sum(end - start for start, end in records) * 1000
+        self.records = {}
+        return totals
+
+    def iterate(self, iterable, name='data_loading'):
+        """ Waiting for the items of iterable (e.g. a DataLoader) is host time, it is only timed by StageProfiler """
+        return iterable
+
+    def step(self):
+        """ Marks the end of a training step """
+
+
+class StageProfiler(StageTimer):
+    """
+    StageTimer for profiling runs: the device is synchronized at both ends of every region, so that each region is
+    charged with the work it issued (at the cost of stalling the pipeline), and every region is kept. Regions may
+    nest. report() returns, per stage, the percentiles of its time per training step and its share of the step time,
+    the first warmup steps (cuDNN autotuning, allocator growth) left out; save_trace() writes every region as a Chrome
+    trace (chrome://tracing or https://ui.perfetto.dev).
+    """
+
+    def __init__(self, device='cuda', rank=0, warmup=0):
+        super().__init__(enabled=True, device=device)
+        self.warmup = warmup
+        self.cuda = False
+        self.device = torch.device(device)
+        self.rank = rank
+        self.events = []
+        self.depth = 0
+        self.steps = 0
+        self.origin = time.perf_counter()
+
+    def synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        self.synchronize()
+        start = time.perf_counter()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            self.synchronize()
+            end = time.perf_counter()
+            self.events.append((name, start, end, self.depth, self.steps))
+            self.records.setdefault(name, []).append((start, end))
+
+    def iterate(self, iterable, name='data_loading'):
+        iterator = iter(iterable)
+        while True:
+            with self(name):
+                item = next(iterator, self)
+            if item is self:
+                return
+            yield item
+
+    def step(self):
+        self.steps += 1
+
+    def report(self):
+        """ Rows of the per-stage breakdown, in ms per training step, stages in order of first appearance """
+        events = [event for event in self.events if event[4] >= self.warmup]
+        steps = range(self.warmup, max(self.steps, self.warmup + 1))
+        per_step = {}
+        for name, start, end, depth, step in events:
+            stage = per_step.setdefault(name, {'depth': depth, 'calls': 0, 'steps': {}})
+            stage['calls'] += 1
+            stage['steps'][step] = stage['steps'].get(step, 0) + (end - start) * 1000
+        # the time of a step is the time of its outermost regions
+        total = sum(end - start for _, start, end, depth, _ in events if depth == 0) * 1000
+
+        rows = []
+        for name, stage in per_step.items():
+            times = np.array([stage['steps'].get(step, 0) for step in steps])
+            rows.append({'stage': '  ' * stage['depth'] + name,
+                         'calls/step': stage['calls'] / len(steps),
+                         'mean_ms': float(times.mean()),
+                         'p50_ms': float(np.percentile(times, 50)),
+                         'p90_ms': float(np.percentile(times, 90)),
+                         'p99_ms': float(np.percentile(times, 99)),
+                         'max_ms': float(times.max()),
+                         'share': '%.1f%%' % (100 * times.sum() / total if total > 0 else 0)})
+        return rows
+
+    def print_report(self):
+        rows = self.report()
+        columns = ['stage', 'calls/step', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'share']
+        cells = [[row[column] if isinstance(row[column], str) else '%.3f' % row[column] for column in columns]
+                 for row in rows]
+        widths = [max([len(column)] + [len(row[i]) for row in cells]) for i, column in enumerate(columns)]
+        print('| Profile of {} steps after {} warmup steps (rank {}), ms per step, nested stages are indented'
+              .format(max(self.steps - self.warmup, 0), self.warmup, self.rank))
+        print(' | '.join(column.ljust(width) for column, width in zip(columns, widths)))
+        print('-+-'.join('-' * width for width in widths))
+        for row in cells:
+            print(' | '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+    def save_trace(self, path):
+        """ Chrome trace event format: one complete event (ph X) per region, in microseconds """
+        events = [{'name': name, 'cat': 'train', 'ph': 'X', 'pid': self.rank, 'tid': 0,
+                   'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6, 'args': {'step': step}}
+                  for name, start, end, _, step in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
 def plot_motion(fake_motion, motion):
+    """ Figure of the first sample of a batch as an RGB array, see utils.plot_utils.render_motion """
     if type(fake_motion) != np.ndarray:
-        fake_motion = fake_motion.cpu().detach().numpy()
+        fake_motion = fake_motion.cpu().detach().float().numpy()
     if type(motion) != np.ndarray:
-        motion = motion.cpu().detach().numpy()
-    kept_names = ['nose', 'left eye', 'right eye', 'left ear', 'right ear', 'left shoulder', 'right shoulder',
-                          'left elbow', 'right elbow', 'left wrist', 'right wrist', 'left hip', 'right hip']
-    coordinate = ['x axis', 'y axis']
-
-    fig = plt.figure(figsize=(18, 6))
-
-    for kept in range(13):
-        for xy in range(2):
-            plt.subplot(13, 2, kept * 2 + xy + 1)
-            plt.plot(motion[0, :, kept, xy], linewidth=0.5,
-                     label=kept_names[kept] + ' - ' + coordinate[xy] + '- real', color='gray')
-            plt.plot(fake_motion[0, :, kept, xy], linewidth=0.5,
-                     label=kept_names[kept] + ' - ' + coordinate[xy] + '- fake', color='r')
-            plt.legend(loc='upper right', fontsize=8)
-            plt.ylim(0, 1)
-            plt.xticks([])
-            plt.yticks([])
-    plt.subplots_adjust(wspace=0, hspace=0, left=0.05, right=0.95, top=0.95, bottom=0.05)
-
-    image_path = 'temp_.png'
-    plt.savefig(image_path)
-    image_PIL = Image.open(image_path)
-    img = np.array(image_PIL)
-    plt.close()
-    time.sleep(0.5)
-    return img
+        motion = motion.cpu().detach().float().numpy()
+    return render_motion(fake_motion[0], motion[0])
 
 
 def plot_hidden_feature(hidden_feature):
+    """ Feature map of the first sample of a batch, (N, T, C), as an RGB array """
     hidden_feature = hidden_feature.transpose(1, 2).cpu().detach().numpy()
     hidden_feature = hidden_feature.astype(np.float32)[0]
-    plt.figure(figsize=(20, 2))
-    plt.imshow(hidden_feature, cmap='plasma', aspect='auto')
-    plt.colorbar()
-
-    image_path = 'temp_hidden_feature.png'
-    plt.savefig(image_path)
-    image_PIL = Image.open(image_path)
-    img = np.array(image_PIL)
-    plt.close()
-    time.sleep(0.1)
-    return img
+    return render_hidden_feature(hidden_feature)